@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import asyncio
+import sys
+
+sys.path.append('..')
+
+from reflectrpc import RpcFunction
+from reflectrpc import RpcProcessor
+from reflectrpc import JsonRpcError
+import reflectrpc.asyncioserver
+
+async def slow_operation():
+    await asyncio.sleep(1)
+
+    return 42
+
+def fast_operation():
+    return 41
+
+async def coroutine_error():
+    await asyncio.sleep(0.1)
+
+    raise JsonRpcError("You wanted an error, here you have it!")
+
+async def coroutine_internal_error():
+    await asyncio.sleep(0.1)
+
+    return 56 / 0
+
+notified_values = []
+
+async def notify(value):
+    await asyncio.sleep(0.1)
+
+    notified_values.append(value)
+
+def get_notified_values():
+    return notified_values
+
+jsonrpc = RpcProcessor()
+jsonrpc.set_description("Concurrency Example RPC Service",
+        "This service demonstrates concurrency with the asyncio Server", "1.0")
+
+slow_func = RpcFunction(slow_operation, 'slow_operation', 'Calculate ultimate answer',
+        'int', 'Ultimate answer')
+jsonrpc.add_function(slow_func)
+
+fast_func = RpcFunction(fast_operation, 'fast_operation',
+        'Calculate fast approximation of the ultimate answer',
+        'int', 'Approximation of the ultimate answer')
+jsonrpc.add_function(fast_func)
+
+error_func = RpcFunction(coroutine_error, 'coroutine_error',
+        'Raise a JsonRpcError from a coroutine', 'int', 'Nothing of interest')
+jsonrpc.add_function(error_func)
+
+internal_error_func = RpcFunction(coroutine_internal_error, 'coroutine_internal_error',
+        'Raise an internal error from a coroutine', 'int', 'Nothing of interest')
+jsonrpc.add_function(internal_error_func)
+
+notify_func = RpcFunction(notify, 'notify', 'Remember a value', 'bool',
+        'Nothing of interest')
+notify_func.add_param('int', 'value', 'Value to remember')
+jsonrpc.add_function(notify_func)
+
+values_func = RpcFunction(get_notified_values, 'get_notified_values',
+        'Get all values that were remembered', 'array<int>', 'Remembered values')
+jsonrpc.add_function(values_func)
+
+try:
+    server = reflectrpc.asyncioserver.AsyncioJsonRpcServer(jsonrpc, 'localhost', 5500)
+    server.run()
+except KeyboardInterrupt:
+    sys.exit(0)
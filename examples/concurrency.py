@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import sys
+import time
 
 import twisted.internet.defer as defer
 from twisted.internet import task
@@ -22,6 +23,21 @@ def slow_operation():
 def fast_operation():
     return 41
 
+def blocking_operation():
+    time.sleep(1)
+
+    return 42
+
+def limited_operation():
+    time.sleep(0.5)
+
+    return 43
+
+async def coroutine_operation(value):
+    await task.deferLater(reactor, 0.5, lambda: None)
+
+    return value * 2
+
 def deferred_error():
     def calc_result(value):
         raise JsonRpcError("You wanted an error, here you have it!")
@@ -55,5 +71,22 @@ internal_error_func = reflectrpc.RpcFunction(deferred_internal_error, 'deferred_
         'Raise an internal error from adeferred function', 'int', 'Nothing of interest')
 jsonrpc.add_function(internal_error_func)
 
+coroutine_func = reflectrpc.RpcFunction(coroutine_operation, 'coroutine_operation',
+        'Double a value in a coroutine', 'int', 'The doubled value')
+coroutine_func.add_param('int', 'value', 'Value to double')
+jsonrpc.add_function(coroutine_func)
+
+blocking_func = reflectrpc.RpcFunction(blocking_operation, 'blocking_operation',
+        'Calculate ultimate answer in a blocking way', 'int', 'Ultimate answer')
+blocking_func.run_in_thread_pool()
+jsonrpc.add_function(blocking_func)
+
+limited_func = reflectrpc.RpcFunction(limited_operation, 'limited_operation',
+        'Blocking function that runs in a pool with only one thread and no queue',
+        'int', 'Nothing of interest')
+limited_func.run_in_thread_pool('limited')
+jsonrpc.add_function(limited_func)
+
 server = reflectrpc.twistedserver.TwistedJsonRpcServer(jsonrpc, 'localhost', 5500)
+server.add_thread_pool('limited', max_threads=1, max_queue=0)
 server.run()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+sys.path.append('..')
+
+import reflectrpc
+import reflectrpc.twistedserver
+from reflectrpc import JsonRpcError
+from reflectrpc.processpool import ProcessPool
+
+worker_ready = False
+
+def init_worker():
+    global worker_ready
+    worker_ready = True
+
+def sum_of_squares(n):
+    return sum(i * i for i in range(n))
+
+def get_worker_info():
+    return {'pid': os.getpid(), 'ready': worker_ready}
+
+def worker_error():
+    raise JsonRpcError("Error in worker process")
+
+def get_server_pid():
+    return os.getpid()
+
+# workers that are replaced after some calls aren't forked, they import
+# this script
+if __name__ == '__main__':
+    jsonrpc = reflectrpc.RpcProcessor()
+    jsonrpc.set_description("Process Pool Example RPC Service",
+            "This service executes CPU-bound functions in worker processes", "1.0")
+    jsonrpc.add_process_pool(ProcessPool(processes=2, initializer=init_worker,
+        max_tasks_per_child=3))
+
+    func = reflectrpc.RpcFunction(sum_of_squares, 'sum_of_squares',
+            'Calculate the sum of the squares of all numbers below n', 'int',
+            'Sum of squares')
+    func.add_param('int', 'n', 'Upper bound')
+    func.run_in_process_pool()
+    jsonrpc.add_function(func)
+
+    func = reflectrpc.RpcFunction(get_worker_info, 'get_worker_info',
+            'Get information about the worker process that executes the call',
+            'hash', 'PID and initialization state of the worker')
+    func.run_in_process_pool()
+    jsonrpc.add_function(func)
+
+    func = reflectrpc.RpcFunction(worker_error, 'worker_error',
+            'Raise a JsonRpcError in a worker process', 'int', 'Nothing of interest')
+    func.run_in_process_pool()
+    jsonrpc.add_function(func)
+
+    func = reflectrpc.RpcFunction(get_server_pid, 'get_server_pid',
+            'Get the PID of the server process', 'int', 'PID of the server')
+    jsonrpc.add_function(func)
+
+    server = reflectrpc.twistedserver.TwistedJsonRpcServer(jsonrpc, 'localhost', 5500)
+    server.run()
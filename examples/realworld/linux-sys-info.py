@@ -2,21 +2,20 @@
 
 import re
 
-from twisted.internet import threads, reactor, defer
-
 import reflectrpc
 from reflectrpc.twistedserver import TwistedJsonRpcServer
 
 #
 # This example RPC service shows how to use ReflectRPC to create a production
-# service using Twisted for concurrency
+# service using Twisted for concurrency. The functions do blocking file IO and
+# are therefore executed in the thread pool of the server.
 #
 # The service runs only on Linux and provides access to system level
 # information in the /proc filesystem.
 #
 
 def get_cpuinfo():
-    # callback function for blocking file IO
+    # blocking file IO
     def read_cpuinfo_file():
         data = ''
         with open('/proc/cpuinfo', 'r') as f:
@@ -24,8 +23,8 @@ def get_cpuinfo():
 
         return data
 
-    # callback function for parsing the file data once it has been read and for
-    # wrapping it into a CPUInfo structure that can be sent to the client
+    # parse the file data once it has been read and wrap it into a CPUInfo
+    # structure that can be sent to the client
     def parse_data(data):
         cpuinfo = {}
         cpuinfo['numCPUs'] = 0
@@ -101,15 +100,10 @@ def get_cpuinfo():
 
         return cpuinfo
 
-    # read the /proc file in a thread and return a deferred
-    d = threads.deferToThread(read_cpuinfo_file)
-    # setup the callback to parse the file data once it is ready
-    d.addCallback(parse_data)
-
-    return d
+    return parse_data(read_cpuinfo_file())
 
 def get_meminfo():
-    # callback function for blocking file IO
+    # blocking file IO
     def read_meminfo_file():
         data = ''
         with open('/proc/meminfo', 'r') as f:
@@ -117,8 +111,8 @@ def get_meminfo():
 
         return data
 
-    # callback function for parsing the file data once it has been read and for
-    # wrapping it into a MemInfo structure that can be sent to the client
+    # parse the file data once it has been read and wrap it into a MemInfo
+    # structure that can be sent to the client
     def parse_data(data):
         result = {}
         result['memTotal'] = 0
@@ -154,12 +148,7 @@ def get_meminfo():
 
         return result
 
-    # read the /proc file in a thread and return a deferred
-    d = threads.deferToThread(read_meminfo_file)
-    # setup the callback to parse the file data once it is ready
-    d.addCallback(parse_data)
-
-    return d
+    return parse_data(read_meminfo_file())
 
 # create custom types
 cpuInfo = reflectrpc.JsonHashType('CPUInfo', 'Information about CPUs')
@@ -204,10 +193,12 @@ jsonrpc.add_custom_type(cpu)
 # register RPC functions
 cpuinfo_func = reflectrpc.RpcFunction(get_cpuinfo, 'get_cpuinfo', 'Gets information about the system CPUs',
         'CPUInfo', 'System CPU information')
+cpuinfo_func.run_in_thread_pool()
 jsonrpc.add_function(cpuinfo_func)
 
 meminfo_func = reflectrpc.RpcFunction(get_meminfo, 'get_meminfo', 'Gets information about the system memory',
         'MemInfo', 'System memory information')
+meminfo_func.run_in_thread_pool()
 jsonrpc.add_function(meminfo_func)
 
 server = reflectrpc.twistedserver.TwistedJsonRpcServer(jsonrpc, '0.0.0.0', 5500)
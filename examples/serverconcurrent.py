@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import sys
+import time
+
+sys.path.append('..')
+
+import reflectrpc
+import reflectrpc.simpleserver
+
+import rpcexample
+
+def slow_operation():
+    time.sleep(1)
+
+    return 42
+
+def fast_operation():
+    return 41
+
+try:
+    jsonrpc = rpcexample.build_example_rpcservice()
+
+    slow_func = reflectrpc.RpcFunction(slow_operation, 'slow_operation',
+            'Calculate ultimate answer', 'int', 'Ultimate answer')
+    jsonrpc.add_function(slow_func)
+
+    fast_func = reflectrpc.RpcFunction(fast_operation, 'fast_operation',
+            'Calculate fast approximation of the ultimate answer',
+            'int', 'Approximation of the ultimate answer')
+    jsonrpc.add_function(fast_func)
+
+    server = reflectrpc.simpleserver.ConcurrentJsonRpcServer(jsonrpc,
+            'localhost', 5500, max_threads=4)
+    server.run()
+except KeyboardInterrupt:
+    sys.exit(0)
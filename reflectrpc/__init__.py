@@ -1,10 +1,19 @@
 from __future__ import unicode_literals
 from builtins import bytes, dict, list, int, float, str
 
+import hashlib
+import inspect
 import json
 import re
+import sys
 import traceback
 
+from reflectrpc.cache import LruCache
+from reflectrpc.codec import JsonCodec, get_codec
+from reflectrpc.memory import MemoryTracer
+from reflectrpc.metrics import InFlightRequests, Metrics, PhaseTimings, RequestTiming, SlowRequestLog, timer
+from reflectrpc.profiler import SamplingProfiler
+
 version = '0.7.6'
 
 json_types = ['int', 'bool', 'float', 'string', 'array', 'hash', 'base64']
@@ -21,6 +30,65 @@ def json2py(json_type):
 def isstring(value):
     return type(value).__name__ in ['str', 'unicode']
 
+def is_deferred(value):
+    """
+    Check if a value is a Twisted Deferred without importing Twisted
+
+    Args:
+        value (any): Value to check
+
+    Returns:
+        bool: True if value is a Deferred, False if not
+    """
+    defer = sys.modules.get('twisted.internet.defer')
+
+    return defer is not None and isinstance(value, defer.Deferred)
+
+def is_awaitable(value):
+    """
+    Check if a value is an awaitable (e.g. a coroutine) but not a Deferred
+
+    Args:
+        value (any): Value to check
+
+    Returns:
+        bool: True if value can be awaited, False if not
+    """
+    return hasattr(type(value), '__await__') and not is_deferred(value)
+
+# Python types the JSON decoder produces for each primitive JSON type
+string_types = (type(''),)
+if sys.version_info.major == 2:
+    string_types += (type(b''),)
+
+py_types = {'bool': (type(True),), 'int': (type(0),), 'float': (type(0.0),),
+            'string': string_types, 'array': (type([]),), 'hash': (type({}),),
+            'base64': string_types}
+
+def json_type_name(value):
+    """
+    Name of the JSON type of a decoded value as used in error messages
+
+    Args:
+        value (any): A value as returned by the JSON decoder
+
+    Returns:
+        str: JSON type name (e.g. 'int', 'string', 'array')
+    """
+    if value is None:
+        return 'null'
+
+    real_type = type(value).__name__
+
+    # workaround for Python 2.7
+    if real_type == 'unicode':
+        real_type = 'str'
+
+    mapping = {'bool': 'bool', 'int': 'int', 'float': 'float', 'str':
+               'string', 'list': 'array', 'dict': 'hash'}
+
+    return mapping.get(real_type, real_type)
+
 class JsonRpcError(Exception):
     """
     Generic JSON-RPC error class
@@ -164,6 +232,38 @@ class JsonRpcInternalError(JsonRpcError):
         self.msg = msg
         self.name = 'InternalError'
 
+class JsonRpcServerBusy(JsonRpcError):
+    """
+    JSON-RPC error class for requests rejected because the server is overloaded
+
+    Raised when a call can't be queued for execution because the thread pool
+    of the function already has too many calls waiting.
+
+    Example:
+        The JSON representation of this error looks like this::
+
+            {"name": "ServerBusy", "message": "Your error message"}
+    """
+    def __init__(self, msg):
+        self.msg = msg
+        self.name = 'ServerBusy'
+
+class JsonRpcPermissionDenied(JsonRpcError):
+    """
+    JSON-RPC error class for calls the user is not allowed to make
+
+    Raised when a privileged builtin is called by a user who is not in the
+    list of privileged users.
+
+    Example:
+        The JSON representation of this error looks like this::
+
+            {"name": "PermissionDenied", "message": "Your error message"}
+    """
+    def __init__(self, msg):
+        self.msg = msg
+        self.name = 'PermissionDenied'
+
 class InvalidEnumValueError(Exception):
     def __init__(self, name, expected_type, value):
         self.name = name
@@ -187,6 +287,22 @@ class InvalidPrimitiveTypeError(Exception):
         self.expected_type = expected_type
         self.real_type = real_type
 
+class UnknownFieldError(Exception):
+    def __init__(self, name, expected_type, fieldname):
+        self.name = name
+        self.expected_type = expected_type
+        self.fieldname = fieldname
+
+class MissingFieldError(Exception):
+    def __init__(self, name, expected_type, fieldname):
+        self.name = name
+        self.expected_type = expected_type
+        self.fieldname = fieldname
+
+validation_errors = (InvalidEnumValueError, InvalidEnumTypeError,
+        InvalidNamedHashError, InvalidPrimitiveTypeError, UnknownFieldError,
+        MissingFieldError)
+
 class JsonEnumType(object):
     """
     Self-describing enum types
@@ -217,6 +333,7 @@ class JsonEnumType(object):
         self.typ = 'enum'
         self.description = description
         self.values = []
+        self.values_dict = {}
 
     def validate(self, value):
         """
@@ -251,6 +368,7 @@ class JsonEnumType(object):
         self.nextvalue += 1
 
         self.values.append(value)
+        self.values_dict[name] = value
 
     def resolve_name(self, name):
         """
@@ -269,8 +387,8 @@ class JsonEnumType(object):
         if not isstring(name):
             raise ValueError("'name' must be a string but is '%s'" % (type(name).__name__))
 
-        for v in self.values:
-            if v['name'] == name: return v['intvalue']
+        if name in self.values_dict:
+            return self.values_dict[name]['intvalue']
 
         return None
 
@@ -386,6 +504,8 @@ class JsonHashType(object):
         self.fields = []
         self.fields_dict = {}
         self.fieldnames = []
+        # incremented with every added field so compiled checks can update
+        self.revision = 0
 
     def add_field(self, name, typ, description):
         """
@@ -410,6 +530,7 @@ class JsonHashType(object):
         self.fields.append(field)
         self.fields_dict[name] = field
         self.fieldnames.append(name)
+        self.revision += 1
 
     def to_dict(self):
         """
@@ -498,6 +619,47 @@ def validate_type_declaration(type_decl):
 
     return False
 
+class PreencodedJson(object):
+    """
+    A value together with its JSON encoding
+
+    RPC functions and builtins can return a PreencodedJson object to have the
+    encoded data spliced into the reply instead of encoding the value again.
+    """
+    def __init__(self, value, data):
+        """
+        Constructor
+
+        Args:
+            value (any): The value as it is returned by process_request
+            data (bytes): UTF-8 encoded JSON representation of value
+        """
+        self.value = value
+        self.data = data
+
+class BatchReplies(list):
+    """
+    Replies of a batch request as returned by process_request
+
+    A notification of an RPC function that returned an awaitable gets no
+    reply, its awaitable is kept in the attribute notifications instead and
+    has to be run by the caller.
+    """
+    def __init__(self, replies=(), notifications=()):
+        """
+        Constructor
+
+        Args:
+            replies (list): JSON-RPC replies in the order of the requests
+            notifications (list): Awaitables of notification requests
+        """
+        list.__init__(self, replies)
+        self.notifications = list(notifications)
+
+# types of results that are neither Deferreds nor awaitables
+plain_result_types = frozenset([type(None), type(True), type(0), type(0.0),
+    type(''), type([]), type({}), PreencodedJson])
+
 class RpcFunction(object):
     """
     Description of a function exposed as Remote Procedure Call
@@ -533,6 +695,16 @@ class RpcFunction(object):
         self.type_checks_enabled = True
         self.requires_rpcinfo = False
 
+        # name of the thread pool or process pool to execute the function in
+        # (None to execute it inline)
+        self.thread_pool = None
+        self.process_pool = None
+
+        self.cache_enabled = False
+        self.cache_max_entries = None
+        self.cache_ttl = None
+        self.cache_per_user = False
+
     def add_param(self, typ, name, description):
         """
         Add a parameter to the function description
@@ -554,6 +726,74 @@ class RpcFunction(object):
     def require_rpcinfo(self):
         self.requires_rpcinfo = True
 
+    def run_in_thread_pool(self, pool_name='default'):
+        """
+        Execute the function in a thread pool of the server
+
+        Use this for functions that block (e.g. by doing file or network I/O)
+        so they don't block the event loop of an asynchronous server like
+        TwistedJsonRpcServer. Servers that don't support thread pools execute
+        the function inline.
+
+        Args:
+            pool_name (str): Name of the thread pool to use
+        """
+        self.thread_pool = pool_name
+        self.process_pool = None
+
+    def run_in_process_pool(self, pool_name='default'):
+        """
+        Execute the function in a worker process
+
+        Use this for CPU-bound functions so they can use all cores of the
+        host. The pool has to be added with RpcProcessor.add_process_pool.
+        The function must be defined at module level and its parameters and
+        result must be picklable.
+
+        Args:
+            pool_name (str): Name of the process pool to use
+        """
+        self.process_pool = pool_name
+        self.thread_pool = None
+
+    def enable_result_cache(self, max_entries=1024, ttl=None, per_user=False):
+        """
+        Cache the results of this function
+
+        Only use this for pure functions whose result depends on nothing but
+        their parameters. RpcProcessor keeps the encoded results of the most
+        recently used parameters and replies to calls with the same
+        parameters without calling the function again.
+
+        Args:
+            max_entries (int): Maximum number of cached results
+            ttl (float): Seconds after which a result expires or None to keep
+                         results until they are evicted
+            per_user (bool): Keep separate results for every user (the
+                             username in rpcinfo is part of the cache key)
+        """
+        self.cache_enabled = True
+        self.cache_max_entries = max_entries
+        self.cache_ttl = ttl
+        self.cache_per_user = per_user
+
+    def disable_result_cache(self):
+        """
+        Stop caching the results of this function
+
+        This is the default.
+        """
+        self.cache_enabled = False
+
+    def run_inline(self):
+        """
+        Execute the function directly in the thread that processes the request
+
+        This is the default.
+        """
+        self.thread_pool = None
+        self.process_pool = None
+
     def to_dict(self):
         """
         Convert the function description to a dictionary
@@ -605,12 +845,83 @@ class RpcProcessor(object):
         }
 
         self.builtins = {}
-        self.builtins['__describe_service'] = self.describe_service
-        self.builtins['__describe_functions'] = self.describe_functions
-        self.builtins['__describe_custom_types'] = self.describe_custom_types
+        self.builtins['__describe_service'] = self.describe_service_preencoded
+        self.builtins['__describe_functions'] = self.describe_functions_preencoded
+        self.builtins['__describe_custom_types'] = self.describe_custom_types_preencoded
+        self.builtins['__describe_if_changed'] = self.describe_if_changed
+        self.builtins['__describe_result_caches'] = self.describe_result_caches
+        self.builtins['__describe_metrics'] = self.describe_metrics
+        self.builtins['__describe_phase_timings'] = self.describe_phase_timings
+        self.builtins['__describe_event_loop_lag'] = self.describe_event_loop_lag
+        self.builtins['__start_profiler'] = self.start_profiler
+        self.builtins['__stop_profiler'] = self.stop_profiler
+        self.builtins['__get_profile'] = self.get_profile
+        self.builtins['__describe_slow_requests'] = self.describe_slow_requests
+        self.builtins['__clear_slow_requests'] = self.clear_slow_requests
+        self.builtins['__describe_in_flight_requests'] = self.describe_in_flight_requests
+        self.builtins['__start_memory_tracing'] = self.start_memory_tracing
+        self.builtins['__stop_memory_tracing'] = self.stop_memory_tracing
+        self.builtins['__describe_memory_tracing'] = self.describe_memory_tracing
+        self.builtins['__take_memory_snapshot'] = self.take_memory_snapshot
+        self.builtins['__compare_memory_snapshots'] = self.compare_memory_snapshots
+
+        # minimum and maximum number of parameters by builtin
+        self.builtin_param_counts = {}
+
+        # builtins that can only be called by privileged users
+        self.privileged_builtins = set(['__start_profiler', '__stop_profiler',
+            '__get_profile', '__describe_slow_requests', '__clear_slow_requests',
+            '__describe_in_flight_requests',
+            '__start_memory_tracing', '__stop_memory_tracing',
+            '__describe_memory_tracing', '__take_memory_snapshot',
+            '__compare_memory_snapshots'])
+        self.privileged_users = set()
+
+        # preencoded descriptions, built on first use
+        self.description_cache = None
 
         self.named_hash_validation = True
 
+        self.codec = get_codec()
+
+        # executes functions that are to be run in a thread pool
+        self.executor = None
+
+        # ProcessPool objects by name
+        self.process_pools = {}
+
+        # LruCache objects with the results of cached functions by name
+        self.result_caches = {}
+
+        # call counts, error counts and latencies by method name
+        self.metrics = Metrics()
+        self.metrics_enabled = False
+
+        # time spent in the phases of processing a message by method name
+        self.phase_timings = PhaseTimings()
+        self.phase_timing_enabled = False
+        self.phase_timing_hook = None
+
+        # the slowest recent requests and requests over a threshold
+        self.slow_requests = None
+
+        # the requests that are currently executing
+        self.in_flight = None
+
+        # the sampling profiler is only set as profiler while it is running
+        self.sampling_profiler = SamplingProfiler()
+        self.profiler = None
+
+        # named tracemalloc snapshots
+        self.memory_tracer = MemoryTracer()
+
+        # LagMonitor of the event loop, set by servers that support it
+        self.lag_monitor = None
+
+        # compiled parameter validators by function name and by type declaration
+        self.validators = {}
+        self.type_validators = {}
+
         self.json2py = {'bool': 'bool', 'int': 'int', 'float': 'float', 'string':
                 'str', 'array': 'list', 'hash': 'dict', 'base64': 'str'}
 
@@ -635,6 +946,7 @@ class RpcProcessor(object):
             custom_fields = {}
 
         self.description['custom_fields'] = custom_fields
+        self.invalidate_description_cache()
 
     def add_custom_type(self, custom_type):
         """
@@ -655,6 +967,69 @@ class RpcProcessor(object):
 
         self.custom_types.append(custom_type)
         self.custom_types_dict[custom_type.name] = custom_type
+        self.invalidate_description_cache()
+
+    def set_codec(self, codec):
+        """
+        Select the JSON codec used to decode requests and encode replies
+
+        By default the fastest installed codec is used.
+
+        Args:
+            codec (str|JsonCodec): Name of a registered codec (e.g. 'json',
+                                   'orjson') or a JsonCodec object
+
+        Raises:
+            ValueError: If the codec is unknown or not installed
+        """
+        if not isinstance(codec, JsonCodec):
+            codec = get_codec(codec)
+
+        self.codec = codec
+        self.invalidate_description_cache()
+        self.clear_result_caches()
+
+    def set_executor(self, executor):
+        """
+        Set the object that executes functions which are to be run in a
+        thread pool
+
+        The executor must have a method execute(pool_name, func, params) that
+        calls func with the list params in the named pool and returns a result
+        that the server can wait for (e.g. a Deferred). This is normally done
+        by the server. Without an executor all functions are executed inline.
+
+        Args:
+            executor (object): Executor object or None
+        """
+        self.executor = executor
+
+    def add_process_pool(self, pool, name='default'):
+        """
+        Add a pool of worker processes for CPU-bound functions
+
+        Args:
+            pool (ProcessPool): The pool (see reflectrpc.processpool)
+            name (str): Name used by RpcFunction.run_in_process_pool
+        """
+        self.process_pools[name] = pool
+
+    def start_process_pools(self):
+        """
+        Start the workers of all process pools
+
+        Servers call this before they start listening. Pools that are not
+        started are started on first use.
+        """
+        for pool in self.process_pools.values():
+            pool.start()
+
+    def stop_process_pools(self):
+        """
+        Stop the workers of all process pools
+        """
+        for pool in self.process_pools.values():
+            pool.stop()
 
     def enable_named_hash_validation(self):
         """
@@ -675,6 +1050,9 @@ class RpcProcessor(object):
         Args:
             func (RpcFunction): Description object for the new function
 
+        The parameter list of func is compiled into a validator at this point,
+        so all custom types referenced by func must be registered before.
+
         Raises:
             ValueError: If a function of this name is already registered or unknown types are referenced in func
         """
@@ -693,8 +1071,59 @@ class RpcProcessor(object):
             if not param['type'] in self.custom_types_dict.keys():
                 raise ValueError("Unknown custom type: '%s'" % (param['type']))
 
+        validator = self.compile_validator(func)
+
         self.functions.append(func)
         self.functions_dict[func.name] = func
+        self.validators[func.name] = validator
+        self.invalidate_description_cache()
+
+    def invalidate_description_cache(self):
+        """
+        Discard the cached descriptions of this RPC service
+
+        The cache is invalidated automatically when functions or custom types
+        are added or the service description is changed. Call this method if
+        you change a registered function or custom type afterwards.
+        """
+        self.description_cache = None
+
+    def get_description_cache(self):
+        """
+        Get the preencoded descriptions of this RPC service
+
+        Returns:
+            dict: PreencodedJson objects for 'service', 'functions',
+                  'custom_types' and 'all' and the content hash in 'hash'
+        """
+        if self.description_cache is not None:
+            return self.description_cache
+
+        service = self.description
+        functions = [function.to_dict() for function in self.functions]
+        custom_types = [custom_type.to_dict() for custom_type in self.custom_types]
+
+        # hash a canonical encoding so it doesn't depend on the codec
+        canonical = json.dumps([service, functions, custom_types], sort_keys=True)
+        digest = hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+        cache = {'hash': digest}
+        cache['service'] = PreencodedJson(service, self.codec.dumps(service))
+        cache['functions'] = PreencodedJson(functions, self.codec.dumps(functions))
+        cache['custom_types'] = PreencodedJson(custom_types,
+                self.codec.dumps(custom_types))
+
+        value = {'hash': digest, 'changed': True, 'service': service,
+                'functions': functions, 'custom_types': custom_types}
+        data = b''.join((b'{"hash":', self.codec.dumps(digest),
+            b',"changed":true,"service":', cache['service'].data,
+            b',"functions":', cache['functions'].data,
+            b',"custom_types":', cache['custom_types'].data, b'}'))
+        cache['all'] = PreencodedJson(value, data)
+
+        self.description_cache = cache
+
+        return cache
 
     def describe_service(self):
         """
@@ -703,7 +1132,7 @@ class RpcProcessor(object):
         Returns:
             dict: Description of this service
         """
-        return self.description
+        return self.get_description_cache()['service'].value
 
     def describe_functions(self):
         """
@@ -712,7 +1141,7 @@ class RpcProcessor(object):
         Returns:
             list: Description of all functions registered to this RpcProcessor
         """
-        return [function.to_dict() for function in self.functions]
+        return self.get_description_cache()['functions'].value
 
     def describe_custom_types(self):
         """
@@ -721,186 +1150,1511 @@ class RpcProcessor(object):
         Returns:
             list: Description of all custom types registered to this RpcProcessor
         """
-        return [custom_type.to_dict() for custom_type in self.custom_types]
+        return self.get_description_cache()['custom_types'].value
 
-    def call_function(self, rpcfunction, rpcinfo, *params):
+    def describe_service_preencoded(self):
         """
-        Execute the actual function
+        Return the self-description of this RPC service as PreencodedJson
+        """
+        return self.get_description_cache()['service']
 
-        Params:
-            rpcfunction (RpcFunction): RPC function object representing a function
-            rpcinfo (dict): Additional information to pass to the function
+    def describe_functions_preencoded(self):
         """
-        if rpcfunction.requires_rpcinfo:
-            return rpcfunction.func(rpcinfo, *params)
+        Return the descriptions of all functions as PreencodedJson
+        """
+        return self.get_description_cache()['functions']
 
-        return rpcfunction.func(*params)
+    def describe_custom_types_preencoded(self):
+        """
+        Return the descriptions of all custom types as PreencodedJson
+        """
+        return self.get_description_cache()['custom_types']
 
-    def check_request_types(self, func, params):
+    def description_hash(self):
         """
-        Check the types of the parameters passed by a JSON-RPC call
+        Get a hash of the complete description of this RPC service
 
-        Args:
-            func (RpcFunction): Description of the called function
-            params (list): Parameters passed in the request
+        The hash changes whenever the service description, a function or a
+        custom type changes.
 
-        Raises:
-            JsonRpcTypeError: If a parameter type is invalid
-            JsonRpcParamTypeError: If a parameter type is invalid
+        Returns:
+            str: Hex encoded SHA-256 hash
         """
-        if len(params) != len(func.params):
-            raise JsonRpcParamError(func.name, len(func.params), len(params))
+        return self.get_description_cache()['hash']
 
-        i = 0
+    def describe_if_changed(self, known_hash):
+        """
+        Describe the whole RPC service unless the caller already knows it
 
-        for p in func.params:
-            value = params[i]
-            try:
-                self.check_param_type(func, p, value, '')
-            except InvalidEnumValueError as e:
-                raise JsonRpcTypeError("%s: '%s' is not a valid value for parameter '%s' of enum type '%s'"
-                        % (func.name, e.value, e.name, e.expected_type))
-            except InvalidEnumTypeError as e:
-                raise JsonRpcTypeError("%s: Enum parameter '%s' requires a value of type 'int' or 'string' but type was '%s'"
-                        % (func.name, e.name, e.real_type))
-            except InvalidNamedHashError as e:
-                raise JsonRpcTypeError("%s: Named hash parameter '%s' of type '%s' requires a hash value but got '%s'"
-                        % (func.name, e.name, e.expected_type, e.real_type))
-            except InvalidPrimitiveTypeError as e:
-                raise JsonRpcParamTypeError(func.name, e.name, e.expected_type, e.real_type)
+        Args:
+            known_hash (str): Hash the caller got from its last call or None
 
-            i += 1
+        Returns:
+            dict: Only 'hash' and 'changed' set to False if known_hash is the
+                  current hash, otherwise 'changed' is True and 'service',
+                  'functions' and 'custom_types' contain the descriptions
+        """
+        cache = self.get_description_cache()
+
+        if known_hash == cache['hash']:
+            return {'hash': cache['hash'], 'changed': False}
+
+        return cache['all']
 
-    def check_param_type(self, func, param, value, path):
+    def enable_metrics(self, latency_buckets=None):
         """
-        Check the type of a single parameter
+        Record call counts, error counts and latencies of all methods
+
+        Metrics are disabled by default since recording them costs time on
+        every request.
 
         Args:
-            value (any): Actual value that was passed by the caller
-            path (str): Path to the variable in nested structures
+            latency_buckets (tuple): Sorted upper bounds of the latency
+                                     histogram buckets in seconds (resets the
+                                     metrics) or None to keep the buckets
         """
-        real_type = type(value).__name__
-        name = param['name']
-        declared_type = param['type']
+        if latency_buckets is not None:
+            self.metrics = Metrics(tuple(latency_buckets))
 
-        if not path:
-            path = name
+        self.metrics_enabled = True
 
-        # workaround for Python 2.7
-        if real_type == 'unicode':
-            real_type = 'str'
+    def disable_metrics(self):
+        """
+        Stop recording metrics
+        """
+        self.metrics_enabled = False
 
-        # custom type?
-        if declared_type[0].isupper():
-            typeobj = self.custom_types_dict[declared_type]
+    def enable_phase_timing(self, hook=None):
+        """
+        Measure the time spent in each phase of processing a message
 
-            if type(typeobj).__name__ == 'JsonEnumType':
-                try:
-                    if not typeobj.validate(value):
-                        raise InvalidEnumValueError(path, declared_type, str(value))
-                except ValueError:
-                    raise InvalidEnumTypeError(path, self.py2json[real_type])
-            elif type(typeobj).__name__ == 'JsonHashType':
-                if self.py2json[real_type] != 'hash':
-                    raise InvalidNamedHashError(path, declared_type, self.py2json[real_type])
-
-                # validate named hashes if named has validation is enabled
-                if self.named_hash_validation and self.__is_named_hash_type(declared_type):
-                    self.check_named_hash(func, param, value, path)
-        # typed array?
-        elif declared_type.startswith('array<'):
-            if real_type != 'list':
-                raise InvalidPrimitiveTypeError(path, declared_type, self.py2json[real_type])
+        The phases are 'framing' (extracting the message from the received
+        data, measured by the servers), 'decode', 'envelope' (checks of the
+        request object), 'type_check', 'execution', 'error_handling' and
+        'encode'. The timings are aggregated by method (batches as
+        '[batch]', invalid requests as '[invalid]') and returned by the
+        builtin __describe_phase_timings. Only process_message is measured.
 
-            array_type = declared_type[len('array<'):-1]
-            i = 0
-            for v in value:
-                p = {'name': '[%d]' % (i), 'type': array_type}
-                self.check_param_type(func, p, v, path + p['name'])
-                i += 1
-        # primitive type?
-        elif real_type != self.json2py[declared_type]:
-            raise InvalidPrimitiveTypeError(path, declared_type, self.py2json[real_type])
+        Args:
+            hook (callable): Called with the method name and a dict with the
+                             seconds spent in each phase after every message
+        """
+        self.phase_timing_enabled = True
+        self.phase_timing_hook = hook
+
+    def disable_phase_timing(self):
+        """
+        Stop measuring phase timings
 
-    def check_named_hash(self, func, param, value, path):
+        This is the default since the measurements add some overhead.
         """
-        Check if a value for a named hash is valid
+        self.phase_timing_enabled = False
+        self.phase_timing_hook = None
+
+    def describe_phase_timings(self):
         """
-        named_hash = self.custom_types_dict[param['type']]
+        Describe the time spent in the phases of processing messages
 
-        name = param['name']
-        declared_type = param['type']
+        Returns:
+            dict: Number of messages and the total, mean (per message) and
+                  maximum seconds spent in each phase by method name
+        """
+        return self.phase_timings.to_dict()
 
-        if not path:
-            path = name
+    def mark_async_execution(self, reply, timing):
+        """
+        Make a Deferred or awaitable result end the execution phase when done
 
-        # check if a field is not defined in the named hash
-        for fieldname in value:
-            if fieldname not in named_hash.fieldnames:
-                raise JsonRpcTypeError("%s: Named hash parameter '%s' of type '%s': Unknown field '%s'" % (func.name, path, declared_type, fieldname))
+        Args:
+            reply (dict): Reply of a single request
+            timing (RequestTiming): Phase timings of the message
+        """
+        result = reply['result']
 
-        for fieldname in named_hash.fieldnames:
-            # check if all field names are present
-            if fieldname not in value:
-                raise JsonRpcTypeError("%s: Named hash parameter '%s' of type '%s': Missing field '%s'" % (func.name, path, declared_type, fieldname))
+        if is_deferred(result):
+            result.addBoth(timing.mark_callback, 'execution')
+        elif is_awaitable(result):
+            from reflectrpc.coroutines import mark_awaitable
+            reply['result'] = mark_awaitable(result, timing, 'execution')
 
-            self.check_param_type(func, named_hash.fields_dict[fieldname],
-                    value[fieldname], path + '.' + fieldname)
+    def finish_timing(self, timing):
+        """
+        Record the phase timings of a message once its reply is encoded
 
-    def process_request(self, message, rpcinfo = None):
+        Args:
+            timing (RequestTiming): Timings of the message
         """
-        Process a JSON-RPC request
+        method = timing.method
+        if method is None:
+            method = '[invalid]'
 
-        Validates the JSON-RPC request and executes the RPC function in case the
-        request is valid. Errors are reported to the user. Exceptions that are
-        not derived from JsonRpcError are reported as internal errors with no
-        further explanation for security reasons.
+        self.phase_timings.record(method, timing.phases)
 
-        Args:
-            message (str): The JSON-RPC request sent by the client
-            rpcinfo (dict): A dictionary used to pass additional information to
-                            the RPC function (e.g. authentication information)
+        if self.phase_timing_hook is not None:
+            self.phase_timing_hook(method, timing.phases)
+
+    def finish_deferred_timing(self, value, timing):
+        """
+        Callback or errback for Deferred replies that records phase timings
 
         Returns:
-            dict: JSON-RPC reply for the client
+            any: value
         """
-        reply = {}
-        request = {}
+        timing.mark('encode')
+        self.finish_timing(timing)
 
-        reply['result'] = None
-        # Notification requests expect no answer
-        notify_request = False
+        return value
 
-        if rpcinfo is None:
-            rpcinfo = {'authenticated': False, 'username': None}
+    def set_lag_monitor(self, lag_monitor):
+        """
+        Set the monitor that measures the lag of the server's event loop
 
-        try:
-            request = json.loads(message)
-        except ValueError:
-            reply['id'] = -1
-            error = JsonRpcInvalidRequest("Received invalid JSON")
-            reply['error'] = error.to_dict()
-            return reply
+        Servers call this when their lag monitor is enabled, so calls of RPC
+        methods can be attributed to the lag they cause.
 
-        if 'id' not in request.keys():
-            reply['id'] = -1
-            error = JsonRpcInvalidRequest("Field 'id' missing in request")
-            reply['error'] = error.to_dict()
-            return reply
+        Args:
+            lag_monitor (LagMonitor): Started lag monitor or None
+        """
+        self.lag_monitor = lag_monitor
 
-        if request['id'] is None:
-            notify_request = True
-        else:
-            reply['id'] = request['id']
+    def describe_event_loop_lag(self):
+        """
+        Describe how late the event loop of the server ran its timer
 
-        if 'method' not in request.keys():
-            error = JsonRpcInvalidRequest("Field 'method' missing in request")
-            reply['error'] = error.to_json()
-            return reply
+        Returns:
+            dict: Lag histogram, maximum lag, number of ticks over the
+                  threshold and the lag attributed to each method
 
-        if not isinstance(request['method'], str):
-            error = JsonRpcInvalidRequest("Field 'method' must contain a string value")
-            reply['error'] = error.to_dict()
+        Raises:
+            JsonRpcError: If the server doesn't monitor its event loop
+        """
+        if self.lag_monitor is None:
+            raise JsonRpcError("Event loop lag monitor is disabled")
+
+        return self.lag_monitor.to_dict()
+
+    def enable_slow_request_log(self, max_entries=20, threshold=1.0,
+            window=600.0, max_param_length=200):
+        """
+        Log the slowest recent requests and the requests over a threshold
+
+        The log is disabled by default. It can be read with the
+        privileged builtin __describe_slow_requests and cleared with
+        __clear_slow_requests. Entries contain the phases of the request if
+        phase timing is enabled.
+
+        Args:
+            max_entries (int): Number of slowest requests and number of
+                               requests over the threshold to keep
+            threshold (float): Requests that take longer than this number of
+                               seconds are always logged
+            window (float): Seconds after which a request no longer counts
+                            as one of the slowest requests or None
+            max_param_length (int): Maximum length of the JSON encoded
+                                    parameters in an entry
+        """
+        self.slow_requests = SlowRequestLog(max_entries, threshold, window,
+                max_param_length)
+
+    def disable_slow_request_log(self):
+        """
+        Stop logging slow requests
+        """
+        self.slow_requests = None
+
+    def describe_slow_requests(self):
+        """
+        Describe the slowest recent requests and the requests over the threshold
+
+        Returns:
+            dict: Threshold and time window of the log and the logged requests
+                  with method, truncated parameters, username, timestamps,
+                  duration, phases, error name and whether the result was a
+                  Deferred
+
+        Raises:
+            JsonRpcError: If the slow request log is disabled
+        """
+        if self.slow_requests is None:
+            raise JsonRpcError("Slow request log is disabled")
+
+        return self.slow_requests.to_dict()
+
+    def clear_slow_requests(self):
+        """
+        Remove all entries from the slow request log
+
+        Returns:
+            bool: True
+        """
+        if self.slow_requests is not None:
+            self.slow_requests.clear()
+
+        return True
+
+    def enable_in_flight_tracking(self):
+        """
+        Keep a table of the requests that are currently executing
+
+        The table is disabled by default. It can be read with the privileged
+        builtin __describe_in_flight_requests. Servers that support it put
+        the address of the client into the 'peer' field of rpcinfo.
+        """
+        if self.in_flight is None:
+            self.in_flight = InFlightRequests()
+
+    def disable_in_flight_tracking(self):
+        """
+        Stop keeping the table of requests that are currently executing
+        """
+        self.in_flight = None
+
+    def describe_in_flight_requests(self):
+        """
+        Describe the requests that are currently executing
+
+        Returns:
+            list: Id, method, peer, username, start time, elapsed seconds and
+                  whether it waits for a Deferred or an awaitable for each
+                  request, the longest running request first
+
+        Raises:
+            JsonRpcError: If in-flight tracking is disabled
+        """
+        if self.in_flight is None:
+            raise JsonRpcError("In-flight tracking is disabled")
+
+        return self.in_flight.to_list()
+
+    def track_in_flight(self, in_flight, request_id, reply):
+        """
+        Remove a request from the in-flight table once its result is available
+
+        Args:
+            in_flight (InFlightRequests): The in-flight table
+            request_id (int): Id of the request in the table
+            reply (dict|None|awaitable): Reply of the request
+
+        Returns:
+            dict|None|awaitable: The reply (awaitables are wrapped)
+        """
+        if reply is None:
+            in_flight.remove(request_id)
+            return reply
+
+        if type(reply) is not dict:
+            from reflectrpc.coroutines import track_awaitable
+            in_flight.set_waiting(request_id)
+            return track_awaitable(reply, in_flight, request_id)
+
+        result = reply['result']
+
+        if type(result) in plain_result_types:
+            in_flight.remove(request_id)
+        elif is_deferred(result):
+            in_flight.set_waiting(request_id)
+            result.addBoth(in_flight.remove_callback, request_id)
+        elif is_awaitable(result):
+            from reflectrpc.coroutines import track_awaitable
+            in_flight.set_waiting(request_id)
+            reply['result'] = track_awaitable(result, in_flight, request_id)
+        else:
+            in_flight.remove(request_id)
+
+        return reply
+
+    def set_privileged_users(self, usernames):
+        """
+        Set the users who are allowed to call privileged builtins
+
+        Privileged builtins (like the ones of the sampling profiler) can only
+        be called by authenticated users. Nobody is privileged by default.
+
+        Args:
+            usernames (list): Names of the privileged users
+        """
+        self.privileged_users = set(usernames)
+
+    def check_privileges(self, method, rpcinfo):
+        """
+        Make sure the caller of a privileged builtin is a privileged user
+
+        Args:
+            method (str): Name of the builtin
+            rpcinfo (dict): Information about the caller
+
+        Raises:
+            JsonRpcPermissionDenied: If the caller is not privileged
+        """
+        if rpcinfo and rpcinfo.get('authenticated') and \
+                rpcinfo.get('username') in self.privileged_users:
+            return
+
+        raise JsonRpcPermissionDenied("Only privileged users can call '%s'" % (method))
+
+    def start_profiler(self, seconds, rate=100):
+        """
+        Start the sampling profiler
+
+        The profiler samples the stacks of all threads of the server and stops
+        after the given time. Get the result with get_profile.
+
+        Args:
+            seconds (float): Number of seconds to sample (at most 600)
+            rate (int): Number of samples per second (1 to 1000)
+
+        Returns:
+            bool: True
+
+        Raises:
+            JsonRpcInvalidRequest: If the parameters are out of range or the
+                                   profiler is already running
+        """
+        if not isinstance(seconds, (int, float)) or not 0 < seconds <= 600:
+            raise JsonRpcInvalidRequest("Profiling time must be between 0 and 600 seconds")
+
+        if not isinstance(rate, int) or not 1 <= rate <= 1000:
+            raise JsonRpcInvalidRequest("Sampling rate must be between 1 and 1000 samples per second")
+
+        if self.sampling_profiler.is_running():
+            raise JsonRpcInvalidRequest("Profiler is already running")
+
+        # set before starting since a short run may stop immediately
+        self.profiler = self.sampling_profiler
+        self.sampling_profiler.start(seconds, rate, self.profiler_stopped)
+
+        return True
+
+    def stop_profiler(self):
+        """
+        Stop the sampling profiler before its time is up
+
+        Returns:
+            bool: True
+        """
+        self.sampling_profiler.stop()
+        self.profiler = None
+
+        return True
+
+    def profiler_stopped(self):
+        """
+        Called by the sampling profiler once it stopped
+        """
+        self.profiler = None
+
+    def get_profile(self, output_format='collapsed'):
+        """
+        Get the samples of the last (or the running) profiling run
+
+        Args:
+            output_format (str): 'collapsed' for collapsed stacks (one line
+                                 per stack, frames separated by semicolons,
+                                 starting with the RPC method) or 'pstats'
+                                 for a base64 encoded dump for pstats.Stats
+
+        Returns:
+            dict: Running state, number of samples, sampling interval and
+                  duration in seconds and the samples as 'data'
+
+        Raises:
+            JsonRpcInvalidRequest: If output_format is unknown
+        """
+        try:
+            return self.sampling_profiler.get_profile(output_format)
+        except ValueError as e:
+            raise JsonRpcInvalidRequest(str(e))
+
+    def start_memory_tracing(self, frames=1):
+        """
+        Start tracing memory allocations with tracemalloc
+
+        Tracing slows down the server and uses additional memory, so stop it
+        once you have taken the snapshots you need.
+
+        Args:
+            frames (int): Number of frames stored per allocation
+
+        Returns:
+            dict: Same as describe_memory_tracing
+
+        Raises:
+            JsonRpcInvalidRequest: If tracemalloc can't be started
+        """
+        try:
+            self.memory_tracer.start(frames)
+            return self.memory_tracer.get_status()
+        except (RuntimeError, ValueError) as e:
+            raise JsonRpcInvalidRequest(str(e))
+
+    def stop_memory_tracing(self):
+        """
+        Stop tracing memory allocations and drop all snapshots
+
+        Returns:
+            bool: True
+
+        Raises:
+            JsonRpcInvalidRequest: If tracemalloc is not available
+        """
+        try:
+            self.memory_tracer.stop()
+        except RuntimeError as e:
+            raise JsonRpcInvalidRequest(str(e))
+
+        return True
+
+    def describe_memory_tracing(self):
+        """
+        Describe the state of memory tracing
+
+        Returns:
+            dict: Whether allocations are traced, current and peak size of
+                  the traced memory in bytes and the names of the snapshots
+
+        Raises:
+            JsonRpcInvalidRequest: If tracemalloc is not available
+        """
+        try:
+            return self.memory_tracer.get_status()
+        except RuntimeError as e:
+            raise JsonRpcInvalidRequest(str(e))
+
+    def take_memory_snapshot(self, name):
+        """
+        Take a named snapshot of the traced memory allocations
+
+        Args:
+            name (str): Name of the snapshot (replaces an older one with the
+                        same name)
+
+        Returns:
+            dict: Same as describe_memory_tracing
+
+        Raises:
+            JsonRpcInvalidRequest: If memory allocations are not traced
+        """
+        try:
+            return self.memory_tracer.take_snapshot(name)
+        except (RuntimeError, ValueError) as e:
+            raise JsonRpcInvalidRequest(str(e))
+
+    def compare_memory_snapshots(self, old_name, new_name, limit=20, group_by='lineno'):
+        """
+        Get the allocation sites whose memory changed most between two snapshots
+
+        Args:
+            old_name (str): Name of the older snapshot
+            new_name (str): Name of the newer snapshot
+            limit (int): Maximum number of allocation sites to return
+            group_by (str): 'lineno' to group by file and line or 'filename'
+                            to group by file
+
+        Returns:
+            list: Allocation sites with 'file', 'line', 'size', 'size_diff',
+                  'count' and 'count_diff', biggest change first
+
+        Raises:
+            JsonRpcInvalidRequest: If a snapshot doesn't exist
+        """
+        try:
+            return self.memory_tracer.compare_snapshots(old_name, new_name,
+                    limit, group_by)
+        except (RuntimeError, ValueError) as e:
+            raise JsonRpcInvalidRequest(str(e))
+
+    def describe_metrics(self):
+        """
+        Describe the metrics of all methods that were called
+
+        Latencies are measured until the result is available, so for
+        Deferreds and awaitables they include the time until they are done.
+
+        Returns:
+            dict: Number of calls, number of errors by error name and latency
+                  histogram for each method
+        """
+        return self.metrics.to_dict()
+
+    def record_metrics(self, method, start, reply, request, rpcinfo, timing):
+        """
+        Record the metrics of a call and log it if it was slow once its result
+        is available
+
+        Args:
+            method (str): Name of the method
+            start (float): Time the execution started (see metrics.timer)
+            reply (dict|None|awaitable): Reply returned by dispatch_request
+            request (dict): Decoded JSON-RPC request
+            rpcinfo (dict): Information about the caller
+            timing (RequestTiming): Phase timings of the message or None
+
+        Returns:
+            dict|None|awaitable: The reply (awaitables are wrapped)
+        """
+        details = (request, rpcinfo, timing)
+
+        if reply is None:
+            self.record_call(method, start, None, details)
+            return reply
+
+        if type(reply) is not dict:
+            from reflectrpc.coroutines import measure_awaitable
+            return measure_awaitable(self, reply, method, start, details)
+
+        result = reply['result']
+
+        # fast path for results that are available right away
+        if type(result) in plain_result_types:
+            error = reply['error']
+            error_name = error['name'] if error is not None else None
+            seconds = timer() - start
+
+            if self.metrics_enabled:
+                self.metrics.record(method, seconds, error_name)
+
+            log = self.slow_requests
+            if log is not None and (seconds >= log.min_seconds or start >= log.next_expiry):
+                self.log_slow_request(method, start, seconds, error_name, details)
+        elif is_deferred(result):
+            result.addCallbacks(self.record_deferred_metrics,
+                    self.record_deferred_error_metrics,
+                    callbackArgs=(method, start, details),
+                    errbackArgs=(method, start, details))
+        elif is_awaitable(result):
+            from reflectrpc.coroutines import measure_awaitable
+            reply['result'] = measure_awaitable(self, result, method, start, details)
+        elif reply['error'] is not None:
+            self.record_call(method, start, reply['error']['name'], details)
+        else:
+            self.record_call(method, start, None, details)
+
+        return reply
+
+    def record_call(self, method, start, error_name, details, deferred=False):
+        """
+        Record the metrics of a call and log it if it was slow
+
+        Args:
+            method (str): Name of the method
+            start (float): Time the execution started (see metrics.timer)
+            error_name (str): Name of the error if the call failed
+            details (tuple): Request, rpcinfo and RequestTiming of the call
+            deferred (bool): True if the result was a Deferred
+        """
+        seconds = timer() - start
+
+        if self.metrics_enabled:
+            self.metrics.record(method, seconds, error_name)
+
+        log = self.slow_requests
+        if log is not None and (seconds >= log.min_seconds or start >= log.next_expiry):
+            self.log_slow_request(method, start, seconds, error_name, details,
+                    deferred)
+
+    def log_slow_request(self, method, start, seconds, error_name, details,
+            deferred=False):
+        """
+        Add a call to the slow request log
+
+        Args:
+            method (str): Name of the method
+            start (float): Time the execution started (see metrics.timer)
+            seconds (float): Time it took until the result was available
+            error_name (str): Name of the error if the call failed
+            details (tuple): Request, rpcinfo and RequestTiming of the call
+            deferred (bool): True if the result was a Deferred
+        """
+        log = self.slow_requests
+        if log is None:
+            return
+
+        request, rpcinfo, timing = details
+
+        username = None
+        if rpcinfo:
+            username = rpcinfo.get('username')
+
+        phases = None
+        if timing is not None:
+            phases = timing.phases
+
+        log.add(method, request['params'], username, start, seconds, phases,
+                deferred, error_name)
+
+    def record_deferred_metrics(self, value, method, start, details):
+        """
+        Callback for Deferred results that records the metrics of a call
+
+        Returns:
+            any: value
+        """
+        self.record_call(method, start, None, details, True)
+
+        return value
+
+    def record_deferred_error_metrics(self, failure, method, start, details):
+        """
+        Errback for Deferred results that records the metrics of a call
+
+        Returns:
+            Failure: failure
+        """
+        self.record_call(method, start, self.get_error_name(failure.value),
+                details, True)
+
+        return failure
+
+    def get_error_name(self, e):
+        """
+        Get the name of an error as it is sent to the client
+
+        Args:
+            e (Exception): Exception raised by an RPC function
+
+        Returns:
+            str: Name of the error
+        """
+        if isinstance(e, JsonRpcError):
+            return e.name
+
+        return 'InternalError'
+
+    def describe_result_caches(self):
+        """
+        Describe the result caches of all functions that have caching enabled
+
+        Returns:
+            dict: Number of entries, limits, hits, misses, evictions and
+                  expirations of each cache by function name
+        """
+        caches = {}
+
+        for func in self.functions:
+            if func.cache_enabled:
+                caches[func.name] = self.get_result_cache(func).stats()
+
+        return caches
+
+    def get_result_cache(self, rpcfunction):
+        """
+        Get the result cache of a function and create it on first use
+
+        Args:
+            rpcfunction (RpcFunction): Function with caching enabled
+
+        Returns:
+            LruCache: The cache
+        """
+        cache = self.result_caches.get(rpcfunction.name)
+
+        if cache is None:
+            cache = LruCache(rpcfunction.cache_max_entries, rpcfunction.cache_ttl)
+            self.result_caches[rpcfunction.name] = cache
+
+        return cache
+
+    def clear_result_caches(self):
+        """
+        Remove all cached results (e.g. after the data they are based on changed)
+        """
+        for cache in self.result_caches.values():
+            cache.clear()
+
+    def call_cached_function(self, rpcfunction, rpcinfo, params):
+        """
+        Get the result of a function from its cache or call it and cache the
+        result
+
+        Args:
+            rpcfunction (RpcFunction): Function with caching enabled
+            rpcinfo (dict): Additional information to pass to the function
+            params (list): Parameters of the call
+
+        Returns:
+            PreencodedJson: The result together with its encoding
+            Deferred|awaitable: Fires with the plain result if the function
+                                returned a Deferred or an awaitable
+        """
+        cache = self.get_result_cache(rpcfunction)
+
+        if rpcfunction.cache_per_user:
+            username = None
+            if rpcinfo is not None:
+                username = rpcinfo.get('username')
+
+            key = json.dumps([username, params], sort_keys=True)
+        else:
+            key = json.dumps(params, sort_keys=True)
+
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+        result = self.call_function(rpcfunction, rpcinfo, *params)
+
+        if is_deferred(result):
+            result.addCallback(self.store_cached_value, cache, key)
+            return result
+
+        if is_awaitable(result):
+            from reflectrpc.coroutines import cache_awaitable_result
+            return cache_awaitable_result(self, result, cache, key)
+
+        return self.store_cached_result(result, cache, key)
+
+    def store_cached_result(self, value, cache, key):
+        """
+        Encode the result of a function and put it into a cache
+
+        Results that can't be encoded are not cached.
+
+        Returns:
+            PreencodedJson|any: The encoded result or value if it can't be
+                                encoded
+        """
+        if isinstance(value, PreencodedJson):
+            result = value
+        else:
+            try:
+                result = PreencodedJson(value, self.codec.dumps(value))
+            except Exception:
+                return value
+
+        cache.put(key, result)
+
+        return result
+
+    def store_cached_value(self, value, cache, key):
+        """
+        Put the result of a function into a cache and return it unchanged
+
+        Used for results of Deferreds and awaitables, which are passed on to
+        callers that expect plain values.
+
+        Returns:
+            any: value
+        """
+        self.store_cached_result(value, cache, key)
+
+        return value
+
+    def call_function(self, rpcfunction, rpcinfo, *params):
+        """
+        Execute the actual function
+
+        Params:
+            rpcfunction (RpcFunction): RPC function object representing a function
+            rpcinfo (dict): Additional information to pass to the function
+        """
+        if rpcfunction.requires_rpcinfo:
+            params = (rpcinfo,) + params
+
+        if rpcfunction.process_pool is not None:
+            if rpcfunction.process_pool not in self.process_pools:
+                raise ValueError("Unknown process pool: %s" % (rpcfunction.process_pool))
+
+            return self.process_pools[rpcfunction.process_pool].apply(
+                    rpcfunction.func, params)
+
+        if rpcfunction.thread_pool is not None and self.executor is not None:
+            func = rpcfunction.func
+
+            if self.profiler is not None:
+                func = self.profiler.wrap(rpcfunction.name, func)
+
+            return self.executor.execute(rpcfunction.thread_pool, func, params)
+
+        return rpcfunction.func(*params)
+
+    def check_request_types(self, func, params):
+        """
+        Check the types of the parameters passed by a JSON-RPC call
+
+        Args:
+            func (RpcFunction): Description of the called function
+            params (list): Parameters passed in the request
+
+        Raises:
+            JsonRpcTypeError: If a parameter type is invalid
+            JsonRpcParamTypeError: If a parameter type is invalid
+        """
+        validator = self.validators.get(func.name)
+
+        if validator is None:
+            validator = self.compile_validator(func)
+
+        validator(params)
+
+    def compile_validator(self, func):
+        """
+        Compile the parameter list of a function into a validator
+
+        Args:
+            func (RpcFunction): Description of the function
+
+        Returns:
+            callable: Takes the list of parameters of a request and raises a
+                      JsonRpcError if they don't match the declaration of func
+
+        Raises:
+            ValueError: If a parameter references an unknown custom type
+        """
+        checks = [self.compile_type_check(p['type']) for p in func.params]
+        names = [p['name'] for p in func.params]
+        count = len(checks)
+
+        def validate(params):
+            if len(params) != count:
+                raise JsonRpcParamError(func.name, count, len(params))
+
+            i = 0
+            try:
+                while i < count:
+                    checks[i](params[i])
+                    i += 1
+            except validation_errors as e:
+                self.raise_validation_error(func, names[i] + e.name, e)
+
+        return validate
+
+    def raise_validation_error(self, func, path, e):
+        """
+        Translate an error of a compiled type check into a JsonRpcError
+
+        Args:
+            func (RpcFunction): Description of the called function
+            path (str): Path to the invalid value in the parameters
+            e (Exception): The error raised by the type check
+        """
+        if isinstance(e, InvalidEnumValueError):
+            raise JsonRpcTypeError("%s: '%s' is not a valid value for parameter '%s' of enum type '%s'"
+                    % (func.name, e.value, path, e.expected_type))
+        elif isinstance(e, InvalidEnumTypeError):
+            raise JsonRpcTypeError("%s: Enum parameter '%s' requires a value of type 'int' or 'string' but type was '%s'"
+                    % (func.name, path, e.real_type))
+        elif isinstance(e, InvalidNamedHashError):
+            raise JsonRpcTypeError("%s: Named hash parameter '%s' of type '%s' requires a hash value but got '%s'"
+                    % (func.name, path, e.expected_type, e.real_type))
+        elif isinstance(e, UnknownFieldError):
+            raise JsonRpcTypeError("%s: Named hash parameter '%s' of type '%s': Unknown field '%s'"
+                    % (func.name, path, e.expected_type, e.fieldname))
+        elif isinstance(e, MissingFieldError):
+            raise JsonRpcTypeError("%s: Named hash parameter '%s' of type '%s': Missing field '%s'"
+                    % (func.name, path, e.expected_type, e.fieldname))
+
+        raise JsonRpcParamTypeError(func.name, path, e.expected_type, e.real_type)
+
+    def compile_type_check(self, declared_type):
+        """
+        Compile a type declaration into a check for a single value
+
+        The check raises one of the validation errors (e.g.
+        InvalidPrimitiveTypeError) if the value does not match the declaration.
+        The attribute 'name' of the error holds the path of the invalid value
+        relative to the checked value. Checks are cached per declaration.
+
+        Args:
+            declared_type (str): Type declaration (e.g. 'int', 'array<int>', 'Address')
+
+        Returns:
+            callable: Takes a value and raises an error if it is invalid
+
+        Raises:
+            ValueError: If the declaration references an unknown custom type
+        """
+        if declared_type in self.type_validators:
+            return self.type_validators[declared_type]
+
+        # custom type?
+        if declared_type[0].isupper():
+            if declared_type not in self.custom_types_dict:
+                raise ValueError("Unknown custom type: '%s'" % (declared_type))
+
+            typeobj = self.custom_types_dict[declared_type]
+
+            if isinstance(typeobj, JsonEnumType):
+                check = self.compile_enum_check(typeobj)
+            else:
+                check = self.compile_named_hash_check(typeobj)
+        # typed array?
+        elif declared_type.startswith('array<'):
+            check = self.compile_typed_array_check(declared_type)
+        # primitive type
+        else:
+            types = py_types[declared_type]
+
+            def check(value):
+                if type(value) not in types:
+                    raise InvalidPrimitiveTypeError('', declared_type,
+                            json_type_name(value))
+
+        self.type_validators[declared_type] = check
+
+        return check
+
+    def compile_enum_check(self, typeobj):
+        """
+        Compile a check for a value of an enum type
+        """
+        declared_type = typeobj.name
+        int_type = py_types['int'][0]
+
+        def check(value):
+            value_type = type(value)
+
+            if value_type in string_types:
+                if value not in typeobj.values_dict:
+                    raise InvalidEnumValueError('', declared_type, str(value))
+            elif value_type is int_type:
+                if value < typeobj.startvalue or value >= typeobj.nextvalue:
+                    raise InvalidEnumValueError('', declared_type, str(value))
+            else:
+                raise InvalidEnumTypeError('', json_type_name(value))
+
+        return check
+
+    def compile_named_hash_check(self, typeobj):
+        """
+        Compile a check for a value of a named hash type
+
+        The checks of the fields are compiled again when fields are added to
+        the named hash later.
+        """
+        declared_type = typeobj.name
+        dict_type = py_types['hash'][0]
+        # field checks and the revision of typeobj they were compiled for
+        compiled = {'fields': [], 'revision': None}
+
+        def compile_fields():
+            compiled['fields'] = [(field['name'],
+                self.compile_type_check(field['type']))
+                for field in typeobj.fields]
+            compiled['revision'] = typeobj.revision
+
+        def check(value):
+            if type(value) is not dict_type:
+                raise InvalidNamedHashError('', declared_type,
+                        json_type_name(value))
+
+            if not self.named_hash_validation:
+                return
+
+            if compiled['revision'] != typeobj.revision:
+                compile_fields()
+
+            # check if a field is not defined in the named hash
+            for fieldname in value:
+                if fieldname not in typeobj.fields_dict:
+                    raise UnknownFieldError('', declared_type, fieldname)
+
+            for fieldname, field_check in compiled['fields']:
+                # check if all field names are present
+                if fieldname not in value:
+                    raise MissingFieldError('', declared_type, fieldname)
+
+                try:
+                    field_check(value[fieldname])
+                except validation_errors as e:
+                    e.name = '.' + fieldname + e.name
+                    raise
+
+        # register before compiling the fields to support recursive types
+        self.type_validators[declared_type] = check
+
+        try:
+            compile_fields()
+        except ValueError:
+            del self.type_validators[declared_type]
+            raise
+
+        return check
+
+    def compile_typed_array_check(self, declared_type):
+        """
+        Compile a check for a value of a typed array
+        """
+        array_type = declared_type[len('array<'):-1]
+        list_type = py_types['array'][0]
+
+        if array_type in py_types:
+            types = py_types[array_type]
+
+            def check(value):
+                if type(value) is not list_type:
+                    raise InvalidPrimitiveTypeError('', declared_type,
+                            json_type_name(value))
+
+                for v in value:
+                    if type(v) not in types:
+                        break
+                else:
+                    return
+
+                for i, v in enumerate(value):
+                    if type(v) not in types:
+                        raise InvalidPrimitiveTypeError('[%d]' % (i),
+                                array_type, json_type_name(v))
+
+            return check
+
+        element_check = self.compile_type_check(array_type)
+
+        def check(value):
+            if type(value) is not list_type:
+                raise InvalidPrimitiveTypeError('', declared_type,
+                        json_type_name(value))
+
+            i = 0
+            try:
+                for v in value:
+                    element_check(v)
+                    i += 1
+            except validation_errors as e:
+                e.name = '[%d]' % (i) + e.name
+                raise
+
+        return check
+
+    def process_request(self, message, rpcinfo = None):
+        """
+        Process a JSON-RPC request
+
+        Validates the JSON-RPC request and executes the RPC function in case the
+        request is valid. Errors are reported to the user. Exceptions that are
+        not derived from JsonRpcError are reported as internal errors with no
+        further explanation for security reasons.
+
+        A message can also contain a batch of requests in a JSON array. In
+        this case all requests are executed and the replies are returned in a
+        list. Notifications get no reply in the list.
+
+        Results of RPC functions that are Deferreds or awaitables (e.g. of
+        'async def' functions) are left in the reply for the caller to wait
+        for. A notification of such a function is returned as an awaitable
+        that has to be run. In a batch these awaitables are kept apart from
+        the replies in the attribute notifications of the returned
+        BatchReplies, if the batch has no replies at all a single awaitable
+        that runs all of them is returned. Use process_request_async to get
+        final results.
+
+        Args:
+            message (bytes|str): The JSON-RPC request sent by the client
+            rpcinfo (dict): A dictionary used to pass additional information to
+                            the RPC function (e.g. authentication information)
+
+        Returns:
+            dict: JSON-RPC reply for the client
+            BatchReplies: JSON-RPC replies in case of a batch request
+            None: If there is nothing to reply (notification requests)
+            awaitable: If there is nothing to reply but notifications of
+                       functions that returned awaitables have to be run
+        """
+        reply = self.process_request_preencoded(message, rpcinfo)
+
+        if isinstance(reply, list):
+            reply = self.split_notifications(reply)
+
+        return self.strip_preencoded(reply)
+
+    def split_notifications(self, replies):
+        """
+        Separate the awaitables of notifications from the replies of a batch
+
+        Args:
+            replies (list): Replies as returned by execute_batch
+
+        Returns:
+            BatchReplies: The replies with the awaitables of the notifications
+            awaitable: Runs all notifications if the batch has no replies
+        """
+        batch = BatchReplies()
+
+        for reply in replies:
+            if is_awaitable(reply):
+                batch.notifications.append(reply)
+            else:
+                batch.append(reply)
+
+        if not batch:
+            from reflectrpc.coroutines import await_notifications
+            return await_notifications(batch.notifications)
+
+        return batch
+
+    def process_request_async(self, message, rpcinfo = None):
+        """
+        Coroutine version of process_request
+
+        Works like process_request but waits for all results that are
+        Deferreds or awaitables (e.g. the results of 'async def' functions).
+        Can be driven by asyncio or by Twisted via ensureDeferred.
+
+        Args:
+            message (bytes|str): The JSON-RPC request sent by the client
+            rpcinfo (dict): A dictionary used to pass additional information to
+                            the RPC function (e.g. authentication information)
+
+        Returns:
+            coroutine: Returns the same as process_request but all results are
+                       final values
+        """
+        from reflectrpc.coroutines import process_request_async
+
+        return process_request_async(self, message, rpcinfo)
+
+    def process_message_async(self, data, rpcinfo = None):
+        """
+        Coroutine version of process_message
+
+        Args:
+            data (bytes|str): The JSON-RPC message sent by the client
+            rpcinfo (dict): A dictionary used to pass additional information to
+                            the RPC function (e.g. authentication information)
+
+        Returns:
+            coroutine: Returns the encoded reply or None for notifications
+        """
+        from reflectrpc.coroutines import process_message_async
+
+        return process_message_async(self, data, rpcinfo)
+
+    def strip_preencoded(self, reply):
+        """
+        Replace PreencodedJson results in a reply by their plain values
+
+        The values are decoded from the encoded data, so the caller gets its
+        own copy of results that are shared (e.g. by a result cache).
+
+        Args:
+            reply (dict|list|None): Reply or list of replies of a batch request
+
+        Returns:
+            dict|list|None: The modified reply
+        """
+        if isinstance(reply, list):
+            for r in reply:
+                if isinstance(r, dict) and isinstance(r['result'], PreencodedJson):
+                    r['result'] = self.codec.loads(r['result'].data)
+        elif isinstance(reply, dict) and isinstance(reply['result'], PreencodedJson):
+            reply['result'] = self.codec.loads(reply['result'].data)
+
+        return reply
+
+    def process_request_preencoded(self, message, rpcinfo, timing=None):
+        """
+        Process a JSON-RPC request but leave PreencodedJson results in the reply
+
+        Args:
+            message (bytes|str): The JSON-RPC request sent by the client
+            rpcinfo (dict): Additional information to pass to the RPC function
+            timing (RequestTiming): Phase timings of the message or None
+
+        Returns:
+            dict|list|None: Same as process_request
+        """
+        if rpcinfo is None:
+            rpcinfo = {'authenticated': False, 'username': None}
+
+        try:
+            request = self.codec.loads(message)
+        except ValueError:
+            error = JsonRpcInvalidRequest("Received invalid JSON")
+            return {'id': -1, 'result': None, 'error': error.to_dict()}
+        finally:
+            if timing is not None:
+                timing.mark('decode')
+
+        return self.execute_message(request, rpcinfo, timing)
+
+    def execute_message(self, request, rpcinfo, timing=None):
+        """
+        Execute a decoded JSON-RPC request or batch of requests
+
+        Args:
+            request (dict|list): The decoded JSON-RPC message
+            rpcinfo (dict): Additional information to pass to the RPC function
+            timing (RequestTiming): Phase timings of the message or None
+
+        Returns:
+            dict|list|None: Same as process_request
+        """
+        if isinstance(request, list):
+            if timing is not None:
+                timing.method = '[batch]'
+
+            return self.execute_batch(request, rpcinfo, timing)
+
+        return self.execute_request(request, rpcinfo, timing)
+
+    def process_message(self, data, rpcinfo = None, framing_time = None):
+        """
+        Process a JSON-RPC message and return the encoded reply
+
+        Works like process_request but takes the message as received from the
+        network and returns the reply ready to be sent back to the client.
+
+        Args:
+            data (bytes|str): The JSON-RPC message sent by the client
+            rpcinfo (dict): A dictionary used to pass additional information to
+                            the RPC function (e.g. authentication information)
+            framing_time (float): Seconds the server needed to extract the
+                                  message from the received data (only used
+                                  for phase timing)
+
+        Returns:
+            bytes: UTF-8 encoded JSON-RPC reply for the client
+            Deferred: Fires with the encoded reply if an RPC function returned
+                      a Deferred
+            awaitable: Returns the encoded reply (or None) if an RPC function
+                       returned an awaitable
+            None: If there is nothing to reply (notification requests)
+        """
+        if not self.phase_timing_enabled:
+            return self.encode_reply(self.process_request_preencoded(data, rpcinfo))
+
+        timing = RequestTiming(framing_time)
+        reply = self.process_request_preencoded(data, rpcinfo, timing)
+
+        return self.encode_timed_reply(reply, timing)
+
+    def process_decoded_message(self, request, rpcinfo=None, framing_time=None,
+            decode_time=None):
+        """
+        Process a JSON-RPC message that was already decoded and return the
+        encoded reply
+
+        Works like process_message for servers that decode large messages
+        themselves (e.g. incrementally while they arrive).
+
+        Args:
+            request (dict|list): The decoded JSON-RPC message
+            rpcinfo (dict): A dictionary used to pass additional information to
+                            the RPC function (e.g. authentication information)
+            framing_time (float): Seconds the server needed to extract the
+                                  message from the received data (only used
+                                  for phase timing)
+            decode_time (float): Seconds the server needed to decode the
+                                 message (only used for phase timing)
+
+        Returns:
+            bytes|Deferred|awaitable|None: Same as process_message
+        """
+        if rpcinfo is None:
+            rpcinfo = {'authenticated': False, 'username': None}
+
+        if not self.phase_timing_enabled:
+            return self.encode_reply(self.execute_message(request, rpcinfo))
+
+        timing = RequestTiming(framing_time)
+        if decode_time is not None:
+            timing.phases['decode'] = decode_time
+
+        reply = self.execute_message(request, rpcinfo, timing)
+
+        return self.encode_timed_reply(reply, timing)
+
+    def encode_timed_reply(self, reply, timing):
+        """
+        Encode a reply and record the phase timings of its message
+
+        Args:
+            reply (dict|list|None): Reply as returned by process_request
+            timing (RequestTiming): Phase timings of the message
+
+        Returns:
+            bytes|Deferred|awaitable|None: Same as process_message
+        """
+        # asynchronous results end the execution phase when they are done
+        if type(reply) is dict:
+            self.mark_async_execution(reply, timing)
+        elif type(reply) is list:
+            for item in reply:
+                self.mark_async_execution(item, timing)
+
+        encoded = self.encode_reply(reply)
+
+        if is_deferred(encoded):
+            encoded.addBoth(self.finish_deferred_timing, timing)
+        elif is_awaitable(encoded):
+            from reflectrpc.coroutines import finish_awaitable_timing
+            encoded = finish_awaitable_timing(self, encoded, timing)
+        else:
+            timing.mark('encode')
+            self.finish_timing(timing)
+
+        return encoded
+
+    def encode_reply(self, reply):
+        """
+        Encode a reply as returned by process_request
+
+        Successful replies are spliced from preencoded fragments and the
+        encoded result. Results that are Deferreds are encoded once they fire.
+
+        Args:
+            reply (dict|list|None): Reply or list of replies of a batch request
+
+        Returns:
+            bytes: UTF-8 encoded JSON-RPC reply
+            Deferred: Fires with the encoded reply if a result is a Deferred
+            None: If reply is None
+        """
+        if reply is None:
+            return None
+
+        if isinstance(reply, list):
+            return self.encode_batch_reply(reply)
+
+        # notification of a function that returned an awaitable
+        if is_awaitable(reply):
+            return reply
+
+        if is_deferred(reply['result']):
+            d = reply['result']
+            d.addCallbacks(self.encode_deferred_result, self.encode_deferred_error,
+                    callbackArgs=(reply,), errbackArgs=(reply,))
+            return d
+
+        if is_awaitable(reply['result']):
+            from reflectrpc.coroutines import encode_awaitable_reply
+            return encode_awaitable_reply(self, reply)
+
+        try:
+            if reply['error'] is None:
+                result = reply['result']
+
+                if isinstance(result, PreencodedJson):
+                    data = result.data
+                else:
+                    data = self.codec.dumps(result)
+
+                return b''.join((b'{"id":', self.codec.dumps(reply['id']),
+                    b',"error":null,"result":', data, b'}'))
+
+            return self.codec.dumps(reply)
+        except Exception as e:
+            return self.codec.dumps(self.handle_error(e, reply))
+
+    def encode_batch_reply(self, replies):
+        """
+        Encode the replies of a batch request as a JSON array
+
+        Args:
+            replies (list): Replies of a batch request
+
+        Returns:
+            bytes: UTF-8 encoded JSON array of the replies
+            Deferred: Fires with the encoded array once all Deferred results
+                      have fired
+        """
+        encoded = [self.encode_reply(r) for r in replies]
+
+        if any(is_awaitable(e) for e in encoded):
+            from reflectrpc.coroutines import encode_awaitable_batch
+            return encode_awaitable_batch(encoded)
+
+        deferreds = [e for e in encoded if is_deferred(e)]
+
+        if not deferreds:
+            return b'[' + b','.join(encoded) + b']'
+
+        # run all Deferreds concurrently and reply once the last one fired
+        defer = sys.modules['twisted.internet.defer']
+        pending = [e if is_deferred(e) else defer.succeed(e) for e in encoded]
+
+        d = defer.gatherResults(pending)
+        d.addCallback(lambda results: b'[' + b','.join(results) + b']')
+
+        return d
+
+    def encode_deferred_result(self, value, reply):
+        reply['result'] = value
+        return self.encode_reply(reply)
+
+    def encode_deferred_error(self, failure, reply):
+        return self.encode_reply(self.handle_error(failure.value, reply))
+
+    def execute_batch(self, requests, rpcinfo, timing=None):
+        """
+        Execute a batch of decoded JSON-RPC requests
+
+        All requests are executed one after another. Results that are
+        Deferreds are left in the replies so their RPC functions can run
+        concurrently.
+
+        Args:
+            requests (list): Decoded JSON-RPC requests
+            rpcinfo (dict): Additional information to pass to the RPC functions
+            timing (RequestTiming): Phase timings of the message or None
+
+        Returns:
+            list: JSON-RPC replies in the order of the requests
+            None: If the batch only contained notification requests
+        """
+        if not requests:
+            error = JsonRpcInvalidRequest("Received empty batch")
+            return {'id': -1, 'result': None, 'error': error.to_dict()}
+
+        replies = []
+
+        for request in requests:
+            reply = self.execute_request(request, rpcinfo, timing)
+
+            if reply is not None:
+                replies.append(reply)
+
+        if not replies:
+            return None
+
+        return replies
+
+    def execute_request(self, request, rpcinfo, timing=None):
+        """
+        Execute a single decoded JSON-RPC request
+
+        Args:
+            request (dict): Decoded JSON-RPC request
+            rpcinfo (dict): Additional information to pass to the RPC function
+            timing (RequestTiming): Phase timings of the message or None
+
+        Returns:
+            dict: JSON-RPC reply for the client
+            None: If request is a notification request
+            awaitable: If request is a notification request and the RPC
+                       function returned an awaitable that has to be run
+        """
+        reply = {}
+
+        reply['result'] = None
+        # Notification requests expect no answer
+        notify_request = False
+
+        if not isinstance(request, dict):
+            reply['id'] = -1
+            error = JsonRpcInvalidRequest("Request must be a JSON object")
+            reply['error'] = error.to_dict()
+            return reply
+
+        if 'id' not in request.keys():
+            reply['id'] = -1
+            error = JsonRpcInvalidRequest("Field 'id' missing in request")
+            reply['error'] = error.to_dict()
+            return reply
+
+        if request['id'] is None:
+            notify_request = True
+        else:
+            reply['id'] = request['id']
+
+        if 'method' not in request.keys():
+            error = JsonRpcInvalidRequest("Field 'method' missing in request")
+            reply['error'] = error.to_dict()
+            return reply
+
+        if not isinstance(request['method'], str):
+            error = JsonRpcInvalidRequest("Field 'method' must contain a string value")
+            reply['error'] = error.to_dict()
             return reply
 
         if 'params' not in request.keys():
@@ -913,28 +2667,156 @@ class RpcProcessor(object):
             reply['error'] = error.to_dict()
             return reply
 
+        method = request['method']
+
+        if method not in self.builtins and method not in self.functions_dict:
+            error = JsonRpcInvalidRequest("No such method: %s. Call '__describe_functions' to get details on available function calls" % (method))
+            reply['error'] = error.to_dict()
+            return reply
+
+        if timing is not None:
+            if timing.method is None:
+                timing.method = method
+
+            timing.mark('envelope')
+
+        in_flight = self.in_flight
+        if in_flight is None:
+            return self.run_request(method, request, reply, notify_request,
+                    rpcinfo, timing)
+
+        request_id = in_flight.add(method, rpcinfo)
+
+        try:
+            reply = self.run_request(method, request, reply, notify_request,
+                    rpcinfo, timing)
+        except:
+            in_flight.remove(request_id)
+            raise
+
+        return self.track_in_flight(in_flight, request_id, reply)
+
+    def run_request(self, method, request, reply, notify_request, rpcinfo, timing=None):
+        """
+        Dispatch a request that passed all checks and measure it
+
+        Args:
+            method (str): Name of the method
+            request (dict): Decoded JSON-RPC request
+            reply (dict): Reply prepared by execute_request
+            notify_request (bool): True if the request is a notification
+            rpcinfo (dict): Additional information to pass to the RPC function
+            timing (RequestTiming): Phase timings of the message or None
+
+        Returns:
+            dict|None|awaitable: Same as execute_request
+        """
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.enter_method(method)
+
+        lag_monitor = self.lag_monitor
+        if lag_monitor is not None:
+            lag_monitor.enter_method(method)
+
+        try:
+            if not self.metrics_enabled and self.slow_requests is None:
+                return self.dispatch_request(request, reply, notify_request, rpcinfo, timing)
+
+            start = timer()
+            reply = self.dispatch_request(request, reply, notify_request, rpcinfo, timing)
+
+            return self.record_metrics(method, start, reply, request, rpcinfo, timing)
+        finally:
+            if profiler is not None:
+                profiler.exit_method()
+
+            if lag_monitor is not None:
+                lag_monitor.exit_method()
+
+    def check_builtin_params(self, method, params):
+        """
+        Check the number of parameters passed to a builtin
+
+        Args:
+            method (str): Name of the builtin
+            params (list): Parameters passed in the request
+
+        Raises:
+            JsonRpcParamError: If the builtin takes fewer or more parameters
+        """
+        counts = self.builtin_param_counts.get(method)
+
+        if counts is None:
+            getargspec = getattr(inspect, 'getfullargspec', None) or \
+                    inspect.getargspec
+            spec = getargspec(self.builtins[method])
+
+            max_count = len(spec.args)
+            if inspect.ismethod(self.builtins[method]):
+                max_count -= 1
+
+            counts = (max_count - len(spec.defaults or ()), max_count)
+            self.builtin_param_counts[method] = counts
+
+        if len(params) < counts[0]:
+            raise JsonRpcParamError(method, counts[0], len(params))
+
+        if len(params) > counts[1]:
+            raise JsonRpcParamError(method, counts[1], len(params))
+
+    def dispatch_request(self, request, reply, notify_request, rpcinfo, timing=None):
+        """
+        Call the builtin or RPC function of a request that passed all checks
+
+        Args:
+            request (dict): Decoded JSON-RPC request
+            reply (dict): Prepared reply
+            notify_request (bool): True if request is a notification request
+            rpcinfo (dict): Additional information to pass to the RPC function
+            timing (RequestTiming): Phase timings of the message or None
+
+        Returns:
+            dict|None|awaitable: Same as execute_request
+        """
         # check for builtins
         if request['method'] in self.builtins:
-            reply['error'] = None
-            reply['result'] = self.builtins[request['method']]()
-            return reply
+            try:
+                reply['error'] = None
+
+                if request['method'] in self.privileged_builtins:
+                    self.check_privileges(request['method'], rpcinfo)
+
+                self.check_builtin_params(request['method'], request['params'])
+                reply['result'] = self.builtins[request['method']](*request['params'])
+            except Exception as e:
+                reply = self.handle_timed_error(e, reply, timing, 'execution')
+            else:
+                if timing is not None:
+                    timing.mark('execution')
+
+            if notify_request:
+                return None
 
-        if not request['method'] in self.functions_dict:
-            error = JsonRpcInvalidRequest("No such method: %s. Call '__describe_functions' to get details on available function calls" % (request['method']))
-            reply['error'] = error.to_dict()
             return reply
 
         try:
             reply['error'] = None
             func_desc = self.functions_dict[request['method']]
             func = func_desc.func
+            phase = 'type_check'
 
             try:
                 if notify_request:
                     try:
                         if func_desc.type_checks_enabled:
                             self.check_request_types(func_desc, request['params'])
-                        self.call_function(func_desc, rpcinfo, *request['params'])
+                        result = self.call_function(func_desc, rpcinfo, *request['params'])
+
+                        # the awaitable has to be run by the caller
+                        if is_awaitable(result):
+                            from reflectrpc.coroutines import await_notification
+                            return await_notification(result)
                     except Exception as e:
                         traceback.print_exc()
 
@@ -943,6 +2825,10 @@ class RpcProcessor(object):
                 if func_desc.type_checks_enabled:
                     self.check_request_types(func_desc, request['params'])
 
+                if timing is not None:
+                    timing.mark('type_check')
+                phase = 'execution'
+
                 if notify_request:
                     try:
                         self.call_function(func_desc, rpcinfo, *request['params'])
@@ -951,9 +2837,17 @@ class RpcProcessor(object):
 
                     return None
 
-                reply['result'] = self.call_function(func_desc, rpcinfo, *request['params'])
+                if func_desc.cache_enabled:
+                    reply['result'] = self.call_cached_function(func_desc, rpcinfo, request['params'])
+                else:
+                    reply['result'] = self.call_function(func_desc, rpcinfo, *request['params'])
+
+                # asynchronous results add the rest of their execution time
+                # when they are done
+                if timing is not None:
+                    timing.mark('execution')
             except Exception as e:
-                reply = self.handle_error(e, reply)
+                reply = self.handle_timed_error(e, reply, timing, phase)
 
             return reply
         except Exception as e:
@@ -962,6 +2856,28 @@ class RpcProcessor(object):
             reply['error'] = error.to_dict()
             return reply
 
+    def handle_timed_error(self, e, reply, timing, phase):
+        """
+        Call handle_error and measure the time it takes if timing is enabled
+
+        Args:
+            e (Exception): The exception caught when executing an RPC function
+            reply (dict): The reply dict to rewrite
+            timing (RequestTiming): Phase timings of the message or None
+            phase (str): The phase that raised the exception
+
+        Returns:
+            dict: Same as handle_error
+        """
+        if timing is None:
+            return self.handle_error(e, reply)
+
+        timing.mark(phase)
+        reply = self.handle_error(e, reply)
+        timing.mark('error_handling')
+
+        return reply
+
     def handle_error(self, e, reply):
         """
         Rewrite a reply dict for an exception caught during RPC function execution
@@ -986,24 +2902,6 @@ class RpcProcessor(object):
 
         return reply
 
-    def __is_named_hash_type(self, typename):
-        """
-        Check if a typename references a Named Hash
-
-        Args:
-            typename (str): Name of the type to check
-
-        Returns:
-            bool: True if it is a Named Hash, False otherwise
-        """
-        if typename[0].isupper():
-            typeobj = self.custom_types_dict[typename]
-
-            if type(typeobj).__name__ == 'JsonHashType':
-                return True
-
-        return False
-
     def __is_enum_type(self, typename):
         """
         Check if a typename references an Enum
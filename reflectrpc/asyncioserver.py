@@ -0,0 +1,649 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import asyncio
+import base64
+import os
+import ssl
+import sys
+
+import reflectrpc.server
+from reflectrpc import is_awaitable, is_deferred
+from reflectrpc import JsonRpcInternalError
+
+# maximum size of the header of a HTTP request
+max_http_header_size = 65536
+
+# maximum size of the body of a HTTP request
+max_http_body_size = 16 * 1024 * 1024
+
+http_reasons = {
+        200: 'OK',
+        204: 'No Content',
+        400: 'Bad Request',
+        401: 'Unauthorized',
+        404: 'Not Found',
+        405: 'Method Not Allowed',
+        411: 'Length Required',
+        413: 'Payload Too Large',
+        431: 'Request Header Fields Too Large',
+        500: 'Internal Server Error'
+}
+
+def new_event_loop():
+    """
+    Create an event loop, based on uvloop if it is installed
+
+    Returns:
+        AbstractEventLoop: New event loop
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.new_event_loop()
+
+    return uvloop.new_event_loop()
+
+def get_common_name(transport):
+    """
+    Get the common name of the certificate the client authenticated with
+
+    Args:
+        transport (Transport): TLS transport of the connection
+
+    Returns:
+        str: Common name of the client certificate or None
+    """
+    peercert = transport.get_extra_info('peercert')
+    if not peercert:
+        return None
+
+    for rdn in peercert.get('subject', ()):
+        for key, value in rdn:
+            if key == 'commonName':
+                return value
+
+    return None
+
+def create_rpcinfo(transport, tls_client_auth_enabled):
+    """
+    Create the rpcinfo of a new connection
+
+    Args:
+        transport (Transport): Transport of the connection
+        tls_client_auth_enabled (bool): True if clients authenticate with
+                                        certificates
+
+    Returns:
+        dict: rpcinfo with the peer address and the user authenticated by
+              the client certificate
+    """
+    rpcinfo = {'authenticated': False, 'username': None, 'peer': None}
+
+    peer = transport.get_extra_info('peername')
+    if peer:
+        rpcinfo['peer'] = reflectrpc.server.format_address(peer)
+    else:
+        rpcinfo['peer'] = transport.get_extra_info('sockname') or 'unix'
+
+    if tls_client_auth_enabled:
+        username = get_common_name(transport)
+
+        if username is not None:
+            rpcinfo['authenticated'] = True
+            rpcinfo['username'] = username
+
+    return rpcinfo
+
+def get_task_reply(task, rpcprocessor):
+    """
+    Get the encoded reply computed by a finished task
+
+    The awaitables returned by the RpcProcessor handle errors of RPC
+    functions themselves, so an exception here is a bug or the task was
+    cancelled. The client gets an InternalError reply in that case instead of
+    waiting forever.
+
+    Args:
+        task (Task): Finished task
+        rpcprocessor (RpcProcessor): Processor that encodes the error reply
+
+    Returns:
+        bytes: UTF-8 encoded JSON-RPC reply or None for notifications
+    """
+    try:
+        return task.result()
+    except (asyncio.CancelledError, Exception) as e:
+        print("Computing a reply failed: %r" % (e))
+
+        error = JsonRpcInternalError("Internal error")
+        return rpcprocessor.encode_reply({'id': -1, 'result': None,
+            'error': error.to_dict()})
+
+class JsonRpcServer(reflectrpc.server.AbstractJsonRpcServer):
+    """
+    asyncio implementation of AbstractJsonRpcServer
+
+    Coroutines returned by RPC functions are run as tasks on the event loop so
+    a slow call doesn't block other requests of the same connection.
+    """
+    def send_data(self, data):
+        self.conn.write(data)
+
+    def send_data_sequence(self, chunks):
+        self.conn.writelines(chunks)
+
+    def run_awaitable(self, reply):
+        task = asyncio.get_running_loop().create_task(reply)
+        task.add_done_callback(self.send_task_result)
+
+    def send_task_result(self, task):
+        if self.conn.is_closing():
+            return
+
+        self.send_reply(get_task_reply(task, self.rpcprocessor))
+
+class JsonRpcProtocol(asyncio.Protocol):
+    """
+    asyncio protocol adapter
+    """
+    def __init__(self, rpcprocessor, tls_client_auth_enabled=False,
+            max_line_length=reflectrpc.server.default_max_line_length,
+            flush_threshold=reflectrpc.server.default_flush_threshold):
+        self.rpcprocessor = rpcprocessor
+        self.tls_client_auth_enabled = tls_client_auth_enabled
+        self.max_line_length = max_line_length
+        self.flush_threshold = flush_threshold
+        self.server = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+        rpcinfo = create_rpcinfo(transport, self.tls_client_auth_enabled)
+        self.server = JsonRpcServer(self.rpcprocessor, transport, rpcinfo,
+                self.max_line_length, self.flush_threshold)
+
+    def data_received(self, data):
+        try:
+            self.server.data_received(data)
+        except reflectrpc.server.LineTooLongError as e:
+            print(e)
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        self.server.connection_lost()
+
+class HttpRequest(object):
+    """
+    A parsed HTTP request
+    """
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    def keep_alive(self):
+        """
+        Check if the client wants to keep the connection open
+
+        Returns:
+            bool: True if the connection is kept open after the response
+        """
+        connection = self.headers.get('connection', '').lower()
+
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+
+        return connection != 'close'
+
+class JsonRpcHttpProtocol(asyncio.Protocol):
+    """
+    Serves JSON-RPC requests sent as HTTP POST requests to '/rpc'
+
+    Requests of a connection are answered in order. While the reply of a
+    request is computed by a coroutine the following requests are buffered.
+    """
+    def __init__(self, rpcprocessor, tls_client_auth_enabled=False,
+            check_password=None):
+        """
+        Constructor
+
+        Args:
+            rpcprocessor (RpcProcessor): RPC implementation
+            tls_client_auth_enabled (bool): True if clients authenticate with
+                                            certificates
+            check_password (callable): Checks username and password of HTTP
+                                       Basic Auth or None to disable it
+        """
+        self.rpcprocessor = rpcprocessor
+        self.tls_client_auth_enabled = tls_client_auth_enabled
+        self.check_password = check_password
+
+        self.transport = None
+        self.rpcinfo = None
+        self.buf = bytearray()
+        self.busy = False
+        self.paused = False
+        self.closing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.rpcinfo = create_rpcinfo(transport, self.tls_client_auth_enabled)
+
+    def connection_lost(self, exc):
+        self.closing = True
+        self.buf = bytearray()
+
+    def data_received(self, data):
+        if self.closing:
+            return
+
+        self.buf += data
+
+        # the next request is only parsed once the current one is answered,
+        # stop reading when it can't be a valid request anymore
+        if self.busy and len(self.buf) > max_http_header_size + max_http_body_size:
+            if not self.paused:
+                self.paused = True
+                self.transport.pause_reading()
+
+            return
+
+        self.process_buffer()
+
+    def process_buffer(self):
+        """
+        Handle all complete requests in the buffer
+        """
+        while not self.busy and not self.closing:
+            request = self.parse_request()
+            if request is None:
+                return
+
+            self.handle_request(request)
+
+    def parse_request(self):
+        """
+        Take the next complete request from the buffer
+
+        Returns:
+            HttpRequest: The request or None if it is incomplete or invalid
+                         (in which case an error was sent)
+        """
+        end = self.buf.find(b'\r\n\r\n')
+        if end < 0:
+            if len(self.buf) > max_http_header_size:
+                self.send_error(431)
+
+            return None
+
+        try:
+            lines = bytes(self.buf[:end]).decode('iso-8859-1').split('\r\n')
+            method, path, version = lines[0].split(' ')
+        except ValueError:
+            self.send_error(400)
+            return None
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+
+            if not sep:
+                self.send_error(400)
+                return None
+
+            headers[name.strip().lower()] = value.strip()
+
+        if 'transfer-encoding' in headers:
+            self.send_error(411)
+            return None
+
+        try:
+            length = int(headers.get('content-length', '0'))
+        except ValueError:
+            self.send_error(400)
+            return None
+
+        if length < 0:
+            self.send_error(400)
+            return None
+
+        if length > max_http_body_size:
+            self.send_error(413)
+            return None
+
+        if len(self.buf) < end + 4 + length:
+            return None
+
+        body = bytes(self.buf[end + 4:end + 4 + length])
+        del self.buf[:end + 4 + length]
+
+        return HttpRequest(method, path, version, headers, body)
+
+    def handle_request(self, request):
+        """
+        Process a request and send the response
+        """
+        keep_alive = request.keep_alive()
+
+        if request.path != '/rpc':
+            self.send_response(404, None, keep_alive)
+            return
+
+        if request.method != 'POST':
+            self.send_response(405, None, keep_alive, [('Allow', 'POST')])
+            return
+
+        rpcinfo = self.rpcinfo
+        if self.check_password is not None:
+            rpcinfo = self.authenticate(request)
+
+            if rpcinfo is None:
+                self.send_response(401, None, keep_alive,
+                        [('WWW-Authenticate', 'Basic realm="Reflect RPC"')])
+                return
+
+        reply = self.rpcprocessor.process_message(request.body, rpcinfo)
+
+        if is_deferred(reply) or is_awaitable(reply):
+            self.busy = True
+
+            from reflectrpc.coroutines import wait
+            task = asyncio.get_running_loop().create_task(wait(reply))
+            task.add_done_callback(lambda t: self.send_task_reply(t, keep_alive))
+            return
+
+        self.send_reply(reply, keep_alive)
+
+    def authenticate(self, request):
+        """
+        Check the HTTP Basic Auth credentials of a request
+
+        Returns:
+            dict: rpcinfo with the authenticated user or None if the
+                  credentials are missing or invalid
+        """
+        scheme, sep, token = request.headers.get('authorization', '').partition(' ')
+        if scheme.lower() != 'basic':
+            return None
+
+        try:
+            credentials = base64.b64decode(token.strip()).decode('utf-8')
+        except ValueError:
+            return None
+
+        username, sep, password = credentials.partition(':')
+        if not sep or not self.check_password(username, password):
+            return None
+
+        rpcinfo = dict(self.rpcinfo)
+        rpcinfo['authenticated'] = True
+        rpcinfo['username'] = username
+
+        return rpcinfo
+
+    def send_task_reply(self, task, keep_alive):
+        """
+        Send the reply computed by a task and continue with the next request
+        """
+        self.busy = False
+
+        if self.closing:
+            return
+
+        self.send_reply(get_task_reply(task, self.rpcprocessor), keep_alive)
+
+        if self.paused:
+            self.paused = False
+            self.transport.resume_reading()
+
+        self.process_buffer()
+
+    def send_reply(self, reply, keep_alive):
+        """
+        Send an encoded JSON-RPC reply (None for notifications)
+        """
+        if reply is None:
+            self.send_response(204, None, keep_alive)
+        else:
+            self.send_response(200, reply, keep_alive,
+                    [('Content-Type', 'application/json-rpc')])
+
+    def send_error(self, status):
+        """
+        Send an error response and close the connection
+        """
+        self.send_response(status, None, False)
+
+    def send_response(self, status, body, keep_alive, headers=()):
+        """
+        Send a HTTP response
+
+        Args:
+            status (int): HTTP status code
+            body (bytes): Body of the response or None
+            keep_alive (bool): False to close the connection afterwards
+            headers (list): Additional (name, value) pairs
+        """
+        if self.closing:
+            return
+
+        if body is None:
+            body = b''
+
+        lines = ['HTTP/1.1 %d %s' % (status, http_reasons[status])]
+        lines.extend('%s: %s' % (name, value) for name, value in headers)
+
+        if status != 204:
+            lines.append('Content-Length: %d' % (len(body)))
+
+        if not keep_alive:
+            lines.append('Connection: close')
+
+        header = ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1')
+        self.transport.write(header + body)
+
+        if not keep_alive:
+            self.closing = True
+            self.transport.close()
+
+class AsyncioJsonRpcServer(object):
+    """
+    JSON-RPC server based on asyncio
+
+    Serves line-terminated messages or HTTP over TCP or UNIX Domain Sockets,
+    optionally with TLS. RPC functions can be coroutine functions ('async
+    def') and are executed concurrently. If uvloop is installed it is used
+    as event loop.
+    """
+    def __init__(self, rpcprocessor, host, port):
+        """
+        Constructor
+
+        Args:
+            rpcprocessor (RpcProcessor): RPC implementation
+            host (str): Hostname, IP or UNIX domain socket to listen on. A UNIX
+                        Domain Socket might look like this: unix:///tmp/my.sock
+            port (int): TCP port to listen on (if host is a UNIX Domain Socket
+                        this value is ignored)
+        """
+        self.rpcprocessor = rpcprocessor
+        self.host = host
+        self.port = port
+
+        self.tls_enabled = False
+        self.tls_client_auth_enabled = False
+        self.ssl_context = None
+        self.http_enabled = False
+        self.http_basic_auth_enabled = False
+        self.passwdCheckFunction = None
+
+        self.unix_socket_backlog = 50
+        self.unix_socket_mode = 438
+        self.max_line_length = reflectrpc.server.default_max_line_length
+        self.flush_threshold = reflectrpc.server.default_flush_threshold
+
+    def enable_tls(self, pem_file):
+        """
+        Enable TLS authentication and encryption for this server
+
+        Args:
+            pem_file (str): Path of a PEM file containing server cert and key
+        """
+        self.tls_enabled = True
+
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(pem_file)
+
+    def enable_client_auth(self, ca_file):
+        """
+        Enable TLS client authentication
+
+        The client needs to present a certificate that validates against our CA
+        to be authenticated. Call enable_tls first.
+
+        Args:
+            ca_file (str): Path of a PEM file containing a CA cert to validate the client certs against
+        """
+        self.tls_client_auth_enabled = True
+
+        self.ssl_context.verify_mode = ssl.CERT_REQUIRED
+        self.ssl_context.load_verify_locations(ca_file)
+
+    def enable_http(self):
+        """
+        Enables HTTP as transport protocol
+
+        JSON-RPC requests are to be sent to '/rpc' as HTTP POST requests with
+        content type 'application/json-rpc'. The server sends the reply in
+        the response body.
+        """
+        self.http_enabled = True
+
+    def enable_http_basic_auth(self, passwdCheckFunction):
+        """
+        Enables HTTP Basic Auth
+
+        Args:
+            passwdCheckFunction (callable): Takes a username and a password as
+                                            argument and checks if they are
+                                            valid
+        """
+        self.http_basic_auth_enabled = True
+        self.passwdCheckFunction = passwdCheckFunction
+
+    def set_unix_socket_backlog(self, backlog):
+        """
+        Sets the number of client connections accepted in case we listen on a
+        UNIX Domain Socket
+
+        Args:
+            backlog (int): Number of client connections allowed
+        """
+        self.unix_socket_backlog = backlog
+
+    def set_unix_socket_mode(self, mode):
+        """
+        Sets the file permission mode used in case we listen on a UNIX Domain
+        Socket
+
+        Args:
+            mode (int): UNIX file permission mode to protect the Domain Socket
+        """
+        self.unix_socket_mode = mode
+
+    def set_max_line_length(self, length):
+        """
+        Sets the maximum length of a line-terminated message, clients that
+        send longer messages get an error reply and are disconnected (HTTP
+        request bodies are limited by max_http_body_size)
+
+        Args:
+            length (int): Maximum message length in bytes or None for no limit
+        """
+        self.max_line_length = length
+
+    def set_flush_threshold(self, size):
+        """
+        Sets how many bytes of replies to pipelined requests are collected
+        before they are sent together
+
+        Args:
+            size (int): Number of bytes or None to send every reply at once
+        """
+        self.flush_threshold = size
+
+    def create_protocol(self):
+        """
+        Create the protocol object of a new connection
+
+        Returns:
+            asyncio.Protocol: Protocol for the configured transport
+        """
+        if self.http_enabled:
+            check_password = None
+            if self.http_basic_auth_enabled:
+                check_password = self.passwdCheckFunction
+
+            return JsonRpcHttpProtocol(self.rpcprocessor,
+                    self.tls_client_auth_enabled, check_password)
+
+        return JsonRpcProtocol(self.rpcprocessor, self.tls_client_auth_enabled,
+                self.max_line_length, self.flush_threshold)
+
+    def create_server(self, loop):
+        """
+        Create the listening server on an event loop
+
+        Args:
+            loop (AbstractEventLoop): Event loop to listen with
+
+        Returns:
+            coroutine: Returns the asyncio Server
+        """
+        unix_prefix = 'unix://'
+
+        if self.host.startswith(unix_prefix):
+            return loop.create_unix_server(self.create_protocol,
+                    self.host[len(unix_prefix):], ssl=self.ssl_context,
+                    backlog=self.unix_socket_backlog)
+
+        return loop.create_server(self.create_protocol, self.host, self.port,
+                ssl=self.ssl_context, reuse_address=True)
+
+    def run(self):
+        """
+        Start the server and listen on host:port
+        """
+        unix_prefix = 'unix://'
+
+        self.rpcprocessor.start_process_pools()
+
+        loop = new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        try:
+            server = loop.run_until_complete(self.create_server(loop))
+        except OSError as e:
+            print("ERROR: " + e.strerror, file=sys.stderr)
+            sys.exit(1)
+
+        if self.host.startswith(unix_prefix):
+            os.chmod(self.host[len(unix_prefix):], self.unix_socket_mode)
+            print("Listening on %s" % (self.host))
+        else:
+            print("Listening on %s:%d" % (self.host, self.port))
+
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.close()
+            self.rpcprocessor.stop_process_pools()
+
+            if self.host.startswith(unix_prefix) and \
+                    os.path.exists(self.host[len(unix_prefix):]):
+                os.unlink(self.host[len(unix_prefix):])
@@ -0,0 +1,108 @@
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import collections
+import threading
+import time
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+class LruCache(object):
+    """
+    Bounded cache that evicts the least recently used entries
+
+    Entries can expire after a time to live. The cache is thread-safe and
+    counts hits, misses, evictions and expirations.
+    """
+    def __init__(self, max_entries, ttl=None):
+        """
+        Constructor
+
+        Args:
+            max_entries (int): Maximum number of entries
+            ttl (float): Seconds after which an entry expires or None if
+                         entries don't expire
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """
+        Look up an entry and mark it as recently used
+
+        Args:
+            key (str): Key of the entry
+
+        Returns:
+            any: The cached value or None if there is no valid entry
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires = entry
+
+            if expires is not None and expires <= monotonic():
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.entries[key] = entry
+            self.hits += 1
+
+            return value
+
+    def put(self, key, value):
+        """
+        Add an entry and evict the least recently used one if the cache is full
+
+        Args:
+            key (str): Key of the entry
+            value (any): Value to cache (must not be None)
+        """
+        expires = None
+        if self.ttl is not None:
+            expires = monotonic() + self.ttl
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all entries (the counters are kept)
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Get the counters of the cache
+
+        Returns:
+            dict: Number of entries, limits and counters
+        """
+        with self.lock:
+            return {
+                    'entries': len(self.entries),
+                    'max_entries': self.max_entries,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations
+            }
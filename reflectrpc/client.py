@@ -2,8 +2,8 @@ from __future__ import unicode_literals
 from builtins import bytes, dict, list, int, float, str
 
 import base64
+import copy
 import errno
-import json
 import os.path
 import select
 import socket
@@ -20,6 +20,8 @@ if sys.version_info.major == 2:
 else:
     from ssl import SSLEOFError
 
+from reflectrpc.codec import JsonCodec, get_codec
+
 class NetworkError(Exception):
     """
     Encapsulates network errors to ease error handling for users
@@ -57,6 +59,77 @@ class RpcError(Exception):
     def __str__(self):
         return "ERROR: " + self.msg
 
+class RpcFuture(object):
+    """
+    Result of a pipelined RPC call that becomes available once the reply
+    arrives
+    """
+    def __init__(self, client, request_id):
+        """
+        Constructor
+
+        Args:
+            client (RpcClient): Client that sent the request
+            request_id (int): JSON-RPC id of the request
+        """
+        self.client = client
+        self.request_id = request_id
+        self._done = False
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        """
+        Check if the reply was received
+
+        Returns:
+            bool: True if the result or an exception is available
+        """
+        return self._done
+
+    def result(self):
+        """
+        Return the value returned by the server
+
+        Reads replies from the connection until the reply to this request has
+        arrived. Replies to other requests that arrive first are stored in
+        their futures.
+
+        Returns:
+            JSON type: The value returned by the server
+
+        Raises:
+            RpcError: If the server replied with an error
+            NetworkError: If the connection failed before the reply arrived
+        """
+        while not self._done:
+            self.client.receive_pipelined_reply()
+
+        if self._exception is not None:
+            raise self._exception
+
+        return self._result
+
+    def exception(self):
+        """
+        Return the exception raised by result without raising it
+
+        Returns:
+            Exception: The exception or None if the call succeeded
+        """
+        while not self._done:
+            self.client.receive_pipelined_reply()
+
+        return self._exception
+
+    def set_result(self, result):
+        self._result = result
+        self._done = True
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done = True
+
 class RpcClient(object):
     """
     Client for the JSON-RPC 1.0 protocol
@@ -71,9 +144,11 @@ class RpcClient(object):
                         Socket)
         """
         self.req_id = 1
-        self.recv_buf = ''
+        self.recv_buf = b''
         self.sock = None
 
+        self.codec = get_codec()
+
         # Client configuration
         self.host = host
         self.port = port
@@ -100,6 +175,13 @@ class RpcClient(object):
 
         self.auto_reconnect = False
 
+        # maximum number of pipelined requests that wait for a reply
+        self.pipeline_window = 100
+        # encoded pipelined requests that were not sent yet
+        self.pipeline_queue = []
+        # futures of the pipelined requests by request id
+        self.pipeline_pending = {}
+
     def enable_auto_reconnect(self):
         """
         Enable automatic reconnect in case the connection was closed by the peer
@@ -115,6 +197,42 @@ class RpcClient(object):
         """
         self.auto_reconnect = False
 
+    def set_codec(self, codec):
+        """
+        Select the JSON codec used to encode requests and decode replies
+
+        By default the fastest installed codec is used.
+
+        Args:
+            codec (str|JsonCodec): Name of a registered codec (e.g. 'json',
+                                   'orjson') or a JsonCodec object
+
+        Raises:
+            ValueError: If the codec is unknown or not installed
+        """
+        if not isinstance(codec, JsonCodec):
+            codec = get_codec(codec)
+
+        self.codec = codec
+
+    def set_pipeline_window(self, window):
+        """
+        Set the maximum number of pipelined requests that wait for a reply
+
+        Once that many requests are in flight rpc_call_pipelined reads replies
+        before it sends another request.
+
+        Args:
+            window (int): Maximum number of requests in flight
+
+        Raises:
+            ValueError: If window is smaller than 1
+        """
+        if window < 1:
+            raise ValueError("The pipeline window must be at least 1")
+
+        self.pipeline_window = window
+
     def enable_tls(self, ca_file, check_hostname=True):
         """
         Enable TLS on the connection
@@ -167,6 +285,22 @@ class RpcClient(object):
         self.http_basic_username = username
         self.http_basic_password = password
 
+    def clone(self):
+        """
+        Create a client with the same configuration that is not connected yet
+
+        Returns:
+            RpcClient: New client
+        """
+        client = copy.copy(self)
+        client.req_id = 1
+        client.recv_buf = b''
+        client.sock = None
+        client.pipeline_queue = []
+        client.pipeline_pending = {}
+
+        return client
+
     def is_connected(self):
         """
         Check if the client is connected to a server
@@ -237,6 +371,32 @@ class RpcClient(object):
         Raises:
             NetworkError: Any network error
         """
+        json_reply = self.__call_raw(json_data, send_only)
+
+        if json_reply is None:
+            return None
+
+        return json_reply.decode('utf-8')
+
+    def __call_raw(self, json_data, send_only):
+        """
+        Send a JSON request to the server and return the response as bytes
+
+        Args:
+            json_data (bytes|str): The JSON that is sent to the server as is
+            send_only (bool): Only send the request, don't try to read a response
+
+        Returns:
+            bytes: The response as returned by the server
+            None: If send_only is True
+
+        Raises:
+            NetworkError: Any network error
+        """
+        # replies to pipelined requests must not be mistaken for ours
+        if self.pipeline_pending:
+            self.wait_for_replies()
+
         try:
             if not self.is_connected():
                 self.__connect()
@@ -267,7 +427,8 @@ class RpcClient(object):
             raise NetworkError(e)
 
     def send_request(self, data):
-        data = data.encode('utf-8')
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
 
         if self.http_enabled:
             http_headers = [
@@ -364,22 +525,29 @@ class RpcClient(object):
             data += self.sock.recv(remaining_bytes)
             remaining_bytes = content_length - len(data)
 
-        return data.decode('utf-8')
+        return data
 
     def receive_line_response(self):
-        data = self.sock.recv(4096)
-        self.recv_buf += data.decode('utf-8')
+        # pipelined replies may already be buffered
+        if not b"\n" in self.recv_buf:
+            data = self.sock.recv(4096)
+            self.recv_buf += data
 
-        if not self.recv_buf.strip().startswith('{'):
+        # a reply is either a JSON object or an array for batch requests
+        if not self.recv_buf.strip()[:1] in (b'{', b'['):
             self.close_connection()
             raise NetworkError("Non-JSON content received")
 
-        while not "\n" in self.recv_buf:
+        while not b"\n" in self.recv_buf:
             data = self.sock.recv(4096)
-            self.recv_buf += data.decode('utf-8')
+            if not data:
+                raise IOError(errno.ECONNRESET, "Connection closed by peer")
 
-        response = self.recv_buf
-        self.recv_buf = ''
+            self.recv_buf += data
+
+        end = self.recv_buf.index(b"\n") + 1
+        response = self.recv_buf[:end]
+        self.recv_buf = self.recv_buf[end:]
 
         return response
 
@@ -399,11 +567,11 @@ class RpcClient(object):
         Raises:
             RpcError: Generic exception to encapsulate all errors
         """
-        json_data = json.dumps(self.build_rpc_call(method, *params))
+        json_data = self.codec.dumps(self.build_rpc_call(method, *params))
 
-        json_reply = self.rpc_call_raw(json_data)
+        json_reply = self.__call_raw(json_data, False)
 
-        reply = json.loads(json_reply)
+        reply = self.codec.loads(json_reply)
 
         if 'error' in reply and reply['error']:
             raise RpcError(reply['error'])
@@ -419,12 +587,140 @@ class RpcClient(object):
             params (list): The parameters to pass to the RPC method
         """
 
-        json_data = json.dumps(self.build_rpc_call(method, *params))
-        self.rpc_call_raw(json_data, True)
+        json_data = self.codec.dumps(self.build_rpc_call(method, *params))
+        self.__call_raw(json_data, True)
+
+    def rpc_call_pipelined(self, method, *params):
+        """
+        Call a RPC function on the server without waiting for the reply
+
+        The request is queued and sent together with the other queued requests
+        as soon as a reply is needed (e.g. when result is called on one of the
+        returned futures), the pipeline window is full or flush_pipeline is
+        called. The server may reply in any order (e.g. TwistedJsonRpcServer
+        when RPC functions return Deferreds), the replies are matched with
+        their requests by id.
+
+        Pipelining requires the line based protocol, it doesn't work with
+        HTTP. Requests in flight are not sent again on reconnect, if the
+        connection fails all their futures raise a NetworkError.
+
+        Args:
+            method (str): The name of the RPC method to call on the server
+            params (list): The parameters to pass to the RPC method
+
+        Returns:
+            RpcFuture: Future for the value returned by the server
+
+        Raises:
+            ValueError: If HTTP is enabled
+            NetworkError: If the connection failed while replies were read
+                          because the pipeline window was full
+        """
+        if self.http_enabled:
+            raise ValueError("Pipelining is not supported with HTTP")
+
+        while len(self.pipeline_pending) >= self.pipeline_window:
+            self.receive_pipelined_reply()
+
+        request = self.build_rpc_call(method, *params)
+        future = RpcFuture(self, request['id'])
+
+        self.pipeline_queue.append(self.codec.dumps(request))
+        self.pipeline_pending[request['id']] = future
+
+        return future
+
+    def flush_pipeline(self):
+        """
+        Send all queued pipelined requests
+
+        Raises:
+            NetworkError: Any network error
+        """
+        if not self.pipeline_queue:
+            return
+
+        data = b'\r\n'.join(self.pipeline_queue) + b'\r\n'
+        self.pipeline_queue = []
+
+        try:
+            if not self.is_connected():
+                self.__connect()
+
+            self.sock.sendall(data)
+        except (ConnectionRefusedError, socket.error, SSLEOFError,
+                TLSHostnameError) as e:
+            self.__fail_pipelined(NetworkError(e))
+            raise NetworkError(e)
+
+    def receive_pipelined_reply(self):
+        """
+        Send the queued pipelined requests and read the next reply
+
+        The reply is stored in the future of its request.
+
+        Raises:
+            NetworkError: Any network error
+        """
+        self.flush_pipeline()
+
+        try:
+            json_reply = self.receive_line_response()
+        except (socket.error, SSLEOFError) as e:
+            self.__fail_pipelined(NetworkError(e))
+            raise NetworkError(e)
+
+        reply = self.codec.loads(json_reply)
+        future = None
+        if isinstance(reply, dict):
+            future = self.pipeline_pending.pop(reply.get('id'), None)
+
+        if future is None:
+            # the server couldn't process a request (e.g. because it is too
+            # long) and will close the connection
+            self.__fail_pipelined(RpcError(reply.get('error')
+                if isinstance(reply, dict) else reply))
+            return
+
+        if 'error' in reply and reply['error']:
+            future.set_exception(RpcError(reply['error']))
+        else:
+            future.set_result(reply['result'])
+
+    def wait_for_replies(self):
+        """
+        Send the queued pipelined requests and read the replies to all
+        pipelined requests
+
+        Raises:
+            NetworkError: Any network error
+        """
+        while self.pipeline_pending:
+            self.receive_pipelined_reply()
+
+    def __fail_pipelined(self, exception):
+        """
+        Close the connection and let all pipelined requests fail
+
+        Args:
+            exception (Exception): Exception raised by the futures
+        """
+        pending = self.pipeline_pending
+        self.pipeline_pending = {}
+        self.pipeline_queue = []
+
+        self.close_connection()
+
+        for future in pending.values():
+            future.set_exception(exception)
 
     def close_connection(self):
         """
         Force the connection to be closed
+
+        Pipelined requests that are still waiting for a reply fail with a
+        NetworkError.
         """
         try:
             self.sock.close()
@@ -432,6 +728,10 @@ class RpcClient(object):
             pass
 
         self.sock = None
+        self.recv_buf = b''
+
+        if self.pipeline_pending:
+            self.__fail_pipelined(NetworkError("Connection closed before the reply was received"))
 
     def __check_host_cert(self, sock):
         """
@@ -0,0 +1,389 @@
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import contextlib
+import select
+import socket
+import ssl
+import threading
+
+from reflectrpc.client import RpcClient, RpcError
+from reflectrpc.metrics import LatencyHistogram, timer
+
+class PoolTimeoutError(Exception):
+    """
+    Raised when no connection of an RpcClientPool became available in time
+    """
+    pass
+
+class RpcClientPool(object):
+    """
+    Thread-safe pool of RpcClient connections to the same server
+
+    A thread leases a client, uses it exclusively and returns it to the pool
+    afterwards. The pool creates at most max_size clients, further threads
+    wait until a client is returned.
+    """
+    def __init__(self, host, port, max_size=10, checkout_timeout=None,
+            max_idle_time=60.0):
+        """
+        Constructor
+
+        Args:
+            host (str): Hostname, IP address or UNIX Domain Socket to connect to
+            port (int): TCP port to connect to (ignored if host is a UNIX Domain
+                        Socket)
+            max_size (int): Maximum number of connections
+            checkout_timeout (float): Seconds to wait for a free connection or
+                                      None to wait as long as it takes
+            max_idle_time (float): Idle connections are closed after this many
+                                   seconds or never if it is None
+
+        Raises:
+            ValueError: If max_size is smaller than 1
+        """
+        if max_size < 1:
+            raise ValueError("The pool size must be at least 1")
+
+        # all clients are cloned from this one
+        self.template = RpcClient(host, port)
+
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.max_idle_time = max_idle_time
+
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+
+        # idle clients with the time they were returned, most recent last
+        self.idle = []
+        self.leased = set()
+        self.closed = False
+
+        # statistics
+        self.created = 0
+        self.evicted = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = LatencyHistogram()
+
+    def set_timeout(self, timeout):
+        """
+        Set the timeout of the socket operations of the clients
+
+        Args:
+            timeout (float): Timeout in seconds
+        """
+        self.template.timeout = timeout
+
+    def enable_auto_reconnect(self):
+        """
+        Enable automatic reconnect in case the connection was closed by the peer
+        """
+        self.template.enable_auto_reconnect()
+
+    def set_codec(self, codec):
+        """
+        Select the JSON codec used to encode requests and decode replies
+
+        Args:
+            codec (str|JsonCodec): Name of a registered codec (e.g. 'json',
+                                   'orjson') or a JsonCodec object
+
+        Raises:
+            ValueError: If the codec is unknown or not installed
+        """
+        self.template.set_codec(codec)
+
+    def set_pipeline_window(self, window):
+        """
+        Set the maximum number of pipelined requests that wait for a reply
+
+        Args:
+            window (int): Maximum number of requests in flight
+
+        Raises:
+            ValueError: If window is smaller than 1
+        """
+        self.template.set_pipeline_window(window)
+
+    def enable_tls(self, ca_file, check_hostname=True):
+        """
+        Enable TLS on the connections
+
+        Args:
+            ca_file (str): Path to a CA file to validate the server certificate
+            check_hostname (bool): Check the hostname of the server against the
+                                   hostname in the certificate
+        """
+        self.template.enable_tls(ca_file, check_hostname)
+
+    def enable_client_auth(self, cert_file, key_file):
+        """
+        Enable TLS client authentication
+
+        Args:
+            cert_file (str): Path of a PEM file containing client cert
+            key_file (str): Path of a PEM file containing the client key
+        """
+        self.template.enable_client_auth(cert_file, key_file)
+
+    def enable_http(self, http_path='/rpc'):
+        """
+        Use HTTP as transport protocol
+
+        Args:
+            http_path (str): The path to the RPC HTTP resource (e.g. /rpc)
+        """
+        self.template.enable_http(http_path)
+
+    def enable_http_basic_auth(self, username, password):
+        """
+        Enable basic authentication for HTTP with username and password
+
+        Args:
+            username (str): Username to authenticate with
+            password (str): Password to authenticate with (will not be encrypted)
+        """
+        self.template.enable_http_basic_auth(username, password)
+
+    def acquire(self, timeout=None):
+        """
+        Lease a client to the calling thread
+
+        An idle client is reused if its connection is still usable, otherwise
+        a new client is created as long as there are fewer than max_size.
+        New clients connect on their first call.
+
+        Args:
+            timeout (float): Seconds to wait for a free client, overrides the
+                             checkout_timeout of the pool
+
+        Returns:
+            RpcClient: Client that must be given back with release
+
+        Raises:
+            PoolTimeoutError: If no client became available in time
+            ValueError: If the pool was closed
+        """
+        if timeout is None:
+            timeout = self.checkout_timeout
+
+        start = timer()
+        with self.lock:
+            while True:
+                if self.closed:
+                    raise ValueError("The pool is closed")
+
+                client = self.take_idle_client(timer())
+                if client is not None:
+                    break
+
+                if len(self.leased) < self.max_size:
+                    client = self.template.clone()
+                    self.created += 1
+                    break
+
+                if timeout is None:
+                    self.available.wait()
+                    continue
+
+                remaining = timeout - (timer() - start)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeoutError("No connection available after %.3f seconds" % (timeout))
+
+                self.available.wait(remaining)
+
+            self.leased.add(client)
+            self.checkouts += 1
+            self.wait_time.record(timer() - start)
+
+        return client
+
+    def take_idle_client(self, now):
+        """
+        Take the most recently returned idle client that is still usable
+
+        Idle clients that were not used for max_idle_time or whose connection
+        is broken are closed. Must be called with the lock held.
+
+        Args:
+            now (float): Current time as returned by timer
+
+        Returns:
+            RpcClient: Usable client or None if there is none
+        """
+        while self.idle:
+            client, returned = self.idle.pop()
+
+            if (self.max_idle_time is None or
+                    now - returned < self.max_idle_time) and \
+                    self.check_connection(client):
+                return client
+
+            client.close_connection()
+            self.evicted += 1
+
+        return None
+
+    def check_connection(self, client):
+        """
+        Check if the connection of an idle client is still usable
+
+        There must be nothing to read from an idle connection. If there is,
+        the server has closed it (or sent data nobody asked for).
+
+        Args:
+            client (RpcClient): Idle client
+
+        Returns:
+            bool: True if the client can be used
+        """
+        sock = client.sock
+        if sock is None:
+            return True
+
+        try:
+            readable = select.select([sock], [], [], 0)[0]
+            if not readable:
+                return True
+
+            # TLS records without application data (e.g. session tickets)
+            # make the socket readable too
+            if isinstance(sock, ssl.SSLSocket):
+                sock.setblocking(False)
+                try:
+                    sock.recv(1)
+                except ssl.SSLWantReadError:
+                    return True
+                finally:
+                    sock.settimeout(client.timeout)
+        except (socket.error, ValueError):
+            pass
+
+        return False
+
+    def release(self, client, broken=False):
+        """
+        Give a leased client back to the pool
+
+        Replies to pipelined requests that are still outstanding are read
+        first. Broken clients are closed and replaced by new ones later.
+
+        Args:
+            client (RpcClient): Client returned by acquire
+            broken (bool): True if the connection is in an unknown state (e.g.
+                           after a network error)
+
+        Raises:
+            ValueError: If the client is not leased from this pool
+        """
+        if not broken and client.pipeline_pending:
+            try:
+                client.wait_for_replies()
+            except Exception:
+                broken = True
+
+        with self.lock:
+            if client not in self.leased:
+                raise ValueError("The client is not leased from this pool")
+
+            self.leased.remove(client)
+
+            if broken or self.closed:
+                client.close_connection()
+                self.evicted += 1
+            else:
+                self.idle.append((client, timer()))
+
+            # the least recently used clients are at the front
+            if self.max_idle_time is not None:
+                now = timer()
+                while self.idle and now - self.idle[0][1] >= self.max_idle_time:
+                    self.idle.pop(0)[0].close_connection()
+                    self.evicted += 1
+
+            self.available.notify()
+
+    @contextlib.contextmanager
+    def lease(self, timeout=None):
+        """
+        Lease a client for the duration of a with statement
+
+        If the block raises an exception other than RpcError the connection
+        is considered broken and closed.
+
+        Args:
+            timeout (float): Seconds to wait for a free client, overrides the
+                             checkout_timeout of the pool
+
+        Raises:
+            PoolTimeoutError: If no client became available in time
+        """
+        client = self.acquire(timeout)
+        try:
+            yield client
+        except RpcError:
+            self.release(client)
+            raise
+        except BaseException:
+            self.release(client, True)
+            raise
+        else:
+            self.release(client)
+
+    def rpc_call(self, method, *params):
+        """
+        Call a RPC function on the server with a leased client
+
+        Args:
+            method (str): The name of the RPC method to call on the server
+            params (list): The parameters to pass to the RPC method
+
+        Returns:
+            JSON type: The value returned by the server
+
+        Raises:
+            RpcError: Generic exception to encapsulate all errors
+            NetworkError: Any network error
+            PoolTimeoutError: If no client became available in time
+        """
+        with self.lease() as client:
+            return client.rpc_call(method, *params)
+
+    def close(self):
+        """
+        Close all idle connections and the leased ones once they are released
+
+        Threads waiting for a client get a ValueError.
+        """
+        with self.lock:
+            self.closed = True
+
+            for client, returned in self.idle:
+                client.close_connection()
+
+            self.idle = []
+            self.available.notify_all()
+
+    def get_status(self):
+        """
+        Get the state of the pool and the time threads waited for clients
+
+        Returns:
+            dict: Numbers of leased and idle clients, how many clients were
+                  created and evicted, how many were leased, how often
+                  acquire timed out and a histogram of the time acquire took
+        """
+        with self.lock:
+            return {
+                    'max_size': self.max_size,
+                    'leased': len(self.leased),
+                    'idle': len(self.idle),
+                    'created': self.created,
+                    'evicted': self.evicted,
+                    'checkouts': self.checkouts,
+                    'timeouts': self.timeouts,
+                    'wait_time': self.wait_time.to_dict()
+            }
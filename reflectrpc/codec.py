@@ -0,0 +1,255 @@
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import json
+import re
+
+# numbers that might not fit into 64 bits (they may also be part of a string)
+big_int_pattern = re.compile(r'\d{20}')
+big_int_bytes_pattern = re.compile(br'\d{20}')
+
+class JsonCodec(object):
+    """
+    Base class for JSON encoders and decoders
+
+    A codec decodes JSON messages from bytes (or strings) and encodes Python
+    values directly to UTF-8 encoded bytes, so no extra copies are needed to
+    convert between strings and bytes on the wire.
+    """
+    name = None
+    module_name = None
+
+    @classmethod
+    def is_available(cls):
+        """
+        Check if the JSON library this codec is based on is installed
+
+        Returns:
+            bool: True if the codec can be used, False if not
+        """
+        try:
+            __import__(cls.module_name)
+        except ImportError:
+            return False
+
+        return True
+
+    def loads(self, data):
+        """
+        Decode a JSON message
+
+        Args:
+            data (bytes|str): UTF-8 encoded JSON message
+
+        Returns:
+            any: The decoded value
+
+        Raises:
+            ValueError: If data is not valid JSON
+        """
+        raise NotImplementedError()
+
+    def dumps(self, value):
+        """
+        Encode a value as JSON
+
+        Args:
+            value (any): Value to encode
+
+        Returns:
+            bytes: UTF-8 encoded JSON
+
+        Raises:
+            TypeError: If value contains something that can't be encoded
+        """
+        raise NotImplementedError()
+
+class StdlibJsonCodec(JsonCodec):
+    """
+    Codec based on the json module of the Python standard library
+    """
+    name = 'json'
+    module_name = 'json'
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.encoder = json.JSONEncoder(ensure_ascii=False,
+                separators=(',', ':'))
+
+    def loads(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+
+        return self.decoder.decode(data)
+
+    def dumps(self, value):
+        return self.encoder.encode(value).encode('utf-8')
+
+class SimplejsonCodec(JsonCodec):
+    """
+    Codec based on simplejson
+    """
+    name = 'simplejson'
+    module_name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+
+        self.simplejson = simplejson
+        self.encoder = simplejson.JSONEncoder(ensure_ascii=False,
+                separators=(',', ':'))
+
+    def loads(self, data):
+        return self.simplejson.loads(data)
+
+    def dumps(self, value):
+        return self.encoder.encode(value).encode('utf-8')
+
+class UjsonCodec(JsonCodec):
+    """
+    Codec based on ujson
+    """
+    name = 'ujson'
+    module_name = 'ujson'
+
+    def __init__(self):
+        import ujson
+
+        self.ujson = ujson
+
+    def loads(self, data):
+        return self.ujson.loads(data)
+
+    def dumps(self, value):
+        return self.ujson.dumps(value, ensure_ascii=False,
+                escape_forward_slashes=False).encode('utf-8')
+
+class OrjsonCodec(JsonCodec):
+    """
+    Codec based on orjson
+
+    orjson encodes directly to bytes. Keys of hashes that are no strings are
+    converted like the json module does. orjson only supports integers of up
+    to 64 bits, messages that might contain larger ones are handled by the
+    json module so they are decoded and encoded exactly.
+    """
+    name = 'orjson'
+    module_name = 'orjson'
+
+    def __init__(self):
+        import orjson
+
+        self.orjson = orjson
+        self.fallback = StdlibJsonCodec()
+
+    def loads(self, data):
+        if isinstance(data, str):
+            big_int = big_int_pattern.search(data)
+        else:
+            big_int = big_int_bytes_pattern.search(data)
+
+        # orjson would turn the number into a float
+        if big_int:
+            return self.fallback.loads(data)
+
+        return self.orjson.loads(data)
+
+    def dumps(self, value):
+        try:
+            return self.orjson.dumps(value, option=self.orjson.OPT_NON_STR_KEYS)
+        except self.orjson.JSONEncodeError:
+            return self.fallback.dumps(value)
+
+# all known codecs ordered from fastest to slowest
+codec_classes = [OrjsonCodec, UjsonCodec, SimplejsonCodec, StdlibJsonCodec]
+
+# codec instances by name
+codec_instances = {}
+
+default_codec_name = None
+
+def register_codec(codec_class, fastest=False):
+    """
+    Make a new codec known to the registry
+
+    Args:
+        codec_class (class): Class derived from JsonCodec
+        fastest (bool): Prefer this codec over all other codecs if it is
+                        installed, otherwise it is the least preferred one
+
+    Raises:
+        ValueError: If codec_class is not derived from JsonCodec or a codec of
+                    this name is already registered
+    """
+    if not issubclass(codec_class, JsonCodec):
+        raise ValueError("Codec must be derived from JsonCodec")
+
+    if codec_class.name in [c.name for c in codec_classes]:
+        raise ValueError("Another codec of the name '%s' is already registered" % (codec_class.name))
+
+    if fastest:
+        codec_classes.insert(0, codec_class)
+    else:
+        codec_classes.append(codec_class)
+
+def available_codecs():
+    """
+    List the names of all codecs that can be used
+
+    Returns:
+        list: Names of all installed codecs ordered from fastest to slowest
+    """
+    return [c.name for c in codec_classes if c.is_available()]
+
+def set_default_codec(name):
+    """
+    Select the codec returned by get_codec() when called without a name
+
+    Args:
+        name (str): Name of the codec or None to pick the fastest one
+
+    Raises:
+        ValueError: If the codec is unknown or not installed
+    """
+    global default_codec_name
+
+    if name is not None:
+        get_codec(name)
+
+    default_codec_name = name
+
+def get_codec(name=None):
+    """
+    Get a codec from the registry
+
+    Args:
+        name (str): Name of the codec (e.g. 'json', 'orjson'). If None the
+                    default codec is returned which is the fastest installed
+                    one unless set_default_codec() was called.
+
+    Returns:
+        JsonCodec: Codec instance
+
+    Raises:
+        ValueError: If the codec is unknown or not installed
+    """
+    if name is None:
+        name = default_codec_name
+
+    if name is None:
+        name = available_codecs()[0]
+
+    if name in codec_instances:
+        return codec_instances[name]
+
+    for codec_class in codec_classes:
+        if codec_class.name != name:
+            continue
+
+        if not codec_class.is_available():
+            raise ValueError("JSON codec '%s' is not installed" % (name))
+
+        codec_instances[name] = codec_class()
+        return codec_instances[name]
+
+    raise ValueError("Unknown JSON codec: '%s'" % (name))
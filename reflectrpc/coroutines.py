@@ -0,0 +1,283 @@
+"""
+Coroutine support for RpcProcessor
+
+This module is only imported when an RPC function returns an awaitable or one
+of the async methods of RpcProcessor is called. It works with coroutines that
+are driven by asyncio as well as with coroutines that are driven by Twisted
+via ensureDeferred.
+"""
+
+from __future__ import unicode_literals
+
+import asyncio
+import sys
+import traceback
+
+from reflectrpc import is_awaitable, is_deferred
+
+def get_running_reactor():
+    """
+    Get the Twisted reactor if it is running without importing it
+
+    Returns:
+        IReactorCore: The running reactor or None
+    """
+    reactor = sys.modules.get('twisted.internet.reactor')
+
+    if reactor is not None and reactor.running:
+        return reactor
+
+    return None
+
+def get_running_loop():
+    """
+    Get the running asyncio event loop
+
+    Returns:
+        AbstractEventLoop: The running event loop or None
+    """
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+async def wait(value):
+    """
+    Await Deferreds and awaitables until a plain value is left
+
+    Args:
+        value (any): A Deferred, an awaitable or a plain value
+
+    Returns:
+        any: The final value
+    """
+    while is_deferred(value) or is_awaitable(value):
+        if is_deferred(value) and get_running_reactor() is None:
+            # asyncio can't await Deferreds directly
+            value = value.asFuture(asyncio.get_event_loop())
+
+        value = await value
+
+    return value
+
+async def gather(awaitables):
+    """
+    Wait for several Deferreds and awaitables concurrently
+
+    Uses Twisted if the reactor is running and asyncio otherwise.
+
+    Args:
+        awaitables (list): Deferreds and awaitables to wait for
+
+    Returns:
+        list: Their values in the same order
+    """
+    if get_running_reactor() is not None:
+        defer = sys.modules['twisted.internet.defer']
+        return await defer.gatherResults([defer.ensureDeferred(wait(a))
+            for a in awaitables])
+
+    if get_running_loop() is not None:
+        return await asyncio.gather(*[wait(a) for a in awaitables])
+
+    return [await wait(a) for a in awaitables]
+
+async def await_notification(awaitable):
+    """
+    Run the awaitable result of a notification request
+
+    Errors are printed since there is nobody to report them to.
+
+    Returns:
+        None: Notifications get no reply
+    """
+    try:
+        await wait(awaitable)
+    except Exception:
+        traceback.print_exc()
+
+    return None
+
+async def await_notifications(awaitables):
+    """
+    Run the awaitable results of the notification requests of a batch
+
+    Returns:
+        None: Notifications get no reply
+    """
+    await gather([await_notification(a) for a in awaitables])
+
+    return None
+
+async def resolve_reply(rpcprocessor, reply):
+    """
+    Wait for the result of a single reply
+
+    Args:
+        rpcprocessor (RpcProcessor): RpcProcessor that created the reply
+        reply (dict): Reply whose result may be a Deferred or an awaitable
+
+    Returns:
+        dict: The reply with the final result or an error
+    """
+    try:
+        reply['result'] = await wait(reply['result'])
+    except Exception as e:
+        reply = rpcprocessor.handle_error(e, reply)
+
+    return reply
+
+async def resolve_replies(rpcprocessor, reply):
+    """
+    Wait for all results of a reply as returned by process_request
+
+    Args:
+        rpcprocessor (RpcProcessor): RpcProcessor that created the reply
+        reply (dict|list|None|awaitable): Reply, list of replies or the
+                                          awaitable of a notification
+
+    Returns:
+        dict|list|None: The reply with all results resolved
+    """
+    if reply is None:
+        return None
+
+    if is_awaitable(reply):
+        return await await_notification(reply)
+
+    if isinstance(reply, list):
+        pending = [r if is_awaitable(r) else resolve_reply(rpcprocessor, r)
+                for r in reply]
+        replies = [r for r in await gather(pending) if r is not None]
+
+        if not replies:
+            return None
+
+        return replies
+
+    return await resolve_reply(rpcprocessor, reply)
+
+async def cache_awaitable_result(rpcprocessor, awaitable, cache, key):
+    """
+    Put the result of an awaitable into a result cache once it is available
+
+    Returns:
+        any: The result of the awaitable
+    """
+    value = await wait(awaitable)
+
+    return rpcprocessor.store_cached_value(value, cache, key)
+
+async def measure_awaitable(rpcprocessor, awaitable, method, start, details):
+    """
+    Record the metrics of a call once its awaitable result is done
+
+    Returns:
+        any: The result of the awaitable
+    """
+    try:
+        value = await wait(awaitable)
+    except Exception as e:
+        rpcprocessor.record_call(method, start, rpcprocessor.get_error_name(e),
+                details)
+        raise
+
+    rpcprocessor.record_call(method, start, None, details)
+
+    return value
+
+async def track_awaitable(awaitable, in_flight, request_id):
+    """
+    Remove a request from the in-flight table once its awaitable is done
+
+    Returns:
+        any: The result of the awaitable
+    """
+    try:
+        return await wait(awaitable)
+    finally:
+        in_flight.remove(request_id)
+
+async def mark_awaitable(awaitable, timing, phase):
+    """
+    End a phase of a RequestTiming once an awaitable is done
+
+    Returns:
+        any: The result of the awaitable
+    """
+    try:
+        return await wait(awaitable)
+    finally:
+        timing.mark(phase)
+
+async def finish_awaitable_timing(rpcprocessor, awaitable, timing):
+    """
+    Record the phase timings of a message once its reply is encoded
+
+    Returns:
+        bytes|None: The encoded reply
+    """
+    try:
+        return await wait(awaitable)
+    finally:
+        timing.mark('encode')
+        rpcprocessor.finish_timing(timing)
+
+async def encode_awaitable_reply(rpcprocessor, reply):
+    """
+    Encode a reply once its awaitable result is available
+
+    Returns:
+        bytes: UTF-8 encoded JSON-RPC reply
+    """
+    reply = await resolve_reply(rpcprocessor, reply)
+
+    return rpcprocessor.encode_reply(reply)
+
+async def encode_awaitable_batch(encoded):
+    """
+    Join the encoded replies of a batch once all of them are available
+
+    Args:
+        encoded (list): Encoded replies, Deferreds and awaitables of encoded
+                        replies or awaitables of notifications
+
+    Returns:
+        bytes: UTF-8 encoded JSON array of replies
+        None: If all requests of the batch were notifications
+    """
+    pending = [i for i in range(len(encoded)) if not isinstance(encoded[i], bytes)]
+    results = await gather([encoded[i] for i in pending])
+
+    encoded = list(encoded)
+    for i, result in zip(pending, results):
+        encoded[i] = result
+
+    encoded = [e for e in encoded if e is not None]
+
+    if not encoded:
+        return None
+
+    return b'[' + b','.join(encoded) + b']'
+
+async def process_request_async(rpcprocessor, message, rpcinfo=None):
+    """
+    Coroutine version of RpcProcessor.process_request
+
+    Returns:
+        dict|list|None: Reply with all Deferreds and awaitables resolved
+    """
+    reply = rpcprocessor.process_request_preencoded(message, rpcinfo)
+    reply = await resolve_replies(rpcprocessor, reply)
+
+    return rpcprocessor.strip_preencoded(reply)
+
+async def process_message_async(rpcprocessor, data, rpcinfo=None):
+    """
+    Coroutine version of RpcProcessor.process_message
+
+    Returns:
+        bytes: UTF-8 encoded JSON-RPC reply
+        None: If there is nothing to reply (notification requests)
+    """
+    return await wait(rpcprocessor.process_message(data, rpcinfo))
@@ -0,0 +1,184 @@
+"""
+Memory profiling of running servers with tracemalloc
+
+Tracing has to be started before the snapshots are taken, allocations made
+before that are unknown to tracemalloc. Comparing two snapshots shows which
+lines allocated the memory a server gained in between (e.g. buffers of
+connections or objects that are never freed).
+"""
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import collections
+import threading
+
+# maximum number of snapshots kept at the same time
+max_snapshots = 10
+
+def get_tracemalloc():
+    """
+    Import tracemalloc
+
+    Returns:
+        module: The tracemalloc module
+
+    Raises:
+        RuntimeError: If tracemalloc is not available (Python 2)
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        raise RuntimeError("tracemalloc is not available")
+
+    return tracemalloc
+
+class MemoryTracer(object):
+    """
+    Named tracemalloc snapshots of the current process
+
+    The oldest snapshot is dropped when more than max_snapshots are taken.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshots = collections.OrderedDict()
+
+    def start(self, frames=1):
+        """
+        Start tracing memory allocations
+
+        Args:
+            frames (int): Number of frames stored per allocation
+
+        Raises:
+            ValueError: If frames is not between 1 and 100
+        """
+        tracemalloc = get_tracemalloc()
+
+        if not 1 <= frames <= 100:
+            raise ValueError("Number of frames must be between 1 and 100")
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def stop(self):
+        """
+        Stop tracing memory allocations and drop all snapshots
+        """
+        tracemalloc = get_tracemalloc()
+        tracemalloc.stop()
+
+        with self.lock:
+            self.snapshots.clear()
+
+    def get_status(self):
+        """
+        Get the state of tracemalloc
+
+        Returns:
+            dict: Whether memory allocations are traced, the current and peak
+                  size of the traced memory in bytes and the names of the
+                  snapshots
+        """
+        tracemalloc = get_tracemalloc()
+        current, peak = tracemalloc.get_traced_memory()
+
+        with self.lock:
+            names = list(self.snapshots.keys())
+
+        return {
+                'tracing': tracemalloc.is_tracing(),
+                'current': current,
+                'peak': peak,
+                'snapshots': names
+        }
+
+    def take_snapshot(self, name):
+        """
+        Take a snapshot of the traced memory allocations
+
+        Allocations of tracemalloc itself and of the import system are left
+        out. A snapshot with the same name is replaced.
+
+        Args:
+            name (str): Name of the snapshot
+
+        Returns:
+            dict: Same as get_status
+
+        Raises:
+            ValueError: If memory allocations are not traced
+        """
+        tracemalloc = get_tracemalloc()
+
+        if not tracemalloc.is_tracing():
+            raise ValueError("Memory allocations are not traced, start tracing first")
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+            tracemalloc.Filter(False, '<unknown>')))
+
+        with self.lock:
+            self.snapshots.pop(name, None)
+            self.snapshots[name] = snapshot
+
+            while len(self.snapshots) > max_snapshots:
+                self.snapshots.popitem(last=False)
+
+        return self.get_status()
+
+    def get_snapshot(self, name):
+        """
+        Get a snapshot by name
+
+        Raises:
+            ValueError: If there is no snapshot with this name
+        """
+        with self.lock:
+            if name not in self.snapshots:
+                raise ValueError("No such snapshot: %s" % (name))
+
+            return self.snapshots[name]
+
+    def compare_snapshots(self, old_name, new_name, limit=20, group_by='lineno'):
+        """
+        Get the allocation sites whose memory changed most between two
+        snapshots
+
+        Args:
+            old_name (str): Name of the older snapshot
+            new_name (str): Name of the newer snapshot
+            limit (int): Maximum number of allocation sites to return
+            group_by (str): 'lineno' to group the allocations by file and line
+                            or 'filename' to group them by file
+
+        Returns:
+            list: Allocation sites with file, line (0 if grouped by file),
+                  size and number of blocks in the new snapshot and their
+                  change, biggest change first
+
+        Raises:
+            ValueError: If a snapshot doesn't exist or group_by is invalid
+        """
+        if group_by not in ('lineno', 'filename'):
+            raise ValueError("Allocations can only be grouped by 'lineno' or 'filename'")
+
+        old = self.get_snapshot(old_name)
+        new = self.get_snapshot(new_name)
+
+        sites = []
+        for stat in new.compare_to(old, group_by)[:limit]:
+            frame = stat.traceback[0]
+
+            sites.append({
+                'file': frame.filename,
+                'line': frame.lineno if group_by == 'lineno' else 0,
+                'size': stat.size,
+                'size_diff': stat.size_diff,
+                'count': stat.count,
+                'count_diff': stat.count_diff
+            })
+
+        return sites
@@ -0,0 +1,767 @@
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import bisect
+import collections
+import heapq
+import json
+import threading
+import time
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# upper bounds of the latency buckets in seconds
+default_latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+        0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class LatencyHistogram(object):
+    """
+    Histogram of latencies with fixed buckets
+
+    Recording a value only increments counters, so it doesn't allocate memory.
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds=default_latency_buckets):
+        """
+        Constructor
+
+        Args:
+            bounds (tuple): Sorted upper bounds of the buckets in seconds.
+                            Values above the last bound are counted in an
+                            extra bucket.
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, seconds):
+        """
+        Count a latency in its bucket
+
+        Args:
+            seconds (float): Latency in seconds
+        """
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def to_dict(self):
+        """
+        Convert the histogram to a dictionary
+
+        Returns:
+            dict: Bucket bounds, the count of each bucket (the last count is
+                  for values above the last bound), total count and sum
+        """
+        return {
+                'bounds': list(self.bounds),
+                'counts': list(self.counts),
+                'count': self.count,
+                'sum': self.sum
+        }
+
+class MethodMetrics(object):
+    """
+    Metrics of a single RPC method
+    """
+    __slots__ = ('calls', 'errors', 'latency')
+
+    def __init__(self, bounds=default_latency_buckets):
+        self.calls = 0
+        self.errors = {}
+        self.latency = LatencyHistogram(bounds)
+
+    def to_dict(self):
+        """
+        Convert the metrics to a dictionary
+
+        Returns:
+            dict: Number of calls, errors by error name and latency histogram
+        """
+        return {
+                'calls': self.calls,
+                'errors': dict(self.errors),
+                'latency': self.latency.to_dict()
+        }
+
+class Metrics(object):
+    """
+    Call counts, error counts and latencies of all RPC methods
+
+    Every thread records into its own set of counters, so recording needs no
+    lock. The counters of all threads are added up when they are read.
+    """
+    def __init__(self, bounds=default_latency_buckets):
+        """
+        Constructor
+
+        Args:
+            bounds (tuple): Upper bounds of the latency buckets in seconds
+        """
+        self.bounds = bounds
+        self.lock = threading.Lock()
+
+        # MethodMetrics by method name for each thread by thread id
+        self.threads = {}
+
+    def record(self, method, seconds, error_name=None):
+        """
+        Record a call of a method
+
+        Args:
+            method (str): Name of the method
+            seconds (float): Time it took until the result was available
+            error_name (str): Name of the error if the call failed
+        """
+        methods = self.threads.get(get_ident())
+        if methods is None:
+            methods = self.add_thread()
+
+        metrics = methods.get(method)
+        if metrics is None:
+            metrics = MethodMetrics(self.bounds)
+            methods[method] = metrics
+
+        metrics.calls += 1
+
+        latency = metrics.latency
+        latency.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        latency.count += 1
+        latency.sum += seconds
+
+        if error_name is not None:
+            metrics.errors[error_name] = metrics.errors.get(error_name, 0) + 1
+
+    def add_thread(self):
+        """
+        Add the counters of the current thread
+
+        Returns:
+            dict: Empty dictionary for the MethodMetrics of the thread
+        """
+        with self.lock:
+            threads = dict(self.threads)
+            threads[get_ident()] = {}
+            self.threads = threads
+
+            return threads[get_ident()]
+
+    def reset(self):
+        """
+        Forget all recorded calls
+        """
+        with self.lock:
+            self.threads = {}
+
+    def get_method_metrics(self):
+        """
+        Add up the counters of all threads
+
+        Returns:
+            dict: MethodMetrics by method name
+        """
+        result = {}
+
+        for methods in list(self.threads.values()):
+            for name, metrics in list(methods.items()):
+                total = result.get(name)
+
+                if total is None:
+                    total = MethodMetrics(self.bounds)
+                    result[name] = total
+
+                total.calls += metrics.calls
+
+                for error_name, count in list(metrics.errors.items()):
+                    total.errors[error_name] = total.errors.get(error_name, 0) + count
+
+                for i, count in enumerate(metrics.latency.counts):
+                    total.latency.counts[i] += count
+
+                total.latency.count += metrics.latency.count
+                total.latency.sum += metrics.latency.sum
+
+        return result
+
+    def to_dict(self):
+        """
+        Convert the metrics of all methods to a dictionary
+
+        Returns:
+            dict: Metrics of all methods that were called by method name
+        """
+        return dict((name, m.to_dict()) for name, m in self.get_method_metrics().items())
+
+class RequestTiming(object):
+    """
+    Time spent in the phases of processing a single message
+
+    The time between two calls of mark is added to the phase passed to the
+    second call.
+    """
+    __slots__ = ('method', 'phases', 'last')
+
+    def __init__(self, framing_time=None):
+        """
+        Constructor
+
+        Args:
+            framing_time (float): Seconds the transport needed to extract the
+                                  message from the received data
+        """
+        self.method = None
+        self.phases = {}
+        self.last = timer()
+
+        if framing_time is not None:
+            self.phases['framing'] = framing_time
+
+    def mark(self, phase):
+        """
+        End a phase
+
+        Args:
+            phase (str): Name of the phase that just ended
+        """
+        now = timer()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def mark_callback(self, value, phase):
+        """
+        Callback or errback for Deferreds that ends a phase
+
+        Returns:
+            any: value
+        """
+        self.mark(phase)
+
+        return value
+
+class PhaseTimings(object):
+    """
+    Time spent in the phases of processing messages aggregated by method
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+
+    def record(self, method, phases):
+        """
+        Add the phases of a message
+
+        Args:
+            method (str): Name of the method
+            phases (dict): Seconds spent in each phase by phase name
+        """
+        with self.lock:
+            entry = self.methods.get(method)
+
+            if entry is None:
+                entry = {'count': 0, 'phases': {}}
+                self.methods[method] = entry
+
+            entry['count'] += 1
+
+            for phase, seconds in phases.items():
+                stats = entry['phases'].get(phase)
+
+                if stats is None:
+                    stats = [0.0, 0.0]
+                    entry['phases'][phase] = stats
+
+                stats[0] += seconds
+                if seconds > stats[1]:
+                    stats[1] = seconds
+
+    def reset(self):
+        """
+        Forget all recorded messages
+        """
+        with self.lock:
+            self.methods = {}
+
+    def to_dict(self):
+        """
+        Convert the timings to a dictionary
+
+        Returns:
+            dict: Number of messages and total, mean and maximum seconds of
+                  each phase by method name
+        """
+        result = {}
+
+        with self.lock:
+            for method, entry in self.methods.items():
+                phases = {}
+
+                for phase, stats in entry['phases'].items():
+                    phases[phase] = {'total': stats[0],
+                            'mean': stats[0] / entry['count'], 'max': stats[1]}
+
+                result[method] = {'count': entry['count'], 'phases': phases}
+
+        return result
+
+class SlowRequestLog(object):
+    """
+    Bounded log of the slowest recent requests and of requests over a threshold
+
+    The slowest requests of a time window are kept in a heap, the requests
+    over the threshold in a ring buffer. Callers should only call add for
+    requests that took at least min_seconds or started after next_expiry, all
+    other requests wouldn't be logged anyway.
+    """
+    def __init__(self, max_entries=20, threshold=1.0, window=600.0,
+            max_param_length=200):
+        """
+        Constructor
+
+        Args:
+            max_entries (int): Number of slowest requests and number of
+                               requests over the threshold to keep
+            threshold (float): Requests that take longer than this number of
+                               seconds are always logged
+            window (float): Seconds after which a request no longer counts
+                            as one of the slowest requests or None to keep
+                            the slowest requests forever
+            max_param_length (int): Maximum length of the JSON encoded
+                                    parameters in an entry
+        """
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.window = window
+        self.max_param_length = max_param_length
+        self.lock = threading.Lock()
+
+        self.clear()
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        with self.lock:
+            # heap of (seconds, sequence number, end, entry)
+            self.slowest = []
+            self.over_threshold = collections.deque(maxlen=self.max_entries)
+            self.sequence = 0
+            self.update_limits()
+
+    def update_limits(self):
+        """
+        Update min_seconds and next_expiry after the entries changed
+        """
+        if len(self.slowest) < self.max_entries:
+            self.min_seconds = 0.0
+        else:
+            self.min_seconds = min(self.slowest[0][0], self.threshold)
+
+        if self.slowest and self.window is not None:
+            self.next_expiry = min(e[2] for e in self.slowest) + self.window
+        else:
+            self.next_expiry = float('inf')
+
+    def truncate_params(self, params):
+        """
+        Encode parameters as JSON and truncate them to max_param_length
+
+        Returns:
+            str: Truncated JSON array of the parameters
+        """
+        try:
+            encoded = json.dumps(params, default=repr)
+        except ValueError:
+            encoded = repr(params)
+
+        if len(encoded) > self.max_param_length:
+            encoded = encoded[:self.max_param_length] + '...'
+
+        return encoded
+
+    def add(self, method, params, username, start, seconds, phases=None,
+            deferred=False, error_name=None):
+        """
+        Log a request if it is slow enough
+
+        Args:
+            method (str): Name of the method
+            params (list): Parameters of the request
+            username (str): Name of the user that sent the request or None
+            start (float): Time the execution started (see timer)
+            seconds (float): Time it took until the result was available
+            phases (dict): Seconds spent in each phase or None if phase
+                           timing is disabled (the dict may still be updated
+                           by the caller)
+            deferred (bool): True if the result was a Deferred
+            error_name (str): Name of the error if the call failed
+        """
+        end = start + seconds
+        finished = time.time() - (timer() - end)
+
+        with self.lock:
+            # forget the slowest requests that left the time window
+            if end >= self.next_expiry:
+                self.slowest = [e for e in self.slowest if e[2] + self.window > end]
+                heapq.heapify(self.slowest)
+
+            entry = None
+
+            if seconds >= self.threshold:
+                entry = self.create_entry(method, params, username, finished,
+                        seconds, phases, deferred, error_name)
+                self.over_threshold.append(entry)
+
+            if len(self.slowest) < self.max_entries or seconds > self.slowest[0][0]:
+                if entry is None:
+                    entry = self.create_entry(method, params, username,
+                            finished, seconds, phases, deferred, error_name)
+
+                self.sequence += 1
+                item = (seconds, self.sequence, end, entry)
+
+                if len(self.slowest) < self.max_entries:
+                    heapq.heappush(self.slowest, item)
+                else:
+                    heapq.heapreplace(self.slowest, item)
+
+            self.update_limits()
+
+    def create_entry(self, method, params, username, finished, seconds,
+            phases, deferred, error_name):
+        """
+        Create the dictionary describing a logged request
+
+        Returns:
+            dict: Entry for the log
+        """
+        return {
+                'method': method,
+                'params': self.truncate_params(params),
+                'username': username,
+                'started': finished - seconds,
+                'finished': finished,
+                'duration': seconds,
+                'phases': phases,
+                'deferred': deferred,
+                'error': error_name
+        }
+
+    def to_dict(self):
+        """
+        Convert the log to a dictionary
+
+        Returns:
+            dict: The threshold, the slowest requests (slowest first) and the
+                  requests over the threshold (oldest first)
+        """
+        def copy_entry(entry):
+            entry = dict(entry)
+
+            if entry['phases'] is not None:
+                entry['phases'] = dict(entry['phases'])
+
+            return entry
+
+        with self.lock:
+            slowest = sorted(self.slowest, reverse=True)
+
+            return {
+                    'threshold': self.threshold,
+                    'window': self.window,
+                    'slowest': [copy_entry(e[3]) for e in slowest],
+                    'over_threshold': [copy_entry(e) for e in self.over_threshold]
+            }
+
+class LagMonitor(object):
+    """
+    Measures how late an event loop runs a periodic timer
+
+    A timer that is due every interval seconds fires late if something blocks
+    the event loop. The delay is recorded in a histogram and, if it is above
+    the threshold, attributed to the RPC method that ran longest on the loop
+    thread since the previous tick. Only calls on the thread that started the
+    monitor are tracked.
+    """
+    def __init__(self, interval=0.1, threshold=0.05,
+            bounds=default_latency_buckets):
+        """
+        Constructor
+
+        Args:
+            interval (float): Seconds between two ticks of the timer
+            threshold (float): Lag in seconds above which it is attributed to
+                               a method
+            bounds (tuple): Upper bounds of the lag histogram buckets in
+                            seconds
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.bounds = bounds
+        self.lock = threading.Lock()
+
+        self.thread_id = None
+        self.call_later = None
+        self.handle = None
+        self.expected = None
+
+        # method currently executed on the loop thread and its start time
+        self.current_method = None
+        self.current_start = None
+
+        # longest call on the loop thread since the last tick
+        self.longest_method = None
+        self.longest_seconds = 0.0
+
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all recorded lags
+        """
+        with self.lock:
+            self.histogram = LatencyHistogram(self.bounds)
+            self.max_lag = 0.0
+            self.over_threshold = 0
+
+            # [count, total lag, max lag] by method name
+            self.methods = {}
+
+    def start(self, call_later):
+        """
+        Start the timer, must be called on the loop thread
+
+        Args:
+            call_later (callable): Schedules a callable after a number of
+                                   seconds and returns a handle with a cancel
+                                   method (e.g. reactor.callLater)
+        """
+        self.thread_id = get_ident()
+        self.call_later = call_later
+        self.schedule()
+
+    def stop(self):
+        """
+        Stop the timer
+        """
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def schedule(self):
+        """
+        Schedule the next tick
+        """
+        self.expected = timer() + self.interval
+        self.handle = self.call_later(self.interval, self.tick)
+
+    def tick(self):
+        """
+        Record the lag of the timer and schedule the next tick
+        """
+        lag = max(timer() - self.expected, 0.0)
+
+        method = self.longest_method
+        if method is None:
+            method = '[unknown]'
+
+        self.longest_method = None
+        self.longest_seconds = 0.0
+
+        with self.lock:
+            self.histogram.record(lag)
+
+            if lag > self.max_lag:
+                self.max_lag = lag
+
+            if lag >= self.threshold:
+                self.over_threshold += 1
+
+                stats = self.methods.get(method)
+                if stats is None:
+                    stats = [0, 0.0, 0.0]
+                    self.methods[method] = stats
+
+                stats[0] += 1
+                stats[1] += lag
+                if lag > stats[2]:
+                    stats[2] = lag
+
+        self.schedule()
+
+    def enter_method(self, method):
+        """
+        Note that the current thread starts executing an RPC method
+
+        Args:
+            method (str): Name of the method
+        """
+        if get_ident() != self.thread_id:
+            return
+
+        self.current_method = method
+        self.current_start = timer()
+
+    def exit_method(self):
+        """
+        Note that the current thread finished executing its RPC method
+        """
+        if get_ident() != self.thread_id or self.current_method is None:
+            return
+
+        seconds = timer() - self.current_start
+        if seconds >= self.longest_seconds:
+            self.longest_method = self.current_method
+            self.longest_seconds = seconds
+
+        self.current_method = None
+
+    def to_dict(self):
+        """
+        Convert the recorded lags to a dictionary
+
+        Returns:
+            dict: Interval and threshold, the lag histogram, the maximum lag,
+                  the number of ticks over the threshold and the count, total
+                  and maximum lag attributed to each method by method name
+        """
+        with self.lock:
+            methods = {}
+
+            for method, stats in self.methods.items():
+                methods[method] = {'count': stats[0], 'total': stats[1],
+                        'max': stats[2]}
+
+            return {
+                    'interval': self.interval,
+                    'threshold': self.threshold,
+                    'lag': self.histogram.to_dict(),
+                    'max': self.max_lag,
+                    'over_threshold': self.over_threshold,
+                    'methods': methods
+            }
+
+class InFlightRequests(object):
+    """
+    Table of the requests that are currently executing
+
+    Requests stay in the table until their result is available, so requests
+    waiting for a Deferred or an awaitable are listed as well.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_id = 1
+
+        # entries by request id
+        self.requests = {}
+
+    def add(self, method, rpcinfo):
+        """
+        Add a request that starts executing
+
+        Args:
+            method (str): Name of the method
+            rpcinfo (dict): Information about the caller, the peer of the
+                            connection is taken from its 'peer' field
+
+        Returns:
+            int: Id of the request in the table
+        """
+        entry = {
+                'method': method,
+                'peer': rpcinfo.get('peer'),
+                'username': rpcinfo.get('username'),
+                'started': time.time(),
+                'start': timer(),
+                'waiting': False
+        }
+
+        with self.lock:
+            request_id = self.next_id
+            self.next_id += 1
+            self.requests[request_id] = entry
+
+        return request_id
+
+    def set_waiting(self, request_id):
+        """
+        Mark a request as waiting for a Deferred or an awaitable
+
+        Args:
+            request_id (int): Id returned by add
+        """
+        with self.lock:
+            entry = self.requests.get(request_id)
+
+            if entry is not None:
+                entry['waiting'] = True
+
+    def remove(self, request_id):
+        """
+        Remove a request once its result is available
+
+        Args:
+            request_id (int): Id returned by add
+        """
+        with self.lock:
+            self.requests.pop(request_id, None)
+
+    def remove_callback(self, value, request_id):
+        """
+        Callback or errback for Deferreds that removes a request
+
+        Returns:
+            any: value
+        """
+        self.remove(request_id)
+
+        return value
+
+    def count_by_method(self):
+        """
+        Count the requests in the table
+
+        Returns:
+            dict: Number of requests by method name
+        """
+        counts = {}
+
+        with self.lock:
+            for entry in self.requests.values():
+                counts[entry['method']] = counts.get(entry['method'], 0) + 1
+
+        return counts
+
+    def to_list(self):
+        """
+        Convert the table to a list
+
+        Returns:
+            list: Id, method, peer, username, start time (UNIX timestamp),
+                  elapsed seconds and waiting flag of each request, the
+                  longest running request first
+        """
+        now = timer()
+
+        with self.lock:
+            items = sorted(self.requests.items(), key=lambda i: i[1]['start'])
+
+        result = []
+        for request_id, entry in items:
+            result.append({
+                'id': request_id,
+                'method': entry['method'],
+                'peer': entry['peer'],
+                'username': entry['username'],
+                'started': entry['started'],
+                'elapsed': now - entry['start'],
+                'waiting': entry['waiting']
+            })
+
+        return result
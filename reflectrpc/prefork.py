@@ -0,0 +1,239 @@
+"""
+Pre-fork multi-process mode for servers
+
+The master process forks a number of workers that serve the same listening
+socket, either inherited from the master or opened by each worker with
+SO_REUSEPORT. The master does nothing but restart crashed workers and pass
+SIGTERM and SIGINT on to them. Everything built before the fork (like the
+RpcProcessor) is shared copy-on-write, gc.freeze keeps the garbage
+collector from touching and thereby copying these objects.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import errno
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+# workers that die sooner than this number of seconds after they were
+# started are restarted with a delay, so a broken worker doesn't fork-bomb
+min_worker_lifetime = 1.0
+
+def create_listening_socket(host, port, backlog=50, reuse_port=False,
+        unix_socket_mode=None):
+    """
+    Create a listening TCP or UNIX Domain Socket
+
+    Args:
+        host (str): Hostname or IP to listen on or the path of a UNIX Domain
+                    Socket prefixed with 'unix://'
+        port (int): TCP port to listen on
+        backlog (int): Number of connections the kernel queues
+        reuse_port (bool): Set SO_REUSEPORT so more than one process can bind
+                           the same TCP port
+        unix_socket_mode (int): File permission mode of a UNIX Domain Socket
+                                or None
+
+    Returns:
+        socket.socket: The listening socket
+
+    Raises:
+        ValueError: If SO_REUSEPORT is requested for a UNIX Domain Socket or
+                    not supported
+    """
+    unix_prefix = 'unix://'
+
+    if host.startswith(unix_prefix):
+        if reuse_port:
+            raise ValueError("SO_REUSEPORT is not supported for UNIX Domain Sockets")
+
+        path = host[len(unix_prefix):]
+        if os.path.exists(path):
+            os.unlink(path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+
+        if unix_socket_mode is not None:
+            os.chmod(path, unix_socket_mode)
+    else:
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError("SO_REUSEPORT is not supported on this platform")
+
+        info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        sock = socket.socket(info[0], socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        sock.bind(info[4])
+
+    sock.listen(backlog)
+    sock.setblocking(False)
+
+    return sock
+
+def describe_status(status):
+    """
+    Describe the status of a process returned by waitpid
+
+    Returns:
+        str: Exit code or the signal that killed the process
+    """
+    if os.WIFSIGNALED(status):
+        return "killed by signal %d" % (os.WTERMSIG(status))
+
+    return "exit code %d" % (os.WEXITSTATUS(status))
+
+class PreforkMaster(object):
+    """
+    Forks worker processes, restarts them when they die and stops them on
+    SIGTERM or SIGINT
+    """
+    def __init__(self, workers, run_worker, freeze_gc=True, grace_period=30.0):
+        """
+        Constructor
+
+        Args:
+            workers (int): Number of worker processes
+            run_worker (callable): Called with the number of the worker in
+                                   each forked process, serves requests until
+                                   the worker is told to stop
+            freeze_gc (bool): Call gc.freeze before forking (Python 3.7+)
+            grace_period (float): Seconds the workers get to finish their
+                                  requests after SIGTERM before they are
+                                  killed
+        """
+        self.workers = workers
+        self.run_worker = run_worker
+        self.freeze_gc = freeze_gc
+        self.grace_period = grace_period
+
+        # worker number and start time by PID
+        self.children = {}
+        self.stopping = False
+        self.stop_deadline = None
+
+    def run(self):
+        """
+        Fork the workers and supervise them until the master is told to stop
+
+        Returns:
+            int: Exit status for the master process
+        """
+        if self.freeze_gc and hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+
+        old_handlers = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            old_handlers[signum] = signal.signal(signum, self.handle_signal)
+
+        try:
+            for number in range(self.workers):
+                self.spawn(number)
+
+            self.supervise()
+        finally:
+            for signum, handler in old_handlers.items():
+                signal.signal(signum, handler)
+
+        return 0
+
+    def spawn(self, number):
+        """
+        Fork a worker process
+
+        Args:
+            number (int): Number of the worker (0 to workers - 1)
+        """
+        pid = os.fork()
+
+        if pid != 0:
+            self.children[pid] = (number, time.time())
+            return
+
+        # the worker stops on SIGTERM and SIGINT like a single process server
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        status = 1
+        try:
+            self.run_worker(number)
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except KeyboardInterrupt:
+            status = 0
+        except:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def handle_signal(self, signum, frame):
+        """
+        Tell all workers to stop
+        """
+        if self.stopping:
+            return
+
+        self.stopping = True
+        self.stop_deadline = time.time() + self.grace_period
+
+        for pid in list(self.children.keys()):
+            self.kill(pid, signal.SIGTERM)
+
+    def kill(self, pid, signum):
+        """
+        Send a signal to a worker that may already be gone
+        """
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def supervise(self):
+        """
+        Wait for workers to die and restart them unless the master stops
+
+        Once the master stops, workers that are still running after the
+        grace period are killed.
+        """
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+
+            if pid == 0:
+                if self.stopping and time.time() >= self.stop_deadline:
+                    for child in list(self.children.keys()):
+                        self.kill(child, signal.SIGKILL)
+
+                time.sleep(0.2)
+                continue
+
+            if pid not in self.children:
+                continue
+
+            number, started = self.children.pop(pid)
+
+            if self.stopping:
+                continue
+
+            print("Worker %d (PID %d) died (%s), restarting" %
+                    (number, pid, describe_status(status)), file=sys.stderr)
+
+            if time.time() - started < min_worker_lifetime:
+                time.sleep(min_worker_lifetime)
+
+            if not self.stopping:
+                self.spawn(number)
@@ -0,0 +1,277 @@
+"""
+Process pools for CPU-bound RPC functions
+
+Functions that are marked with RpcFunction.run_in_process_pool are executed in
+worker processes so they can use all cores of the host. The parameters and the
+result have to be picklable and the function has to be defined at module level
+(it is sent to the workers by reference).
+
+Workers are forked where the platform supports it, regardless of the default
+start method of multiprocessing (spawn on macOS, forkserver on newer Python
+versions), as long as the pool is started before the server runs any threads
+and its workers are kept forever. Forked workers see the state of the server
+at the time the pool was started, including functions defined in the main
+script.
+
+Forking a process that runs threads (e.g. those of the thread pools, the
+reactor or a profiler) can leave the child with locks that are never
+released. So pools that replace workers after max_tasks_per_child calls or
+that are started while other threads run use forkserver or spawn instead.
+Their workers import the functions, which therefore have to be importable,
+and the main script of the server has to be guarded by
+"if __name__ == '__main__':".
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+from reflectrpc import JsonRpcError
+from reflectrpc import JsonRpcInternalError
+
+def get_worker_context(max_tasks_per_child):
+    """
+    Get the multiprocessing context that starts the worker processes
+
+    Workers are only forked if the pool keeps them forever and the process
+    has no other threads yet, otherwise they are started by a fork server or
+    spawned.
+
+    Args:
+        max_tasks_per_child (int): Number of calls after which a worker is
+                                   replaced or None
+
+    Returns:
+        object: A multiprocessing context or the multiprocessing module
+                itself if the platform (or Python 2) doesn't support contexts
+    """
+    if max_tasks_per_child is None and threading.active_count() == 1:
+        methods = ('fork', 'forkserver', 'spawn')
+    else:
+        methods = ('forkserver', 'spawn')
+
+    for method in methods:
+        try:
+            return multiprocessing.get_context(method)
+        except AttributeError:
+            return multiprocessing
+        except ValueError:
+            pass
+
+    return multiprocessing
+
+def init_worker(initializer, initargs):
+    """
+    Prepare a new worker process and call the user's initializer
+
+    Forked workers inherit the signal handlers of the server (e.g. the ones
+    of the Twisted reactor), so they are reset to make the worker stop on
+    SIGTERM. SIGINT is ignored
+    because the server stops the workers itself.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if hasattr(signal, 'set_wakeup_fd'):
+        signal.set_wakeup_fd(-1)
+
+    if initializer is not None:
+        initializer(*initargs)
+
+def call_in_worker(func, params):
+    """
+    Call a function in a worker process
+
+    Exceptions are converted to picklable values since not all exception
+    classes can be pickled.
+
+    Returns:
+        tuple: ('result', value), ('error', error_dict) for a JsonRpcError or
+               ('internal', None) for all other exceptions
+    """
+    try:
+        return ('result', func(*params))
+    except JsonRpcError as e:
+        return ('error', e.to_dict())
+    except Exception:
+        traceback.print_exc()
+        return ('internal', None)
+
+def warm_up_worker(delay):
+    """
+    No-op task used to wait until all workers have run their initializer
+
+    Returns:
+        int: PID of the worker
+    """
+    time.sleep(delay)
+
+    return os.getpid()
+
+def worker_failed(error):
+    """
+    Handle an error of the pool itself (e.g. a result that can't be pickled)
+
+    Returns:
+        tuple: Value to pass to unpack_result
+    """
+    print(error, file=sys.stderr)
+
+    return ('internal', None)
+
+def unpack_result(value):
+    """
+    Convert the value returned by call_in_worker into a result or exception
+
+    Returns:
+        any: The result of the function
+
+    Raises:
+        JsonRpcError: If the function raised an error
+    """
+    kind, value = value
+
+    if kind == 'result':
+        return value
+
+    if kind == 'error':
+        error = JsonRpcError(value['message'])
+        error.name = value['name']
+        raise error
+
+    raise JsonRpcInternalError("Internal error")
+
+class ProcessPool(object):
+    """
+    Pool of worker processes to execute CPU-bound RPC functions in
+
+    The result of a call is returned in the form the running server can wait
+    for: a Deferred if the Twisted reactor is running, an asyncio Future if an
+    asyncio event loop is running and the plain result otherwise.
+    """
+    def __init__(self, processes=None, initializer=None, initargs=(),
+            max_tasks_per_child=None, warm_up=True):
+        """
+        Constructor
+
+        Args:
+            processes (int): Number of worker processes (defaults to the
+                             number of CPUs)
+            initializer (callable): Called with initargs in every new worker
+                                    (e.g. to load data or import modules)
+            initargs (tuple): Arguments for initializer
+            max_tasks_per_child (int): Number of calls after which a worker is
+                                       replaced by a fresh one or None to keep
+                                       workers forever
+            warm_up (bool): Wait until all workers have started and run the
+                            initializer when the pool is started
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        self.processes = processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.max_tasks_per_child = max_tasks_per_child
+        self.warm_up = warm_up
+        self.context = None
+        self.pool = None
+
+    def start(self):
+        """
+        Start the worker processes
+
+        Does nothing if the pool is already running.
+        """
+        if self.pool is not None:
+            return
+
+        self.context = get_worker_context(self.max_tasks_per_child)
+        self.pool = self.context.Pool(self.processes, init_worker,
+                (self.initializer, self.initargs), self.max_tasks_per_child)
+
+        if self.warm_up:
+            # every worker runs the initializer before it takes a task, a
+            # short delay makes sure the tasks are spread over all workers
+            self.pool.map(warm_up_worker, [0.01] * self.processes, 1)
+
+    def stop(self):
+        """
+        Stop all worker processes
+
+        Calls that are still running are aborted.
+        """
+        if self.pool is None:
+            return
+
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+    def apply(self, func, params):
+        """
+        Call a function in a worker process
+
+        Args:
+            func (callable): Function defined at module level
+            params (tuple): Parameters to pass to the function
+
+        Returns:
+            Deferred: If the Twisted reactor is running
+            Future: If an asyncio event loop is running
+            any: The result of the function otherwise
+        """
+        from reflectrpc.coroutines import get_running_loop, get_running_reactor
+
+        self.start()
+
+        reactor = get_running_reactor()
+        if reactor is not None:
+            defer = sys.modules['twisted.internet.defer']
+            d = defer.Deferred()
+
+            def deliver_to_deferred(value):
+                try:
+                    d.callback(unpack_result(value))
+                except Exception as e:
+                    d.errback(e)
+
+            self.pool.apply_async(call_in_worker, (func, params),
+                    callback=lambda value: reactor.callFromThread(deliver_to_deferred, value),
+                    error_callback=lambda e: reactor.callFromThread(deliver_to_deferred, worker_failed(e)))
+
+            return d
+
+        loop = get_running_loop()
+        if loop is not None:
+            future = loop.create_future()
+
+            def deliver_to_future(value):
+                if future.cancelled():
+                    return
+
+                try:
+                    future.set_result(unpack_result(value))
+                except Exception as e:
+                    future.set_exception(e)
+
+            self.pool.apply_async(call_in_worker, (func, params),
+                    callback=lambda value: loop.call_soon_threadsafe(deliver_to_future, value),
+                    error_callback=lambda e: loop.call_soon_threadsafe(deliver_to_future, worker_failed(e)))
+
+            return future
+
+        try:
+            value = self.pool.apply(call_in_worker, (func, params))
+        except Exception as e:
+            value = worker_failed(e)
+
+        return unpack_result(value)
@@ -0,0 +1,300 @@
+"""
+Sampling profiler for running servers
+
+The profiler runs in a background thread and periodically records the stacks
+of all other threads of the process. Every stack is attributed to the RPC
+method the thread was executing at the time, so the overhead on the profiled
+requests is a dictionary update per request. The samples can be exported as
+collapsed stacks (the input format of flame graph tools) or as a dump that
+can be loaded with the pstats module.
+"""
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import base64
+import marshal
+import sys
+import threading
+
+from reflectrpc.metrics import timer
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident
+
+# maximum number of frames recorded per stack
+max_stack_depth = 256
+
+def get_code_key(code):
+    """
+    Get the key identifying a function in pstats dumps
+
+    Returns:
+        tuple: Filename, first line number and name of the function
+    """
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+def format_function(key):
+    """
+    Format a function key as a frame of a collapsed stack
+
+    Returns:
+        str: Name of the function with its location
+    """
+    return '%s (%s:%d)' % (key[2], key[0], key[1])
+
+class SamplingProfiler(object):
+    """
+    Statistical profiler that samples the stacks of all threads
+
+    Threads register the RPC method they are executing with enter_method and
+    exit_method. Samples of threads that don't execute a method are attributed
+    to the name of the thread in brackets (e.g. '[MainThread]').
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # RPC method that is currently executed by thread id
+        self.methods = {}
+
+        # number of samples by (method, stack) with the stack as a tuple of
+        # function keys from the outermost to the innermost frame
+        self.stacks = {}
+
+        self.sample_count = 0
+        self.interval = 0.0
+        self.started = None
+        self.stopped = None
+
+        self.thread = None
+        self.stop_event = None
+
+    def is_running(self):
+        """
+        Check if the profiler is sampling
+
+        Returns:
+            bool: True if the sampling thread is running
+        """
+        return self.thread is not None
+
+    def start(self, seconds, rate, on_stop=None):
+        """
+        Discard the previous samples and start sampling
+
+        Args:
+            seconds (float): Number of seconds to sample
+            rate (int): Number of samples per second
+            on_stop (callable): Called without arguments once sampling stopped
+
+        Raises:
+            RuntimeError: If the profiler is already running
+        """
+        with self.lock:
+            if self.thread is not None:
+                raise RuntimeError("Profiler is already running")
+
+            self.stacks = {}
+            self.sample_count = 0
+            self.interval = 1.0 / rate
+            self.started = timer()
+            self.stopped = None
+            self.stop_event = threading.Event()
+
+            self.thread = threading.Thread(target=self.sample_loop,
+                    args=(seconds, self.stop_event, on_stop),
+                    name='reflectrpc-profiler')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stop sampling before the time given to start has passed
+        """
+        thread = self.thread
+        if thread is None:
+            return
+
+        self.stop_event.set()
+
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def sample_loop(self, seconds, stop_event, on_stop):
+        """
+        Take samples until the time is up or stop is called
+        """
+        deadline = timer() + seconds
+        own_id = get_ident()
+
+        while not stop_event.wait(self.interval) and timer() < deadline:
+            self.take_sample(own_id)
+
+        with self.lock:
+            self.stopped = timer()
+            self.thread = None
+
+        if on_stop is not None:
+            on_stop()
+
+    def take_sample(self, own_id):
+        """
+        Record the current stack of every thread except the sampling thread
+
+        Args:
+            own_id (int): Thread id of the sampling thread
+        """
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+
+        for thread_id, frame in list(sys._current_frames().items()):
+            if thread_id == own_id:
+                continue
+
+            method = self.methods.get(thread_id)
+            if method is None:
+                method = '[%s]' % (names.get(thread_id, thread_id))
+
+            stack = []
+            while frame is not None and len(stack) < max_stack_depth:
+                stack.append(get_code_key(frame.f_code))
+                frame = frame.f_back
+
+            stack.reverse()
+            key = (method, tuple(stack))
+
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+        self.sample_count += 1
+
+    def enter_method(self, method):
+        """
+        Attribute the samples of the current thread to an RPC method
+
+        Args:
+            method (str): Name of the method
+        """
+        self.methods[get_ident()] = method
+
+    def exit_method(self):
+        """
+        Stop attributing the samples of the current thread to an RPC method
+        """
+        self.methods.pop(get_ident(), None)
+
+    def wrap(self, method, func):
+        """
+        Wrap a function that is executed in another thread
+
+        Args:
+            method (str): Name of the RPC method
+            func (callable): The function to wrap
+
+        Returns:
+            callable: Function that attributes its samples to method
+        """
+        def call_with_method(*params):
+            self.enter_method(method)
+
+            try:
+                return func(*params)
+            finally:
+                self.exit_method()
+
+        return call_with_method
+
+    def to_collapsed(self):
+        """
+        Export the samples as collapsed stacks
+
+        Every line contains the frames of a stack separated by semicolons
+        (starting with the RPC method) followed by the number of samples.
+
+        Returns:
+            str: Collapsed stacks, one per line
+        """
+        lines = []
+
+        for (method, stack), count in sorted(list(self.stacks.items())):
+            frames = [method] + [format_function(key) for key in stack]
+            lines.append('%s %d' % (';'.join(frames), count))
+
+        return '\n'.join(lines)
+
+    def to_pstats(self):
+        """
+        Export the samples in the format of the pstats module
+
+        Every RPC method is added as a pseudo function with the filename
+        '<rpc>' that calls the outermost frames of its stacks. Call counts are
+        sample counts and times are estimated from the sampling interval.
+
+        Returns:
+            bytes: Data to write to a file that can be loaded with pstats.Stats
+        """
+        stats = {}
+
+        def get_entry(key):
+            entry = stats.get(key)
+
+            if entry is None:
+                entry = [0, 0, 0.0, 0.0, {}]
+                stats[key] = entry
+
+            return entry
+
+        for (method, stack), count in list(self.stacks.items()):
+            stack = (('<rpc>', 0, method),) + stack
+            seconds = count * self.interval
+
+            # self time is attributed to the innermost frame only
+            get_entry(stack[-1])[2] += seconds
+
+            # recursive functions are counted once per sample
+            for key in set(stack):
+                entry = get_entry(key)
+                entry[0] += count
+                entry[1] += count
+                entry[3] += seconds
+
+            for caller, callee in set(zip(stack, stack[1:])):
+                callers = get_entry(callee)[4]
+                callers[caller] = callers.get(caller, 0) + count
+
+        return marshal.dumps(dict((key, tuple(entry)) for key, entry in stats.items()))
+
+    def get_profile(self, output_format='collapsed'):
+        """
+        Get the samples and some information about the profiling run
+
+        Args:
+            output_format (str): 'collapsed' for collapsed stacks or 'pstats'
+                                 for a base64 encoded pstats dump
+
+        Returns:
+            dict: Running state, number of samples, sampling interval and
+                  duration in seconds and the exported samples as 'data'
+
+        Raises:
+            ValueError: If output_format is unknown
+        """
+        if output_format == 'collapsed':
+            data = self.to_collapsed()
+        elif output_format == 'pstats':
+            data = base64.b64encode(self.to_pstats()).decode('ascii')
+        else:
+            raise ValueError("Unknown profile format: %s" % (output_format))
+
+        duration = 0.0
+        if self.started is not None:
+            duration = (self.stopped or timer()) - self.started
+
+        return {
+                'running': self.is_running(),
+                'samples': self.sample_count,
+                'interval': self.interval,
+                'duration': duration,
+                'format': output_format,
+                'data': data
+        }
@@ -0,0 +1,156 @@
+"""
+Metrics of an RpcProcessor in the Prometheus text exposition format
+
+The metrics are generated one family at a time, so servers can send each
+chunk as soon as it is rendered instead of building the whole page first.
+"""
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+content_type = b'text/plain; version=0.0.4; charset=utf-8'
+
+def escape_label_value(value):
+    """
+    Escape a label value for the text exposition format
+
+    Returns:
+        str: Value with backslashes, double quotes and newlines escaped
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_value(value):
+    """
+    Format a sample value
+
+    Returns:
+        str: Integer values without a fraction, '+Inf' for infinity
+    """
+    if value == float('inf'):
+        return '+Inf'
+
+    if isinstance(value, int):
+        return str(value)
+
+    return repr(float(value))
+
+def format_labels(labels):
+    """
+    Format a list of (name, value) pairs as label set
+
+    Returns:
+        str: Label set in curly braces or an empty string
+    """
+    if not labels:
+        return ''
+
+    return '{' + ','.join('%s="%s"' % (name, escape_label_value(value))
+        for name, value in labels) + '}'
+
+def render_family(name, metric_type, help_text, samples):
+    """
+    Render a metric family
+
+    Args:
+        name (str): Name of the metric
+        metric_type (str): 'counter', 'gauge' or 'histogram'
+        help_text (str): Description of the metric
+        samples (list): Tuples of suffix, labels and value of each sample
+
+    Returns:
+        bytes: UTF-8 encoded lines of the family
+    """
+    lines = ['# HELP %s %s' % (name, help_text),
+            '# TYPE %s %s' % (name, metric_type)]
+
+    for suffix, labels, value in samples:
+        lines.append('%s%s%s %s' % (name, suffix, format_labels(labels),
+            format_value(value)))
+
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def histogram_samples(histogram, labels):
+    """
+    Convert a histogram to the samples of a Prometheus histogram
+
+    Args:
+        histogram (dict): Histogram as returned by LatencyHistogram.to_dict
+        labels (list): Labels of the histogram
+
+    Returns:
+        list: Cumulative bucket samples, sum and count
+    """
+    samples = []
+    cumulative = 0
+
+    for bound, count in zip(histogram['bounds'], histogram['counts']):
+        cumulative += count
+        samples.append(('_bucket', labels + [('le', format_value(bound))], cumulative))
+
+    samples.append(('_bucket', labels + [('le', '+Inf')], histogram['count']))
+    samples.append(('_sum', labels, histogram['sum']))
+    samples.append(('_count', labels, histogram['count']))
+
+    return samples
+
+def generate_metrics(rpcprocessor, connections=None):
+    """
+    Generate the metrics of an RpcProcessor family by family
+
+    Args:
+        rpcprocessor (RpcProcessor): Processor whose metrics are rendered
+        connections (int): Number of open client connections or None if the
+                           server doesn't count them
+
+    Returns:
+        generator: UTF-8 encoded chunks of the exposition
+    """
+    if rpcprocessor.metrics_enabled:
+        methods = sorted(rpcprocessor.metrics.get_method_metrics().items())
+
+        yield render_family('reflectrpc_requests_total', 'counter',
+                'Number of calls by method',
+                [('', [('method', name)], m.calls) for name, m in methods])
+
+        errors = []
+        for name, m in methods:
+            for error_name, count in sorted(m.errors.items()):
+                errors.append(('', [('method', name), ('error', error_name)], count))
+
+        yield render_family('reflectrpc_errors_total', 'counter',
+                'Number of failed calls by method and error', errors)
+
+        samples = []
+        for name, m in methods:
+            samples.extend(histogram_samples(m.latency.to_dict(), [('method', name)]))
+
+        yield render_family('reflectrpc_request_duration_seconds', 'histogram',
+                'Time until the result of a call was available', samples)
+
+    in_flight = rpcprocessor.in_flight
+    if in_flight is not None:
+        counts = sorted(in_flight.count_by_method().items())
+
+        yield render_family('reflectrpc_in_flight_requests', 'gauge',
+                'Number of requests that are currently executing by method',
+                [('', [('method', name)], count) for name, count in counts])
+
+    if connections is not None:
+        yield render_family('reflectrpc_connections', 'gauge',
+                'Number of open client connections', [('', [], connections)])
+
+    lag_monitor = rpcprocessor.lag_monitor
+    if lag_monitor is not None:
+        lag = lag_monitor.to_dict()
+
+        yield render_family('reflectrpc_event_loop_lag_seconds', 'histogram',
+                'Delay of the event loop running a periodic timer',
+                histogram_samples(lag['lag'], []))
+
+        yield render_family('reflectrpc_event_loop_lag_max_seconds', 'gauge',
+                'Maximum delay of the event loop', [('', [], lag['max'])])
+
+        yield render_family('reflectrpc_event_loop_blocked_total', 'counter',
+                'Number of times the lag was over the threshold by the method that caused it',
+                [('', [('method', name)], stats['count'])
+                    for name, stats in sorted(lag['methods'].items())])
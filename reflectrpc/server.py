@@ -1,17 +1,71 @@
 from __future__ import unicode_literals
 from builtins import bytes, dict, list, int, float, str
 
-import json
-
 from abc import ABCMeta, abstractmethod
 
+from reflectrpc import is_awaitable, is_deferred
+from reflectrpc import JsonRpcInternalError
+from reflectrpc import JsonRpcInvalidRequest
+from reflectrpc.metrics import timer
+
+def format_address(address):
+    """
+    Format a socket address as returned by accept or getpeername
+
+    Args:
+        address (tuple|str): IP address and port or path of a UNIX Domain
+                             Socket
+
+    Returns:
+        str: Address as 'host:port' ('[host]:port' for IPv6) or the path
+    """
+    if isinstance(address, tuple):
+        if ':' in address[0]:
+            return '[%s]:%d' % (address[0], address[1])
+
+        return '%s:%d' % (address[0], address[1])
+
+    return str(address)
+
+# longest message a client may send if the server doesn't set a limit
+default_max_line_length = 16 * 1024 * 1024
+
+def import_ijson():
+    """
+    Import ijson, which is used to decode large messages incrementally
+
+    Returns:
+        module: The ijson module
+
+    Raises:
+        ValueError: If ijson is not installed
+    """
+    try:
+        import ijson
+    except ImportError:
+        raise ValueError("Incremental decoding requires the ijson module")
+
+    return ijson
+
+# replies of pipelined requests are sent together until they are this long
+default_flush_threshold = 64 * 1024
+
+class LineTooLongError(Exception):
+    """
+    Raised by data_received when a client sends a line that is longer than
+    the maximum line length, the server should close the connection
+    """
+    pass
+
 class AbstractJsonRpcServer(object):
     """
     Abstract base class for line based JSON-RPC servers
     """
     __metaclass__=ABCMeta
 
-    def __init__(self, rpcprocessor, conn, rpcinfo=None):
+    def __init__(self, rpcprocessor, conn, rpcinfo=None,
+            max_line_length=default_max_line_length,
+            flush_threshold=default_flush_threshold):
         """
         Constructor
 
@@ -19,32 +73,431 @@ class AbstractJsonRpcServer(object):
             rpcprocessor (RpcProcessor): RpcProcessor with the RPCs to be served
             conn (any): An abstract connection object to be used in the user
                         implemented send_data method
+            rpcinfo (dict): Information about the client passed to the RPC
+                            functions (e.g. the 'peer' address)
+            max_line_length (int): Maximum length of a message in bytes or
+                                   None for no limit
+            flush_threshold (int): Number of bytes of replies collected while
+                                   processing received data before they are
+                                   sent or None to send each reply at once
         """
-        self.buf = ''
+        self.buf = bytearray()
+        # position in buf up to which we already searched for a linebreak
+        self.scanned = 0
         self.rpcprocessor = rpcprocessor
         self.conn = conn
         self.rpcinfo = rpcinfo
+        self.max_line_length = max_line_length
+        self.flush_threshold = flush_threshold
+        self.loop = None
+
+        # replies collected while processing received data
+        self.pending = None
+        self.pending_size = 0
+
+        # incremental decoding of large messages
+        self.stream_threshold = None
+        self.parser = None
+        self.parsed = None
+        self.parser_errors = ()
+        self.parse_failed = False
+        self.streamed = 0
+        self.decode_time = 0.0
+
+    def enable_incremental_decoding(self, threshold=256 * 1024):
+        """
+        Decode large messages incrementally while they arrive
+
+        Once the incomplete message in the buffer is longer than threshold it
+        is passed to an incremental JSON parser (ijson), the rest of it follows
+        in chunks of threshold bytes. The work of decoding is spread over the
+        reads and the raw message is not kept in memory next to the decoded
+        one. Smaller messages are still decoded by the codec of the
+        RpcProcessor, which is faster.
+
+        Args:
+            threshold (int): Length in bytes from which on a message is decoded
+                             incrementally and size of the chunks passed to the
+                             parser
+
+        Raises:
+            ValueError: If ijson is not installed
+        """
+        import_ijson()
+
+        self.stream_threshold = threshold
 
     def data_received(self, data):
-        self.buf += data.decode('utf-8')
+        """
+        Process all messages completed by the received data
+
+        Data is appended to a buffer and only the new part of the buffer is
+        searched for linebreaks, so the time needed for framing is linear in
+        the amount of data even if a message arrives in many small chunks.
+
+        The replies that are available right away are collected and sent with
+        a single call of send_data_sequence once all messages are processed
+        or flush_threshold bytes have been collected. A client that pipelines
+        requests gets fewer and fuller packets this way.
+
+        Args:
+            data (bytes): Data received from the client
+
+        Raises:
+            LineTooLongError: If a message is longer than max_line_length (an
+                              error reply was already sent)
+        """
+        if self.flush_threshold is None:
+            self.process_data(data)
+            return
+
+        self.pending = []
+        try:
+            self.process_data(data)
+        finally:
+            self.flush_replies()
+            self.pending = None
+
+    def process_data(self, data):
+        """
+        Frame and process received data
+
+        Args:
+            data (bytes): Data received from the client
+
+        Raises:
+            LineTooLongError: If a message is longer than max_line_length
+        """
+        # the time spent on framing a message is measured from the arrival
+        # of the data (or the end of the previous message) to its processing
+        timing_enabled = self.rpcprocessor.phase_timing_enabled
+        if timing_enabled:
+            framing_start = timer()
+
+        if self.parser is not None:
+            data = self.stream_data(data)
+            if data is None:
+                return
+
+            if timing_enabled:
+                self.handle_reply(self.finish_parser(timer() - framing_start))
+                framing_start = timer()
+            else:
+                self.handle_reply(self.finish_parser())
+
+        for line in self.split_lines(data):
+            if timing_enabled:
+                reply = self.rpcprocessor.process_message(line,
+                        self.rpcinfo, timer() - framing_start)
+                framing_start = timer()
+            else:
+                reply = self.rpcprocessor.process_message(line, self.rpcinfo)
+
+            self.handle_reply(reply)
+
+        if self.stream_threshold is not None and \
+                len(self.buf) > self.stream_threshold:
+            self.start_parser()
+
+    def handle_reply(self, reply):
+        """
+        Send a reply returned by the RpcProcessor once it is available
+
+        Args:
+            reply (bytes|Deferred|awaitable|None): Encoded reply
+        """
+        # in case of a notification request (or a batch of them)
+        # process_message returns None and we send no reply back
+        if reply is None:
+            return
+
+        if is_deferred(reply):
+            reply.addCallbacks(self.send_reply, self.deferred_reply_failed)
+        elif is_awaitable(reply):
+            self.run_awaitable(reply)
+        else:
+            self.send_reply(reply)
+
+    def split_lines(self, data):
+        """
+        Append data to the buffer and take the complete lines out of it
+
+        Args:
+            data (bytes): Data received from the client
+
+        Returns:
+            list: Complete lines as bytes without the linebreak
+
+        Raises:
+            LineTooLongError: If a line is longer than max_line_length
+        """
+        buf = self.buf
+        buf += data
+
+        lines = []
+        start = 0
+        end = buf.find(b'\n', self.scanned)
+
+        if end != -1:
+            with memoryview(buf) as view:
+                while end != -1:
+                    line_end = end
+                    if line_end > start and buf[line_end - 1] == 0x0d:
+                        line_end -= 1
+
+                    if self.max_line_length is not None and \
+                            line_end - start > self.max_line_length:
+                        self.line_length_exceeded()
+
+                    lines.append(view[start:line_end].tobytes())
+                    start = end + 1
+                    end = buf.find(b'\n', start)
+
+            del buf[:start]
+
+        self.scanned = len(buf)
+
+        if self.max_line_length is not None and len(buf) > self.max_line_length:
+            self.line_length_exceeded()
+
+        return lines
+
+    def stream_data(self, data):
+        """
+        Pass received data on to the parser of a message that is decoded
+        incrementally
+
+        The data is collected until there are stream_threshold bytes or the
+        message is complete. Passing larger chunks to the parser is faster,
+        especially for long strings which the parser scans again from their
+        beginning with every chunk.
+
+        Args:
+            data (bytes): Data received from the client
 
-        count = self.buf.count("\n")
-        if count > 0:
-            lines = self.buf.splitlines()
+        Returns:
+            bytes: Data after the end of the message or None if the message
+                   is not complete yet
+        """
+        end = data.find(b'\n')
+        if end == -1:
+            self.buf += data
+            if len(self.buf) >= self.stream_threshold:
+                self.feed_parser(self.buf)
+                self.buf = bytearray()
+
+            return None
+
+        self.buf += memoryview(data)[:end]
+        self.feed_parser(self.buf)
+        self.buf = bytearray()
+
+        return data[end + 1:]
+
+    def start_parser(self):
+        """
+        Start to decode the incomplete message in the buffer incrementally
+        """
+        ijson = import_ijson()
+
+        self.parsed = ijson.sendable_list()
+        self.parser = ijson.items_coro(self.parsed, '', use_float=True)
+        # exceptions the parser raises for invalid JSON
+        self.parser_errors = (ijson.JSONError, ValueError)
+        self.parse_failed = False
+        self.streamed = 0
+        self.decode_time = 0.0
+
+        self.feed_parser(self.buf)
+        self.buf = bytearray()
+        self.scanned = 0
+
+    def feed_parser(self, data):
+        """
+        Pass a chunk of the message that is decoded incrementally to the parser
+
+        Args:
+            data (bytes|bytearray|memoryview): Part of the message
+
+        Raises:
+            LineTooLongError: If the message is longer than max_line_length
+        """
+        self.streamed += len(data)
+        if self.max_line_length is not None and self.streamed > self.max_line_length:
+            self.line_length_exceeded()
+
+        # after a syntax error the rest of the message is skipped
+        if self.parse_failed:
+            return
+
+        start = timer()
+        try:
+            self.parser.send(data)
+        except self.parser_errors:
+            self.parse_failed = True
+        finally:
+            self.decode_time += timer() - start
+
+    def finish_parser(self, framing_time=None):
+        """
+        Finish decoding a message incrementally and process it
 
-            for i in range(count):
-                line = lines.pop(0)
-                reply = self.rpcprocessor.process_request(line, self.rpcinfo)
+        Args:
+            framing_time (float): Seconds spent on framing the last part of the
+                                  message (only used for phase timing)
+
+        Returns:
+            bytes|Deferred|awaitable|None: Encoded reply
+        """
+        parser = self.parser
+        parsed = self.parsed
+        failed = self.parse_failed
+        self.parser = None
+        self.parsed = None
+
+        if not failed:
+            start = timer()
+            try:
+                parser.close()
+            except self.parser_errors:
+                failed = True
+            finally:
+                self.decode_time += timer() - start
+
+        if failed or not parsed:
+            return self.error_reply("Received invalid JSON")
+
+        return self.rpcprocessor.process_decoded_message(parsed[0],
+                self.rpcinfo, framing_time, self.decode_time)
+
+    def error_reply(self, message):
+        """
+        Encode a reply for a message that could not be processed
+
+        Args:
+            message (str): Error message
+
+        Returns:
+            bytes: UTF-8 encoded JSON-RPC reply with an InvalidRequest error
+        """
+        error = JsonRpcInvalidRequest(message)
+
+        return self.rpcprocessor.encode_reply({'id': -1, 'result': None,
+            'error': error.to_dict()})
+
+    def deferred_reply_failed(self, failure):
+        """
+        Send an InternalError reply if a Deferred reply failed
+
+        The RpcProcessor handles the errors of RPC functions itself, so this
+        only happens in case of a bug (e.g. while encoding the reply).
+
+        Args:
+            failure (Failure): The error of the Deferred
+        """
+        failure.printTraceback()
 
-                # in case of a notification request process_request returns None
-                # and we send no reply back
-                if reply:
-                    reply_line = json.dumps(reply) + "\r\n"
-                    self.send_data(reply_line.encode("utf-8"))
+        error = JsonRpcInternalError("Internal error")
+        self.send_reply(self.rpcprocessor.encode_reply({'id': -1,
+            'result': None, 'error': error.to_dict()}))
 
-            self.buf = ''
-            if lines:
-                self.buf = lines[0]
+    def line_length_exceeded(self):
+        """
+        Send an error reply and drop the buffered data of an overlong line
+
+        Raises:
+            LineTooLongError: Always
+        """
+        self.buf = bytearray()
+        self.scanned = 0
+        self.parser = None
+        self.parsed = None
+
+        self.send_reply(self.error_reply("Message is longer than %d bytes" %
+            (self.max_line_length)))
+
+        raise LineTooLongError("Client sent a message longer than %d bytes" %
+                (self.max_line_length))
+
+    def run_awaitable(self, reply):
+        """
+        Run an awaitable returned by process_message and send its reply
+
+        The default implementation blocks until the awaitable is done by
+        running it on a private asyncio event loop. Override this method to
+        schedule it on the event loop of your server instead.
+
+        Args:
+            reply (awaitable): Awaitable that returns the encoded reply or None
+        """
+        import asyncio
+
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+
+        reply = self.loop.run_until_complete(reply)
+
+        if reply is not None:
+            self.send_reply(reply)
+
+    def connection_lost(self):
+        """
+        Release the resources of the connection, call this once the connection
+        was closed
+        """
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
+
+        self.parser = None
+        self.parsed = None
+
+    def send_reply(self, reply):
+        """
+        Send an encoded reply to the client as a line
+
+        Args:
+            reply (bytes): UTF-8 encoded JSON-RPC reply
+        """
+        if reply is None:
+            return
+
+        if self.pending is None:
+            self.send_data(reply + b"\r\n")
+            return
+
+        self.pending.append(reply)
+        self.pending.append(b"\r\n")
+        self.pending_size += len(reply) + 2
+
+        if self.pending_size >= self.flush_threshold:
+            self.flush_replies()
+
+    def flush_replies(self):
+        """
+        Send the collected replies
+        """
+        if not self.pending:
+            return
+
+        pending = self.pending
+        self.pending = []
+        self.pending_size = 0
+
+        self.send_data_sequence(pending)
+
+    def send_data_sequence(self, chunks):
+        """
+        Send a list of byte strings to the client
+
+        The default implementation joins them and calls send_data. Override
+        this method if your transport can send a sequence of buffers without
+        copying them (e.g. with writev or sendmsg).
+
+        Args:
+            chunks (list): Byte strings to send in order
+        """
+        self.send_data(b''.join(chunks))
 
     """
     Abstract method you must override to send a reply back to the client
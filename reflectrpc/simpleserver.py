@@ -6,9 +6,21 @@ import os
 import sys
 import json
 import socket
+import traceback
 
 import reflectrpc.server
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# stop reading from a connection while more reply data than this is unsent
+max_output_buffer = 1024 * 1024
+
+# maximum number of buffers passed to sendmsg at once (IOV_MAX on Linux)
+max_send_buffers = 1024
+
 if sys.version_info.major == 2:
     class ConnectionResetError(Exception):
         pass
@@ -20,6 +32,27 @@ class JsonRpcServer(reflectrpc.server.AbstractJsonRpcServer):
     def send_data(self, data):
         self.conn.sendall(data)
 
+    def send_data_sequence(self, chunks):
+        # sendmsg sends all replies with a single system call
+        if not hasattr(self.conn, 'sendmsg'):
+            self.conn.sendall(b''.join(chunks))
+            return
+
+        buffers = [memoryview(chunk) for chunk in chunks]
+        start = 0
+
+        while start < len(buffers):
+            sent = self.conn.sendmsg(buffers[start:start + max_send_buffers])
+
+            # skip the buffers that were sent completely and cut off the sent
+            # part of the last one
+            while start < len(buffers) and sent >= len(buffers[start]):
+                sent -= len(buffers[start])
+                start += 1
+
+            if sent:
+                buffers[start] = buffers[start][sent:]
+
 class SimpleJsonRpcServer(object):
     """
     Simple JSON-RPC server for line-terminated messages
@@ -38,6 +71,28 @@ class SimpleJsonRpcServer(object):
         self.rpcprocessor = rpcprocessor
         self.host = host
         self.port = port
+        self.max_line_length = reflectrpc.server.default_max_line_length
+        self.flush_threshold = reflectrpc.server.default_flush_threshold
+
+    def set_max_line_length(self, length):
+        """
+        Sets the maximum length of a message, clients that send longer
+        messages get an error reply and are disconnected
+
+        Args:
+            length (int): Maximum message length in bytes or None for no limit
+        """
+        self.max_line_length = length
+
+    def set_flush_threshold(self, size):
+        """
+        Sets how many bytes of replies to pipelined requests are collected
+        before they are sent together
+
+        Args:
+            size (int): Number of bytes or None to send every reply at once
+        """
+        self.flush_threshold = size
 
     def run(self):
         """
@@ -52,20 +107,30 @@ class SimpleJsonRpcServer(object):
             print("ERROR: " + e.strerror, file=sys.stderr)
             sys.exit(1)
 
+        self.rpcprocessor.start_process_pools()
+
         self.socket.listen(10)
         print("Listening on %s:%d" % (self.host, self.port))
 
-        while 1:
-            conn, addr = self.socket.accept()
-            self.server = JsonRpcServer(self.rpcprocessor, conn)
+        try:
+            while 1:
+                conn, addr = self.socket.accept()
+                rpcinfo = {'authenticated': False, 'username': None,
+                        'peer': reflectrpc.server.format_address(addr)}
+                self.server = JsonRpcServer(self.rpcprocessor, conn, rpcinfo,
+                        self.max_line_length, self.flush_threshold)
 
-            try:
-                self.__handle_connection(conn)
-            except ConnectionResetError:
-                pass
-            except UnicodeDecodeError as e:
-                print(e)
-                conn.close()
+                try:
+                    self.__handle_connection(conn)
+                except ConnectionResetError:
+                    pass
+                except reflectrpc.server.LineTooLongError as e:
+                    print(e)
+                    conn.close()
+                finally:
+                    self.server.connection_lost()
+        finally:
+            self.rpcprocessor.stop_process_pools()
 
     def __handle_connection(self, conn):
         """
@@ -76,3 +141,311 @@ class SimpleJsonRpcServer(object):
         while data:
             self.server.data_received(data)
             data = conn.recv(4096)
+
+class BufferedJsonRpcServer(reflectrpc.server.AbstractJsonRpcServer):
+    """
+    Implementation of AbstractJsonRpcServer that collects the replies in a
+    buffer which the event loop of ConcurrentJsonRpcServer sends
+    """
+    def __init__(self, rpcprocessor, conn, rpcinfo=None,
+            max_line_length=reflectrpc.server.default_max_line_length,
+            flush_threshold=reflectrpc.server.default_flush_threshold):
+        reflectrpc.server.AbstractJsonRpcServer.__init__(self, rpcprocessor,
+                conn, rpcinfo, max_line_length, flush_threshold)
+        self.outbuf = bytearray()
+        self.busy = False
+        self.failed = False
+        self.events = 0
+
+    def send_data(self, data):
+        self.outbuf += data
+
+    def send_data_sequence(self, chunks):
+        for chunk in chunks:
+            self.outbuf += chunk
+
+class ConcurrentJsonRpcServer(object):
+    """
+    JSON-RPC server for line-terminated messages that serves many connections
+    at the same time
+
+    Connections are multiplexed with the selectors module. By default the
+    messages are processed in the event loop thread, so RPC functions should
+    not block. With max_threads the messages are processed by a bounded pool
+    of worker threads instead, the messages of one connection are still
+    processed in order.
+    """
+    def __init__(self, rpcprocessor, host, port, max_threads=None):
+        """
+        Constructor
+
+        Args:
+            rpcprocessor (RpcProcessor): RPC implementation
+            host (str): Hostname or IP to listen on
+            port (int): TCP port to listen on
+            max_threads (int): Number of worker threads or None to process
+                               messages in the event loop thread
+        """
+        self.rpcprocessor = rpcprocessor
+        self.host = host
+        self.port = port
+        self.max_threads = max_threads
+        self.max_line_length = reflectrpc.server.default_max_line_length
+        self.flush_threshold = reflectrpc.server.default_flush_threshold
+
+        self.selector = None
+        self.executor = None
+        self.socket = None
+
+        # connections whose worker finished, handed over to the event loop
+        self.finished = queue.Queue()
+        self.wakeup_receiver = None
+        self.wakeup_sender = None
+
+    def set_max_line_length(self, length):
+        """
+        Sets the maximum length of a message, clients that send longer
+        messages get an error reply and are disconnected
+
+        Args:
+            length (int): Maximum message length in bytes or None for no limit
+        """
+        self.max_line_length = length
+
+    def set_flush_threshold(self, size):
+        """
+        Sets how many bytes of replies to pipelined requests are collected
+        before they are sent together
+
+        Args:
+            size (int): Number of bytes or None to send every reply at once
+        """
+        self.flush_threshold = size
+
+    def run(self):
+        """
+        Start the server and listen on host:port
+        """
+        import selectors
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        try:
+            self.socket.bind((self.host, self.port))
+        except OSError as e:
+            print("ERROR: " + e.strerror, file=sys.stderr)
+            sys.exit(1)
+
+        self.rpcprocessor.start_process_pools()
+
+        self.socket.listen(128)
+        self.socket.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+
+        if self.max_threads:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self.executor = ThreadPoolExecutor(self.max_threads)
+            self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+            self.wakeup_receiver.setblocking(False)
+            self.selector.register(self.wakeup_receiver, selectors.EVENT_READ)
+
+        print("Listening on %s:%d" % (self.host, self.port))
+
+        try:
+            while 1:
+                for key, mask in self.selector.select():
+                    if key.fileobj is self.socket:
+                        self.accept()
+                    elif key.fileobj is self.wakeup_receiver:
+                        self.collect_finished()
+                    else:
+                        self.handle_events(key.data, mask)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """
+        Close all connections and stop the worker threads
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+        for key in list(self.selector.get_map().values()):
+            if isinstance(key.data, BufferedJsonRpcServer):
+                self.close_connection(key.data)
+
+        self.selector.close()
+        self.socket.close()
+
+        if self.wakeup_receiver is not None:
+            self.wakeup_receiver.close()
+            self.wakeup_sender.close()
+
+        self.rpcprocessor.stop_process_pools()
+
+    def accept(self):
+        """
+        Accept a new connection
+        """
+        try:
+            conn, addr = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        conn.setblocking(False)
+
+        rpcinfo = {'authenticated': False, 'username': None,
+                'peer': reflectrpc.server.format_address(addr)}
+        server = BufferedJsonRpcServer(self.rpcprocessor, conn, rpcinfo,
+                self.max_line_length, self.flush_threshold)
+        self.update_events(server)
+
+    def update_events(self, server):
+        """
+        Register the events a connection waits for with the selector
+
+        A connection is read from unless a worker processes its messages or
+        too much of its reply data is unsent. It waits for writability as
+        long as there is unsent reply data. While a worker appends replies
+        to the output buffer the event loop leaves it alone, the remaining
+        data is sent once collect_finished hands the connection back.
+        """
+        import selectors
+
+        events = 0
+        if not server.busy and not server.failed and \
+                len(server.outbuf) < max_output_buffer:
+            events |= selectors.EVENT_READ
+        if server.outbuf and not server.busy:
+            events |= selectors.EVENT_WRITE
+
+        if events == server.events:
+            return
+
+        if server.events == 0:
+            self.selector.register(server.conn, events, server)
+        elif events == 0:
+            self.selector.unregister(server.conn)
+        else:
+            self.selector.modify(server.conn, events, server)
+
+        server.events = events
+
+    def handle_events(self, server, mask):
+        """
+        Read from or write to a connection that is ready
+        """
+        import selectors
+
+        # a worker might have taken over since the events were selected
+        if server.busy:
+            return
+
+        if mask & selectors.EVENT_WRITE:
+            if not self.flush(server):
+                return
+
+        if mask & selectors.EVENT_READ:
+            try:
+                data = server.conn.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except (ConnectionResetError, OSError):
+                data = b''
+
+            if not data:
+                self.close_connection(server)
+                return
+
+            if self.executor is not None:
+                server.busy = True
+                self.update_events(server)
+                self.executor.submit(self.process_data, server, data)
+                return
+
+            try:
+                server.data_received(data)
+            except reflectrpc.server.LineTooLongError as e:
+                print(e)
+                server.failed = True
+
+            self.flush(server)
+
+    def process_data(self, server, data):
+        """
+        Process the received data of a connection in a worker thread
+        """
+        try:
+            server.data_received(data)
+        except reflectrpc.server.LineTooLongError as e:
+            print(e)
+            server.failed = True
+        except Exception:
+            traceback.print_exc()
+            server.failed = True
+        finally:
+            self.finished.put(server)
+            self.wakeup_sender.send(b'\0')
+
+    def collect_finished(self):
+        """
+        Continue with the connections whose workers are done
+        """
+        try:
+            while self.wakeup_receiver.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        while 1:
+            try:
+                server = self.finished.get_nowait()
+            except queue.Empty:
+                return
+
+            server.busy = False
+            self.flush(server)
+
+    def flush(self, server):
+        """
+        Send as much of the reply data of a connection as possible
+
+        Connections that received invalid data are closed once their replies
+        are sent.
+
+        Returns:
+            bool: False if the connection was closed
+        """
+        if server.outbuf:
+            try:
+                sent = server.conn.send(server.outbuf)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.close_connection(server)
+                return False
+
+            del server.outbuf[:sent]
+
+        if server.failed and not server.outbuf:
+            self.close_connection(server)
+            return False
+
+        self.update_events(server)
+
+        return True
+
+    def close_connection(self, server):
+        """
+        Close a connection and release its resources
+        """
+        if server.events != 0:
+            self.selector.unregister(server.conn)
+            server.events = 0
+
+        server.conn.close()
+        server.connection_lost()
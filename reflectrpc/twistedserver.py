@@ -1,9 +1,12 @@
+from __future__ import print_function
 from __future__ import unicode_literals
 from builtins import bytes, dict, list, int, float, str
 
+import io
+import multiprocessing
 import os
+import socket
 import sys
-import json
 
 from zope.interface import implementer
 from twisted.internet import defer
@@ -14,13 +17,21 @@ from twisted.web.resource import IResource
 from twisted.web.resource import NoResource
 from twisted.web import server, resource
 from twisted.internet.protocol import Protocol, Factory
-from twisted.internet import reactor, ssl
+from twisted.internet import ssl, task, tcp, threads, unix
 from twisted.python import log
 from twisted.internet.defer import Deferred
-from twisted.protocols.basic import LineReceiver
+from twisted.protocols.policies import WrappingFactory
 from twisted.web.server import NOT_DONE_YET
+from twisted.python.threadpool import ThreadPool
 
+import reflectrpc.prefork
+import reflectrpc.prometheus
 import reflectrpc.server
+from reflectrpc import is_awaitable
+from reflectrpc import JsonRpcInternalError
+from reflectrpc import JsonRpcInvalidRequest
+from reflectrpc import JsonRpcServerBusy
+from reflectrpc.metrics import LagMonitor
 
 class PasswordChecker(object):
     credentialInterfaces = (credentials.IUsernamePassword,)
@@ -62,43 +73,76 @@ class HttpPasswordRealm(object):
             return (IResource, self.resource, lambda: None)
         raise NotImplementedError()
 
-class JsonRpcProtocol(LineReceiver):
+def format_peer(address):
+    """
+    Format the address of a Twisted transport peer
+
+    Args:
+        address (IAddress): Address returned by transport.getPeer()
+
+    Returns:
+        str: Address as 'host:port' or the name of the UNIX Domain Socket
+    """
+    if hasattr(address, 'host') and hasattr(address, 'port'):
+        return reflectrpc.server.format_address((address.host, address.port))
+
+    name = getattr(address, 'name', None)
+    if isinstance(name, bytes):
+        name = name.decode('utf-8', 'replace')
+
+    return name or 'unix'
+
+class JsonRpcServer(reflectrpc.server.AbstractJsonRpcServer):
+    """
+    Twisted implementation of AbstractJsonRpcServer
+    """
+    def send_data(self, data):
+        self.conn.write(data)
+
+    def send_data_sequence(self, chunks):
+        self.conn.writeSequence(chunks)
+
+    def run_awaitable(self, reply):
+        # coroutines are run by the reactor
+        defer.ensureDeferred(reply).addCallback(self.send_reply)
+
+class JsonRpcProtocol(Protocol):
     """
     Twisted protocol adapter
     """
     def __init__(self):
-        self.rpcinfo = None
+        self.server = None
         self.initialized = False
 
-            #self.server = JsonRpcServer(self.factory.rpcprocessor,
-            #        self.transport, rpcinfo)
+    def connectionMade(self):
+        rpcinfo = {'authenticated': False, 'username': None,
+                'peer': format_peer(self.transport.getPeer())}
+
+        self.server = JsonRpcServer(self.factory.rpcprocessor, self.transport,
+                rpcinfo, self.factory.max_line_length,
+                self.factory.flush_threshold)
+
+        if self.factory.stream_threshold is not None:
+            self.server.enable_incremental_decoding(self.factory.stream_threshold)
 
-    def lineReceived(self, line):
+    def dataReceived(self, data):
+        # the TLS handshake is done once the first data arrives
         if not self.initialized:
             self.initialized = True
             if self.factory.tls_client_auth_enabled:
                 self.username = self.transport.getPeerCertificate().get_subject().commonName
-                self.rpcinfo = {}
-                self.rpcinfo['authenticated'] = True
-                self.rpcinfo['username'] = self.username
+                self.server.rpcinfo['authenticated'] = True
+                self.server.rpcinfo['username'] = self.username
 
-        rpcprocessor = self.factory.rpcprocessor
-        reply = rpcprocessor.process_request(line.decode('utf-8'), self.rpcinfo)
+        try:
+            self.server.data_received(data)
+        except reflectrpc.server.LineTooLongError as e:
+            log.msg(str(e))
+            self.transport.loseConnection()
 
-        if isinstance(reply['result'], Deferred):
-            def handler(value):
-                reply['result'] = value
-                self.sendLine(json.dumps(reply).encode('utf-8'))
-
-            def error_handler(error):
-                r = rpcprocessor.handle_error(error.value, reply)
-                self.sendLine(json.dumps(r).encode('utf-8'))
-
-            d = reply['result']
-            d.addCallback(handler)
-            d.addErrback(error_handler)
-        else:
-            self.sendLine(json.dumps(reply).encode('utf-8'))
+    def connectionLost(self, reason):
+        if self.server is not None:
+            self.server.connection_lost()
 
 class JsonRpcProtocolFactory(Factory):
     """
@@ -106,73 +150,337 @@ class JsonRpcProtocolFactory(Factory):
     """
     protocol = JsonRpcProtocol
 
-    def __init__(self, rpcprocessor, tls_client_auth_enabled):
+    def __init__(self, rpcprocessor, tls_client_auth_enabled,
+            max_line_length=reflectrpc.server.default_max_line_length,
+            stream_threshold=None,
+            flush_threshold=reflectrpc.server.default_flush_threshold):
         self.rpcprocessor = rpcprocessor
         self.tls_client_auth_enabled = tls_client_auth_enabled
+        self.max_line_length = max_line_length
+        self.stream_threshold = stream_threshold
+        self.flush_threshold = flush_threshold
 
 class RootResource(resource.Resource):
-    def __init__(self, rpc):
+    def __init__(self, rpc, metrics=None):
         resource.Resource.__init__(self)
         self.rpc = rpc
+        self.metrics = metrics
 
     def getChild(self, name, request):
         if name == b'rpc':
             return self.rpc
+        elif name == b'metrics' and self.metrics is not None:
+            return self.metrics
         else:
             return NoResource()
 
+class MetricsResource(resource.Resource):
+    """
+    Serves the metrics of an RpcProcessor in the Prometheus text format
+
+    The response is written one metric family at a time, cooperating with
+    the reactor, so scraping doesn't block other requests.
+    """
+    isLeaf = True
+
+    def __init__(self, rpcprocessor, connections=None):
+        """
+        Constructor
+
+        Args:
+            rpcprocessor (RpcProcessor): Processor whose metrics are served
+            connections (WrappingFactory): Factory that tracks the open
+                                           connections or None
+        """
+        resource.Resource.__init__(self)
+        self.rpcprocessor = rpcprocessor
+        self.connections = connections
+
+    def render_GET(self, request):
+        connection_count = None
+        if self.connections is not None:
+            connection_count = len(self.connections.protocols)
+
+        chunks = reflectrpc.prometheus.generate_metrics(self.rpcprocessor,
+                connection_count)
+
+        def write_chunks():
+            for chunk in chunks:
+                request.write(chunk)
+                yield None
+
+        request.setHeader(b"Content-Type", reflectrpc.prometheus.content_type)
+
+        finished = []
+
+        def write_failed(failure):
+            # the client went away and writing was stopped on purpose
+            if failure.check(task.TaskStopped) or finished:
+                return
+
+            log.err(failure, 'Generating metrics failed')
+
+            # the headers may already be sent so an error page is no option
+            request.loseConnection()
+
+        writer = task.cooperate(write_chunks())
+        writer.whenDone().addCallbacks(lambda _: request.finish(),
+                write_failed)
+
+        # stop writing if the client goes away
+        def client_gone(failure):
+            finished.append(True)
+            writer.stop()
+
+        request.notifyFinish().addErrback(client_gone)
+
+        return NOT_DONE_YET
+
+class JsonRpcHttpRequest(server.Request):
+    """
+    HTTP request that enforces the maximum message length while the body
+    arrives
+
+    A body that is too long is neither buffered nor processed. The client
+    gets a 413 response and is disconnected as soon as the Content-Length
+    header or the data received so far exceed the limit of the site.
+    """
+    body_length = 0
+    rejected = False
+
+    def gotLength(self, length):
+        if length is not None and self.too_long(length):
+            # don't ask the client for a body that is rejected anyway
+            self.requestHeaders.removeHeader(b'Expect')
+            self.reject()
+            return
+
+        server.Request.gotLength(self, length)
+
+    def handleContentChunk(self, data):
+        if self.rejected:
+            return
+
+        self.body_length += len(data)
+        if self.too_long(self.body_length):
+            self.reject()
+            return
+
+        server.Request.handleContentChunk(self, data)
+
+    def requestReceived(self, command, path, version):
+        if self.rejected:
+            return
+
+        server.Request.requestReceived(self, command, path, version)
+
+    def too_long(self, length):
+        max_length = self.channel.site.max_length
+
+        return max_length is not None and length > max_length
+
+    def reject(self):
+        """
+        Send a 413 response with an InvalidRequest error and disconnect
+        """
+        self.rejected = True
+        self.content = io.BytesIO()
+
+        site = self.channel.site
+        error = JsonRpcInvalidRequest("Message is longer than %d bytes" %
+                (site.max_length))
+        body = site.rpcprocessor.encode_reply({'id': -1, 'result': None,
+            'error': error.to_dict()})
+
+        self.channel.transport.write(b'HTTP/1.1 413 Payload Too Large\r\n'
+                b'Content-Type: application/json-rpc\r\n'
+                b'Content-Length: ' + str(len(body)).encode('utf-8') +
+                b'\r\nConnection: close\r\n\r\n' + body)
+        self.channel.loseConnection()
+
+class JsonRpcSite(server.Site):
+    """
+    Site whose requests are limited to max_length bytes
+    """
+    requestFactory = JsonRpcHttpRequest
+
+    def __init__(self, resource, rpcprocessor, max_length):
+        """
+        Constructor
+
+        Args:
+            resource (IResource): Root resource
+            rpcprocessor (RpcProcessor): Encodes the error replies
+            max_length (int): Maximum length of a request body in bytes or
+                              None for no limit
+        """
+        server.Site.__init__(self, resource, JsonRpcHttpRequest)
+        self.rpcprocessor = rpcprocessor
+        self.max_length = max_length
+
 class JsonRpcHttpResource(resource.Resource):
     isLeaf = True
 
     def __init__(self):
         resource.Resource.__init__(self)
+        self.max_length = reflectrpc.server.default_max_line_length
 
     def render_POST(self, request):
-        rpcinfo = None
+        rpcinfo = {'authenticated': False, 'username': None,
+                'peer': format_peer(request.getClientAddress())}
 
         if self.tls_client_auth_enabled:
             self.username = request.transport.getPeerCertificate().get_subject().commonName
-            rpcinfo = {}
             rpcinfo['authenticated'] = True
             rpcinfo['username'] = self.username
         elif request.getUser():
-            rpcinfo = {}
             rpcinfo['authenticated'] = True
             rpcinfo['username'] = request.getUser().decode('utf-8')
 
-        data = request.content.getvalue().decode('utf-8')
-        reply = self.rpcprocessor.process_request(data, rpcinfo)
-        request.setHeader(b"Content-Type", b"application/json-rpc")
+        # large bodies are stored in a temporary file instead of a BytesIO,
+        # JsonRpcSite rejects too long ones before they are stored but other
+        # sites don't
+        content = request.content
+        content.seek(0, os.SEEK_END)
+        if self.max_length is not None and content.tell() > self.max_length:
+            request.setResponseCode(413)
+            error = JsonRpcInvalidRequest("Message is longer than %d bytes" %
+                    (self.max_length))
+            return self.render_reply(request, self.rpcprocessor.encode_reply(
+                {'id': -1, 'result': None, 'error': error.to_dict()}))
+
+        content.seek(0)
+        data = content.read()
+        reply = self.rpcprocessor.process_message(data, rpcinfo)
+
+        if is_awaitable(reply):
+            reply = defer.ensureDeferred(reply)
+
+        if isinstance(reply, Deferred):
+            finished = []
+
+            # the client went away before the reply was ready
+            request.notifyFinish().addErrback(lambda _: finished.append(True))
 
-        if isinstance(reply['result'], Deferred):
             def delayed_render(value):
-                reply['result'] = value
+                if finished:
+                    return
 
-                data = json.dumps(reply).encode('utf-8')
-                header_value = str(len(data)).encode('utf-8')
-                request.setHeader(b"Content-Length", header_value)
-                request.write(data)
+                request.write(self.render_reply(request, value))
                 request.finish()
 
-            def error_handler(error):
-                r = self.rpcprocessor.handle_error(error.value, reply)
+            def render_error(failure):
+                log.err(failure, 'Processing a request failed')
 
-                data = json.dumps(r).encode('utf-8')
-                header_value = str(len(data)).encode('utf-8')
-                request.setHeader(b"Content-Length", header_value)
-                request.write(data)
-                request.finish()
+                error = JsonRpcInternalError("Internal error")
+                delayed_render(self.rpcprocessor.encode_reply({'id': -1,
+                    'result': None, 'error': error.to_dict()}))
 
-            d = reply['result']
-            d.addCallback(delayed_render)
-            d.addErrback(error_handler)
+            reply.addCallbacks(delayed_render, render_error)
+            reply.addErrback(log.err, 'Sending a reply failed')
 
             return NOT_DONE_YET
 
-        data = json.dumps(reply).encode('utf-8')
-        header_value = str(len(data)).encode('utf-8')
+        return self.render_reply(request, reply)
+
+    def render_reply(self, request, reply):
+        # in case of a notification request there is no reply to send
+        if reply is None:
+            request.setResponseCode(204)
+            return b''
+
+        header_value = str(len(reply)).encode('utf-8')
+        request.setHeader(b"Content-Type", b"application/json-rpc")
         request.setHeader(b"Content-Length", header_value)
-        return data
+
+        return reply
+
+class ThreadPoolExecutor(object):
+    """
+    Executes blocking RPC functions in named Twisted thread pools
+
+    Each pool has a limit for the number of calls that wait for a free thread.
+    Calls beyond that limit are rejected with a JsonRpcServerBusy error
+    instead of piling up in memory.
+    """
+    def __init__(self):
+        self.pools = {}
+        self.max_queue = {}
+        self.pending = {}
+
+    def add_pool(self, name, max_threads, min_threads, max_queue):
+        """
+        Add a thread pool or replace the settings of an existing one
+
+        Args:
+            name (str): Name of the pool
+            max_threads (int): Maximum number of threads
+            min_threads (int): Number of threads kept alive when idle
+            max_queue (int): Maximum number of calls waiting for a thread or
+                             None for no limit
+        """
+        self.pools[name] = ThreadPool(min_threads, max_threads,
+                'reflectrpc-' + name)
+        self.max_queue[name] = max_queue
+        self.pending[name] = 0
+
+    def start(self):
+        """
+        Start all pools and stop them when the reactor shuts down
+        """
+        from twisted.internet import reactor
+
+        for pool in self.pools.values():
+            pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+
+    def execute(self, pool_name, func, params):
+        """
+        Call a function in a thread pool
+
+        Args:
+            pool_name (str): Name of the pool
+            func (callable): Function to call
+            params (tuple): Parameters to pass to the function
+
+        Returns:
+            Deferred: Fires with the result of the function
+
+        Raises:
+            JsonRpcServerBusy: If too many calls are waiting for the pool
+            ValueError: If there is no pool of that name
+        """
+        if pool_name not in self.pools:
+            raise ValueError("Unknown thread pool: %s" % (pool_name))
+
+        pool = self.pools[pool_name]
+        max_queue = self.max_queue[pool_name]
+
+        if max_queue is not None and self.pending[pool_name] >= pool.max + max_queue:
+            raise JsonRpcServerBusy("Too many requests waiting for thread pool '%s'" % (pool_name))
+
+        from twisted.internet import reactor
+
+        self.pending[pool_name] += 1
+
+        def call_done(value):
+            self.pending[pool_name] -= 1
+            return value
+
+        d = threads.deferToThreadPool(reactor, pool, func, *params)
+        d.addBoth(call_done)
+
+        return d
+
+class InheritedUnixPort(unix.Port):
+    """
+    UNIX Domain Socket port of a pre-forked worker
+
+    The socket file belongs to the prefork master, so a worker must not
+    remove it when it closes the port.
+    """
+    def connectionLost(self, reason):
+        tcp.Port.connectionLost(self, reason)
 
 class TwistedJsonRpcServer(object):
     """
@@ -205,6 +513,20 @@ class TwistedJsonRpcServer(object):
         self.unix_socket_mode = 438
         self.unix_socket_want_pid = False
 
+        self.max_line_length = reflectrpc.server.default_max_line_length
+        self.stream_threshold = None
+        self.flush_threshold = reflectrpc.server.default_flush_threshold
+
+        self.thread_pools = ThreadPoolExecutor()
+        self.add_thread_pool('default')
+
+        self.lag_monitor = None
+        self.metrics_endpoint_enabled = False
+
+        self.prefork_workers = None
+        self.prefork_reuse_port = False
+        self.prefork_freeze_gc = True
+
     def enable_tls(self, pem_file):
         """
         Enable TLS authentication and encryption for this server
@@ -242,6 +564,18 @@ class TwistedJsonRpcServer(object):
         """
         self.http_enabled = True
 
+    def enable_metrics_endpoint(self):
+        """
+        Serve the metrics of the server at '/metrics' for Prometheus
+
+        Requires HTTP as transport protocol. The endpoint renders request
+        counters, latency histograms, in-flight requests, the number of open
+        connections and the reactor lag (if the lag monitor is enabled) in
+        the Prometheus text format. If HTTP Basic Auth is enabled the
+        endpoint is protected by it as well.
+        """
+        self.metrics_endpoint_enabled = True
+
     def enable_http_basic_auth(self, passwdCheckFunction):
         """
         Enables HTTP Basic Auth
@@ -281,39 +615,262 @@ class TwistedJsonRpcServer(object):
         """
         self.unix_socket_want_pid = True
 
+    def set_max_line_length(self, length):
+        """
+        Sets the maximum length of a message, clients that send longer
+        messages get an error reply and are disconnected (or a HTTP 413
+        response)
+
+        Args:
+            length (int): Maximum message length in bytes or None for no limit
+        """
+        self.max_line_length = length
+
+    def set_flush_threshold(self, size):
+        """
+        Sets how many bytes of replies to pipelined requests are collected
+        before they are sent together
+
+        Args:
+            size (int): Number of bytes or None to send every reply at once
+        """
+        self.flush_threshold = size
+
+    def enable_incremental_decoding(self, threshold=256 * 1024):
+        """
+        Decode large line-terminated messages while they arrive
+
+        Messages longer than threshold are passed in chunks of threshold bytes
+        to an incremental JSON parser, so decoding a message of many megabytes
+        doesn't block the reactor once it is complete and the raw message is
+        not kept in memory next to the decoded one. This pays off for
+        messages with many small values, messages that consist of a few long
+        strings are decoded faster by the codec. Requires ijson.
+
+        Args:
+            threshold (int): Length in bytes from which on a message is decoded
+                             incrementally and size of the chunks passed to the
+                             parser
+
+        Raises:
+            ValueError: If ijson is not installed
+        """
+        reflectrpc.server.import_ijson()
+
+        self.stream_threshold = threshold
+
+    def add_thread_pool(self, name, max_threads=10, min_threads=0,
+            max_queue=None):
+        """
+        Add a thread pool for RPC functions that block
+
+        Functions are assigned to a pool with RpcFunction.run_in_thread_pool.
+        There always is a pool named 'default' which can be reconfigured by
+        calling this method with its name.
+
+        Args:
+            name (str): Name of the pool
+            max_threads (int): Maximum number of threads
+            min_threads (int): Number of threads kept alive when idle
+            max_queue (int): Maximum number of calls waiting for a free thread
+                             or None for no limit. If the limit is reached
+                             calls are rejected with a ServerBusy error.
+        """
+        self.thread_pools.add_pool(name, max_threads, min_threads, max_queue)
+
+    def enable_lag_monitor(self, interval=0.1, threshold=0.05):
+        """
+        Measure how long the reactor is blocked
+
+        A timer that is due every interval seconds records how late the
+        reactor runs it. Lags over the threshold are attributed to the RPC
+        method that ran longest in the reactor thread in the meantime. The
+        data is returned by the builtin __describe_event_loop_lag.
+
+        Args:
+            interval (float): Seconds between two measurements
+            threshold (float): Lag in seconds above which it is attributed to
+                               a method
+        """
+        self.lag_monitor = LagMonitor(interval, threshold)
+
+    def enable_prefork(self, workers=None, reuse_port=False, freeze_gc=True):
+        """
+        Serve with several worker processes to use more than one core
+
+        run forks the workers after everything is set up. They share the
+        listening socket, which is either opened by the master and inherited
+        or opened by each worker with SO_REUSEPORT (TCP only, lets the kernel
+        balance the connections). The master restarts workers that die and
+        passes SIGTERM and SIGINT on to them. Each worker has its own process
+        pools, thread pools and metrics.
+
+        The Twisted reactor must not be imported before run is called, since
+        the workers can't share it. Import it inside your functions instead.
+
+        Args:
+            workers (int): Number of worker processes (defaults to the number
+                           of CPUs)
+            reuse_port (bool): Open a socket with SO_REUSEPORT in every worker
+                               instead of inheriting one from the master
+            freeze_gc (bool): Call gc.freeze before forking so the objects
+                              created so far (e.g. the RpcProcessor) stay
+                              shared copy-on-write
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        self.prefork_workers = workers
+        self.prefork_reuse_port = reuse_port
+        self.prefork_freeze_gc = freeze_gc
+
+    def protect_resource(self, child):
+        """
+        Protect a resource with HTTP Basic Auth
+
+        Args:
+            child (IResource): Resource to protect
+
+        Returns:
+            IResource: Resource that requires a valid username and password
+        """
+        checker = PasswordChecker(self.passwdCheckFunction)
+        realm = HttpPasswordRealm(child)
+        p = portal.Portal(realm, [checker])
+
+        realm_name = 'Reflect RPC'
+
+        if sys.version_info.major == 2:
+            realm_name = realm_name.encode('utf-8')
+
+        credentialFactory = BasicCredentialFactory(realm_name)
+
+        return HTTPAuthSessionWrapper(p, [credentialFactory])
+
     def run(self):
         """
         Start the server and listen on host:port
         """
+        unix_prefix = 'unix://'
+
+        for func in self.rpcprocessor.functions:
+            if func.thread_pool is not None and func.thread_pool not in self.thread_pools.pools:
+                print("ERROR: Function '%s' uses unknown thread pool '%s'" %
+                        (func.name, func.thread_pool), file=sys.stderr)
+                sys.exit(1)
+
+        if self.metrics_endpoint_enabled and not self.http_enabled:
+            print("ERROR: The metrics endpoint requires HTTP", file=sys.stderr)
+            sys.exit(1)
+
+        if self.prefork_workers is None:
+            self.serve()
+            return
+
+        if 'twisted.internet.reactor' in sys.modules:
+            print("ERROR: The Twisted reactor must not be imported before the workers are forked",
+                    file=sys.stderr)
+            sys.exit(1)
+
+        listener = None
+        if not self.prefork_reuse_port:
+            listener = self.create_listener()
+
+        if self.host.startswith(unix_prefix):
+            print("Listening on %s with %d workers" % (self.host, self.prefork_workers))
+        else:
+            print("Listening on %s:%d with %d workers" % (self.host, self.port,
+                self.prefork_workers))
+        sys.stdout.flush()
+
+        master = reflectrpc.prefork.PreforkMaster(self.prefork_workers,
+                lambda number: self.serve(listener), self.prefork_freeze_gc)
+
+        try:
+            master.run()
+        finally:
+            if listener is not None:
+                listener.close()
+
+            if self.host.startswith(unix_prefix):
+                path = self.host[len(unix_prefix):]
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def create_listener(self):
+        """
+        Create the listening socket for a pre-forked worker
+
+        Returns:
+            socket.socket: Listening socket
+        """
+        try:
+            return reflectrpc.prefork.create_listening_socket(self.host,
+                    self.port, self.unix_socket_backlog, self.prefork_reuse_port,
+                    self.unix_socket_mode)
+        except (OSError, ValueError) as e:
+            print("ERROR: %s" % (e), file=sys.stderr)
+            sys.exit(1)
+
+    def serve(self, listener=None):
+        """
+        Set up the reactor and run it
+
+        Args:
+            listener (socket.socket): Listening socket inherited from the
+                                      prefork master or None
+        """
+        from twisted.internet import reactor
+
         f = None
         unix_prefix = 'unix://'
 
+        # fork the worker processes before any threads are started
+        self.rpcprocessor.start_process_pools()
+        reactor.addSystemEventTrigger('during', 'shutdown',
+                self.rpcprocessor.stop_process_pools)
+
+        self.thread_pools.start()
+        self.rpcprocessor.set_executor(self.thread_pools)
+
+        if self.lag_monitor is not None:
+            self.lag_monitor.start(reactor.callLater)
+            self.rpcprocessor.set_lag_monitor(self.lag_monitor)
+
         if self.http_enabled:
             rpc = JsonRpcHttpResource()
             rpc.rpcprocessor = self.rpcprocessor
             rpc.tls_client_auth_enabled = self.tls_client_auth_enabled
+            rpc.max_length = self.max_line_length
 
-            if self.http_basic_auth_enabled:
-                checker = PasswordChecker(self.passwdCheckFunction)
-                realm = HttpPasswordRealm(rpc)
-                p = portal.Portal(realm, [checker])
+            metrics_resource = None
+            metrics = None
+            if self.metrics_endpoint_enabled:
+                metrics_resource = MetricsResource(self.rpcprocessor)
+                metrics = metrics_resource
 
-                realm_name = 'Reflect RPC'
+            if self.http_basic_auth_enabled:
+                rpc = self.protect_resource(rpc)
 
-                if sys.version_info.major == 2:
-                    realm_name = realm_name.encode('utf-8')
+                if metrics is not None:
+                    metrics = self.protect_resource(metrics)
 
-                credentialFactory = BasicCredentialFactory(realm_name)
-                rpc = HTTPAuthSessionWrapper(p, [credentialFactory])
+            root = RootResource(rpc, metrics)
 
-            root = RootResource(rpc)
+            f = JsonRpcSite(root, self.rpcprocessor, self.max_line_length)
 
-            f = server.Site(root)
+            # count the open connections for the metrics endpoint
+            if metrics_resource is not None:
+                f = WrappingFactory(f)
+                metrics_resource.connections = f
         else:
             f = JsonRpcProtocolFactory(self.rpcprocessor,
-                    self.tls_client_auth_enabled)
+                    self.tls_client_auth_enabled, self.max_line_length,
+                    self.stream_threshold, self.flush_threshold)
 
-        if self.tls_enabled:
+        if self.prefork_workers is not None:
+            self.adopt_listener(reactor, f, listener)
+        elif self.tls_enabled:
             if not self.tls_client_auth_enabled:
                 reactor.listenSSL(self.port, f, self.cert.options(),
                         interface=self.host)
@@ -329,9 +886,44 @@ class TwistedJsonRpcServer(object):
             else:
                 reactor.listenTCP(self.port, f, interface=self.host)
 
-        if self.host.startswith(unix_prefix):
-            print("Listening on %s" % (self.host))
-        else:
-            print("Listening on %s:%d" % (self.host, self.port))
+        if self.prefork_workers is None:
+            if self.host.startswith(unix_prefix):
+                print("Listening on %s" % (self.host))
+            else:
+                print("Listening on %s:%d" % (self.host, self.port))
 
         reactor.run()
+
+    def adopt_listener(self, reactor, f, listener):
+        """
+        Serve a factory on the listening socket of a pre-forked worker
+
+        Args:
+            reactor (IReactorSocket): The reactor of the worker
+            f (Factory): Factory for the connections
+            listener (socket.socket): Inherited listening socket or None to
+                                      open one with SO_REUSEPORT
+        """
+        from twisted.protocols.tls import TLSMemoryBIOFactory
+
+        if listener is None:
+            listener = self.create_listener()
+
+        if self.tls_enabled:
+            if not self.tls_client_auth_enabled:
+                options = self.cert.options()
+            else:
+                options = self.cert.options(self.client_auth_ca)
+
+            f = TLSMemoryBIOFactory(options, False, f)
+
+        # the reactor uses a duplicate of the file descriptor
+        if listener.family == socket.AF_UNIX:
+            port = InheritedUnixPort._fromListeningDescriptor(reactor,
+                    listener.fileno(), f)
+            port.mode = self.unix_socket_mode
+            port.startListening()
+        else:
+            reactor.adoptStreamPort(listener.fileno(), listener.family, f)
+
+        listener.close()
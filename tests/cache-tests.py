@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import sys
+import time
+import unittest
+
+sys.path.append('..')
+
+from reflectrpc.cache import LruCache
+
+class LruCacheTests(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = LruCache(2)
+
+        cache.put('a', 1)
+        cache.put('b', 2)
+
+        # 'a' is now the most recently used entry
+        self.assertEqual(cache.get('a'), 1)
+
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+        self.assertEqual(cache.stats(), {'entries': 2, 'max_entries': 2,
+            'ttl': None, 'hits': 3, 'misses': 1, 'evictions': 1,
+            'expirations': 0})
+
+    def test_ttl(self):
+        cache = LruCache(10, 0.05)
+
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+
+        time.sleep(0.1)
+        self.assertEqual(cache.get('a'), None)
+
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 0)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['expirations'], 1)
+
+    def test_clear(self):
+        cache = LruCache(10)
+
+        cache.put('a', 1)
+        cache.clear()
+
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
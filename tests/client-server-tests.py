@@ -52,6 +52,22 @@ class ClientServerTests(unittest.TestCase):
             client.close_connection()
             server.stop()
 
+    def test_twisted_server_large_message(self):
+        server = ServerRunner('../examples/servertwisted.py', 5500)
+        server.run()
+
+        client = RpcClient('localhost', 5500)
+
+        try:
+            # longer than the 16 KB lines LineReceiver accepts by default
+            message = 'x' * 100000
+            result = client.rpc_call('echo', message)
+
+            self.assertEqual(result, message)
+        finally:
+            client.close_connection()
+            server.stop()
+
     def test_twisted_server_http(self):
         server = ServerRunner('../examples/serverhttp.py', 5500)
         server.run()
@@ -67,6 +83,34 @@ class ClientServerTests(unittest.TestCase):
             client.close_connection()
             server.stop()
 
+    def test_twisted_server_http_too_long(self):
+        import socket
+
+        server = ServerRunner('../examples/serverhttp.py', 5500)
+        server.run()
+
+        sock = socket.create_connection(('localhost', 5500))
+        sock.settimeout(10)
+
+        try:
+            # the body is rejected before it is sent
+            sock.sendall(b'POST /rpc HTTP/1.1\r\nHost: localhost\r\n'
+                    b'Content-Length: 100000000\r\n\r\n')
+
+            response = b''
+            data = sock.recv(4096)
+            while data:
+                response += data
+                data = sock.recv(4096)
+
+            header, body = response.split(b'\r\n\r\n', 1)
+            self.assertTrue(header.startswith(b'HTTP/1.1 413 '))
+            self.assertEqual(json.loads(body.decode('utf-8'))['error']['name'],
+                    'InvalidRequest')
+        finally:
+            sock.close()
+            server.stop()
+
     def test_twisted_server_tls(self):
         server = ServerRunner('../examples/servertls.py', 5500)
         server.run()
@@ -333,6 +377,132 @@ class ClientServerTests(unittest.TestCase):
             client.close_connection()
             server.stop()
 
+    def test_asyncio_server_http_basic_auth(self):
+        server = ServerRunner('../examples/serverasyncio_http_basic_auth.py', 5500)
+        server.run()
+
+        client = RpcClient('localhost', 5500)
+        client.enable_http()
+        client.enable_http_basic_auth('testuser', '123456')
+
+        try:
+            result = client.rpc_call('echo', 'Hello Server')
+            authenticated = client.rpc_call('is_authenticated')
+            username = client.rpc_call('get_username')
+
+            self.assertEqual(result, 'Hello Server')
+            self.assertEqual(authenticated, True)
+            self.assertEqual(username, 'testuser')
+        finally:
+            client.close_connection()
+            server.stop()
+
+    def test_asyncio_server_http_basic_auth_wrong_password(self):
+        server = ServerRunner('../examples/serverasyncio_http_basic_auth.py', 5500)
+        server.run()
+
+        client = RpcClient('localhost', 5500)
+        client.enable_http()
+        client.enable_http_basic_auth('testuser', 'wrongpassword')
+
+        try:
+            with self.assertRaises(HttpException) as cm:
+                client.rpc_call('is_authenticated')
+
+            self.assertEqual(cm.exception.status, '401')
+        finally:
+            client.close_connection()
+            server.stop()
+
+    def test_asyncio_unix_socket(self):
+        server = ServerRunner('../examples/serverasyncio_unixsocket.py',
+                '/tmp/reflectrpc.sock')
+        server.run()
+
+        client = RpcClient('unix:///tmp/reflectrpc.sock', 0)
+
+        try:
+            result = client.rpc_call('echo', 'Hello Server')
+
+            self.assertEqual(result, 'Hello Server')
+        finally:
+            client.close_connection()
+            server.stop()
+
+    def test_concurrent_simple_server(self):
+        server = ServerRunner('../examples/serverconcurrent.py', 5500)
+        server.run()
+
+        client1 = RpcClient('localhost', 5500)
+        client2 = RpcClient('localhost', 5500)
+
+        results = []
+
+        def t1_func():
+            result = client1.rpc_call('slow_operation')
+            results.append(result)
+
+        def t2_func():
+            time.sleep(0.5)
+            result = client2.rpc_call('fast_operation')
+            results.append(result)
+
+        try:
+            t1 = threading.Thread(target = t1_func, args = ())
+            t1.start()
+
+            t2 = threading.Thread(target = t2_func, args = ())
+            t2.start()
+
+            t1.join()
+            t2.join()
+
+            # the second client is served while the first one waits
+            self.assertEqual(results, [41, 42])
+            self.assertEqual(client2.rpc_call('echo', 'Hello Server'), 'Hello Server')
+        finally:
+            client1.close_connection()
+            client2.close_connection()
+            server.stop()
+
+    def test_concurrent_simple_server_large_replies(self):
+        import socket
+
+        server = ServerRunner('../examples/serverconcurrent.py', 5500)
+        server.run()
+
+        # the replies don't fit into the socket buffers, so they are sent
+        # while the worker threads process the next requests
+        message = 'x' * 60000
+        data = b''.join(('{"method": "echo", "params": ["%s"], "id": %d}\n' %
+            (message, i)).encode('utf-8') for i in range(300))
+
+        sock = socket.create_connection(('localhost', 5500))
+        sock.settimeout(30)
+        sender = threading.Thread(target = sock.sendall, args = (data,))
+
+        try:
+            sender.start()
+            time.sleep(0.5)
+
+            received = bytearray()
+            while received.count(b'\n') < 300:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+
+                received += chunk
+
+            sender.join()
+
+            replies = [json.loads(line.decode('utf-8'))
+                    for line in bytes(received).splitlines()]
+            self.assertEqual(list(range(300)), [r['id'] for r in replies])
+            self.assertTrue(all(r['result'] == message for r in replies))
+        finally:
+            sock.close()
+            server.stop()
+
     def test_concurrency(self):
         server = ServerRunner('../examples/concurrency.py', 5500)
         server.run()
@@ -456,6 +626,289 @@ class ClientServerTests(unittest.TestCase):
             client.close_connection()
             server.stop()
 
+    def test_batch_request(self):
+        server = ServerRunner('../examples/concurrency.py', 5500)
+        server.run()
+
+        client = RpcClient('localhost', 5500)
+
+        try:
+            start = time.time()
+            reply = client.rpc_call_raw(json.dumps([
+                {'method': 'slow_operation', 'params': [], 'id': 1},
+                {'method': 'fast_operation', 'params': [], 'id': 2},
+                {'method': 'deferred_error', 'params': [], 'id': 3},
+                {'method': 'fast_operation', 'params': [], 'id': None}
+            ]))
+            duration = time.time() - start
+
+            self.assertEqual(json.loads(reply), [
+                {'result': 42, 'error': None, 'id': 1},
+                {'result': 41, 'error': None, 'id': 2},
+                {'result': None, 'error': {'name': 'JsonRpcError',
+                    'message': 'You wanted an error, here you have it!'}, 'id': 3}
+            ])
+            self.assertTrue(duration < 2)
+        finally:
+            client.close_connection()
+            server.stop()
+
+    def test_pipelined_requests(self):
+        server = ServerRunner('../examples/concurrency.py', 5500)
+        server.run()
+
+        client = RpcClient('localhost', 5500)
+
+        try:
+            start = time.time()
+            slow = client.rpc_call_pipelined('slow_operation')
+            coroutine = client.rpc_call_pipelined('coroutine_operation', 21)
+            error = client.rpc_call_pipelined('deferred_error')
+            fast = [client.rpc_call_pipelined('fast_operation') for i in range(100)]
+
+            # the replies of the fast functions arrive first
+            self.assertEqual([41] * 100, [f.result() for f in fast])
+            self.assertFalse(slow.done())
+
+            self.assertEqual(42, slow.result())
+            self.assertEqual(42, coroutine.result())
+            with self.assertRaises(RpcError):
+                error.result()
+
+            duration = time.time() - start
+            self.assertTrue(duration < 2)
+
+            # at most 10 requests are in flight
+            client.set_pipeline_window(10)
+            futures = []
+            for i in range(50):
+                futures.append(client.rpc_call_pipelined('coroutine_operation', i))
+                self.assertTrue(len(client.pipeline_pending) <= 10)
+
+            # rpc_call waits for the pipelined requests first
+            self.assertEqual(41, client.rpc_call('fast_operation'))
+            self.assertEqual([i * 2 for i in range(50)],
+                    [f.result() for f in futures])
+        finally:
+            client.close_connection()
+            server.stop()
+
+    def test_batch_request_http(self):
+        server = ServerRunner('../examples/concurrency-http.py', 5500)
+        server.run()
+
+        client = RpcClient('localhost', 5500)
+        client.enable_http()
+
+        try:
+            reply = client.rpc_call_raw(json.dumps([
+                {'method': 'slow_operation', 'params': [], 'id': 1},
+                {'method': 'fast_operation', 'params': [], 'id': 2}
+            ]))
+
+            self.assertEqual(json.loads(reply), [
+                {'result': 42, 'error': None, 'id': 1},
+                {'result': 41, 'error': None, 'id': 2}
+            ])
+        finally:
+            client.close_connection()
+            server.stop()
+
+
+    def test_coroutine_twisted(self):
+        server = ServerRunner('../examples/concurrency.py', 5500)
+        server.run()
+
+        client = RpcClient('localhost', 5500)
+
+        try:
+            self.assertEqual(client.rpc_call('coroutine_operation', 21), 42)
+        finally:
+            client.close_connection()
+            server.stop()
+
+    def test_concurrency_asyncio(self):
+        server = ServerRunner('../examples/concurrency-asyncio.py', 5500)
+        server.run()
+
+        client1 = RpcClient('localhost', 5500)
+        client2 = RpcClient('localhost', 5500)
+
+        results = []
+
+        def t1_func():
+            result = client1.rpc_call('slow_operation')
+            results.append(result)
+
+        def t2_func():
+            time.sleep(0.5)
+            result = client2.rpc_call('fast_operation')
+            results.append(result)
+
+        try:
+            t1 = threading.Thread(target = t1_func, args = ())
+            t1.start()
+
+            t2 = threading.Thread(target = t2_func, args = ())
+            t2.start()
+
+            t1.join()
+            t2.join()
+
+            # slow_operation (value 42) must finish last
+            self.assertEqual(results, [41, 42])
+        finally:
+            client1.close_connection()
+            client2.close_connection()
+            server.stop()
+
+    def test_concurrency_asyncio_error_handling(self):
+        server = ServerRunner('../examples/concurrency-asyncio.py', 5500)
+        server.run()
+
+        client = RpcClient('localhost', 5500)
+
+        try:
+            with self.assertRaises(RpcError) as cm:
+                client.rpc_call('coroutine_error')
+
+            self.assertEqual(cm.exception.json['name'], 'JsonRpcError')
+            self.assertEqual(cm.exception.json['message'], 'You wanted an error, here you have it!')
+
+            with self.assertRaises(RpcError) as cm:
+                client.rpc_call('coroutine_internal_error')
+
+            self.assertEqual(cm.exception.json['name'], 'InternalError')
+        finally:
+            client.close_connection()
+            server.stop()
+
+    def test_batch_request_asyncio(self):
+        server = ServerRunner('../examples/concurrency-asyncio.py', 5500)
+        server.run()
+
+        client = RpcClient('localhost', 5500)
+
+        try:
+            start = time.time()
+            reply = client.rpc_call_raw(json.dumps([
+                {'method': 'slow_operation', 'params': [], 'id': 1},
+                {'method': 'slow_operation', 'params': [], 'id': 2},
+                {'method': 'notify', 'params': [5], 'id': None},
+                {'method': 'fast_operation', 'params': [], 'id': 3}
+            ]))
+            duration = time.time() - start
+
+            self.assertEqual(json.loads(reply), [
+                {'result': 42, 'error': None, 'id': 1},
+                {'result': 42, 'error': None, 'id': 2},
+                {'result': 41, 'error': None, 'id': 3}
+            ])
+            self.assertTrue(duration < 2)
+            self.assertEqual(client.rpc_call('get_notified_values'), [5])
+        finally:
+            client.close_connection()
+            server.stop()
+
+
+    def test_thread_pool(self):
+        server = ServerRunner('../examples/concurrency.py', 5500)
+        server.run()
+
+        client1 = RpcClient('localhost', 5500)
+        client2 = RpcClient('localhost', 5500)
+
+        results = []
+
+        def t1_func():
+            result = client1.rpc_call('blocking_operation')
+            results.append(result)
+
+        def t2_func():
+            time.sleep(0.5)
+            result = client2.rpc_call('fast_operation')
+            results.append(result)
+
+        try:
+            t1 = threading.Thread(target = t1_func, args = ())
+            t1.start()
+
+            t2 = threading.Thread(target = t2_func, args = ())
+            t2.start()
+
+            t1.join()
+            t2.join()
+
+            # blocking_operation (value 42) must not block the reactor
+            self.assertEqual(results, [41, 42])
+        finally:
+            client1.close_connection()
+            client2.close_connection()
+            server.stop()
+
+    def test_thread_pool_busy(self):
+        server = ServerRunner('../examples/concurrency.py', 5500)
+        server.run()
+
+        client1 = RpcClient('localhost', 5500)
+        client2 = RpcClient('localhost', 5500)
+
+        results = []
+
+        def t1_func():
+            result = client1.rpc_call('limited_operation')
+            results.append(result)
+
+        try:
+            t1 = threading.Thread(target = t1_func, args = ())
+            t1.start()
+
+            time.sleep(0.2)
+
+            with self.assertRaises(RpcError) as cm:
+                client2.rpc_call('limited_operation')
+            self.assertEqual(cm.exception.json['name'], 'ServerBusy')
+
+            t1.join()
+            self.assertEqual(results, [43])
+
+            # once the thread is free again calls are accepted
+            self.assertEqual(client2.rpc_call('limited_operation'), 43)
+        finally:
+            client1.close_connection()
+            client2.close_connection()
+            server.stop()
+
+
+    def test_process_pool(self):
+        server = ServerRunner('../examples/processpool.py', 5500)
+        server.run()
+
+        client = RpcClient('localhost', 5500)
+
+        try:
+            self.assertEqual(client.rpc_call('sum_of_squares', 4), 14)
+
+            server_pid = client.rpc_call('get_server_pid')
+            pids = set()
+
+            for i in range(10):
+                info = client.rpc_call('get_worker_info')
+                self.assertTrue(info['ready'])
+                self.assertNotEqual(info['pid'], server_pid)
+                pids.add(info['pid'])
+
+            # workers are replaced after 3 calls
+            self.assertTrue(len(pids) > 2)
+
+            with self.assertRaises(RpcError) as cm:
+                client.rpc_call('worker_error')
+            self.assertEqual(cm.exception.json['name'], 'JsonRpcError')
+            self.assertEqual(cm.exception.json['message'], 'Error in worker process')
+        finally:
+            client.close_connection()
+            server.stop()
+
 
 if __name__ == '__main__':
     unittest.main()
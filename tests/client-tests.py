@@ -54,6 +54,70 @@ class ClientTests(unittest.TestCase):
         finally:
             client.close_connection()
 
+    def test_client_pipelined(self):
+        server = FakeServer('localhost', 5500)
+        # the replies arrive in a different order than the requests
+        server.add_reply('{"error": null, "result": "second", "id": 2}\r\n'
+                '{"error": {"name": "JsonRpcError", "message": "failed"}, "result": null, "id": 3}\r\n'
+                '{"error": null, "result": "first", "id": 1}')
+        server.run()
+
+        client = RpcClient('localhost', 5500)
+
+        try:
+            first = client.rpc_call_pipelined('echo', 'first')
+            second = client.rpc_call_pipelined('echo', 'second')
+            third = client.rpc_call_pipelined('fail')
+
+            # nothing was sent yet
+            self.assertEqual(3, len(client.pipeline_queue))
+            self.assertFalse(first.done())
+
+            self.assertEqual('first', first.result())
+            self.assertTrue(second.done())
+            self.assertEqual('second', second.result())
+            self.assertIsInstance(third.exception(), RpcError)
+            with self.assertRaises(RpcError):
+                third.result()
+
+            server.stop()
+
+            # all requests were sent with a single write
+            self.assertEqual(1, len(server.requests))
+            requests = [json.loads(r) for r in server.requests[0].splitlines()]
+            self.assertEqual([1, 2, 3], [r['id'] for r in requests])
+            self.assertEqual({}, client.pipeline_pending)
+        finally:
+            client.close_connection()
+
+    def test_client_pipelined_connection_lost(self):
+        server = FakeServer('localhost', 5500)
+        server.add_reply('{"error": null, "result": "first", "id": 1}')
+        server.run()
+
+        client = RpcClient('localhost', 5500)
+
+        try:
+            first = client.rpc_call_pipelined('echo', 'first')
+            second = client.rpc_call_pipelined('echo', 'second')
+
+            self.assertEqual('first', first.result())
+            server.stop()
+
+            # the server closed the connection without a reply
+            with self.assertRaises(NetworkError):
+                second.result()
+
+            self.assertFalse(client.is_connected())
+        finally:
+            client.close_connection()
+
+    def test_client_pipeline_http(self):
+        client = RpcClient('localhost', 5500)
+        client.enable_http()
+
+        with self.assertRaises(ValueError):
+            client.rpc_call_pipelined('echo', 'Hello Server')
 
 if __name__ == '__main__':
     unittest.main()
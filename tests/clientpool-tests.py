@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import sys
+import threading
+import unittest
+
+sys.path.append('..')
+
+from reflectrpc.client import RpcError
+from reflectrpc.client import NetworkError
+from reflectrpc.clientpool import RpcClientPool
+from reflectrpc.clientpool import PoolTimeoutError
+from reflectrpc.testing import FakeServer
+from reflectrpc.testing import ServerRunner
+
+class ClientPoolTests(unittest.TestCase):
+    def test_pool_size(self):
+        pool = RpcClientPool('localhost', 5500, max_size=2)
+
+        client1 = pool.acquire()
+        client2 = pool.acquire()
+        self.assertNotEqual(client1, client2)
+
+        # all clients are leased
+        with self.assertRaises(PoolTimeoutError):
+            pool.acquire(0.1)
+
+        # a returned client is leased again
+        pool.release(client1)
+        self.assertIs(client1, pool.acquire(0.1))
+
+        # a client can only be returned once
+        pool.release(client1)
+        with self.assertRaises(ValueError):
+            pool.release(client1)
+
+        status = pool.get_status()
+        self.assertEqual(2, status['created'])
+        self.assertEqual(1, status['leased'])
+        self.assertEqual(1, status['idle'])
+        self.assertEqual(3, status['checkouts'])
+        self.assertEqual(1, status['timeouts'])
+        self.assertEqual(3, status['wait_time']['count'])
+
+        pool.close()
+        with self.assertRaises(ValueError):
+            pool.acquire()
+
+    def test_waiting_thread(self):
+        pool = RpcClientPool('localhost', 5500, max_size=1)
+        client = pool.acquire()
+
+        leased = []
+        def acquire():
+            leased.append(pool.acquire(5))
+
+        t = threading.Thread(target = acquire, args = ())
+        t.start()
+
+        pool.release(client)
+        t.join()
+
+        self.assertEqual([client], leased)
+
+    def test_configuration(self):
+        pool = RpcClientPool('unix:///tmp/reflectrpc.sock', 0)
+        pool.enable_http('/jsonrpc')
+        pool.enable_http_basic_auth('testuser', '123456')
+        pool.set_timeout(10)
+        pool.set_codec('json')
+
+        client = pool.acquire()
+        self.assertEqual('unix:///tmp/reflectrpc.sock', client.host)
+        self.assertTrue(client.http_enabled)
+        self.assertEqual('/jsonrpc', client.http_path)
+        self.assertEqual('testuser', client.http_basic_username)
+        self.assertEqual(10, client.timeout)
+        self.assertEqual('json', client.codec.name)
+        self.assertIsNot(pool.template, client)
+
+    def test_broken_connection(self):
+        server = FakeServer('localhost', 5500)
+        server.add_reply('{"error": null, "result": "Hello Server", "id": 1}')
+        server.run()
+
+        pool = RpcClientPool('localhost', 5500)
+
+        try:
+            self.assertEqual('Hello Server', pool.rpc_call('echo', 'Hello Server'))
+            server.stop()
+
+            # the server closed the idle connection
+            client = pool.acquire()
+            self.assertFalse(client.is_connected())
+
+            status = pool.get_status()
+            self.assertEqual(2, status['created'])
+            self.assertEqual(1, status['evicted'])
+        finally:
+            pool.close()
+
+    def test_lease(self):
+        pool = RpcClientPool('localhost', 5500)
+
+        # an RpcError leaves the connection usable
+        with self.assertRaises(RpcError):
+            with pool.lease() as client:
+                raise RpcError({'name': 'JsonRpcError', 'message': 'failed'})
+
+        self.assertEqual(1, pool.get_status()['idle'])
+
+        # after other errors the connection is closed
+        with self.assertRaises(NetworkError):
+            with pool.lease() as client:
+                raise NetworkError('failed')
+
+        status = pool.get_status()
+        self.assertEqual(0, status['idle'])
+        self.assertEqual(0, status['leased'])
+        self.assertEqual(1, status['evicted'])
+
+    def test_max_idle_time(self):
+        pool = RpcClientPool('localhost', 5500, max_idle_time=0)
+
+        with pool.lease() as client:
+            pass
+
+        status = pool.get_status()
+        self.assertEqual(0, status['idle'])
+        self.assertEqual(1, status['evicted'])
+
+    def test_concurrent_calls(self):
+        server = ServerRunner('../examples/serverconcurrent.py', 5500)
+        server.run()
+
+        pool = RpcClientPool('localhost', 5500, max_size=3)
+        results = []
+        lock = threading.Lock()
+
+        def call():
+            for i in range(20):
+                result = pool.rpc_call('echo', 'Hello %d' % (i))
+                with lock:
+                    results.append(result)
+
+        try:
+            threads = [threading.Thread(target = call, args = ()) for i in range(8)]
+            for t in threads:
+                t.start()
+
+            for t in threads:
+                t.join()
+
+            self.assertEqual(160, len(results))
+            self.assertEqual(sorted(['Hello %d' % (i) for i in range(20)] * 8),
+                    sorted(results))
+
+            status = pool.get_status()
+            self.assertTrue(status['created'] <= 3)
+            self.assertEqual(0, status['leased'])
+            self.assertEqual(160, status['checkouts'])
+        finally:
+            pool.close()
+            server.stop()
+
+if __name__ == '__main__':
+    unittest.main()
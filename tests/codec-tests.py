@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import sys
+import unittest
+
+sys.path.append('..')
+
+import reflectrpc.codec
+from reflectrpc import RpcProcessor
+from reflectrpc import RpcFunction
+from reflectrpc.codec import JsonCodec
+from reflectrpc.codec import StdlibJsonCodec
+from reflectrpc.codec import available_codecs
+from reflectrpc.codec import get_codec
+from reflectrpc.codec import register_codec
+from reflectrpc.codec import set_default_codec
+
+def echo(msg):
+    return msg
+
+class CodecTests(unittest.TestCase):
+    def test_available_codecs(self):
+        codecs = available_codecs()
+
+        # the stdlib codec is always available and the slowest one
+        self.assertEqual(codecs[-1], 'json')
+        self.assertEqual(get_codec().name, codecs[0])
+
+    def test_roundtrip(self):
+        value = {'id': 1, 'result': ['Hällo', 3.5, True, None, {'a': -5}],
+                'error': None}
+
+        for name in available_codecs():
+            codec = get_codec(name)
+
+            data = codec.dumps(value)
+            self.assertTrue(isinstance(data, bytes))
+            self.assertEqual(codec.loads(data), value)
+            self.assertEqual(codec.loads(data.decode('utf-8')), value)
+
+    def test_same_encoding(self):
+        stdlib = get_codec('json')
+
+        # all codecs handle what the json module handles
+        for name in available_codecs():
+            codec = get_codec(name)
+
+            self.assertEqual(codec.dumps({1: 'a', 2.5: None}), b'{"1":"a","2.5":null}')
+
+            big = [2 ** 70, -2 ** 70, 18446744073709551615]
+            self.assertEqual(codec.dumps(big), stdlib.dumps(big))
+            self.assertEqual(codec.loads(stdlib.dumps(big)), big)
+            self.assertEqual(codec.loads(stdlib.dumps(big).decode('utf-8')), big)
+
+    def test_invalid_json(self):
+        for name in available_codecs():
+            codec = get_codec(name)
+
+            self.assertRaises(ValueError, codec.loads, b'{"id": 1')
+            self.assertRaises(ValueError, codec.loads, b'{"id": 1} x')
+            self.assertRaises(ValueError, codec.loads, b'\xff\xfe')
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, get_codec, 'nosuchcodec')
+        self.assertRaises(ValueError, set_default_codec, 'nosuchcodec')
+
+    def test_default_codec(self):
+        try:
+            set_default_codec('json')
+            self.assertEqual(get_codec().name, 'json')
+            self.assertEqual(RpcProcessor().codec.name, 'json')
+        finally:
+            set_default_codec(None)
+
+        self.assertEqual(get_codec().name, available_codecs()[0])
+
+    def test_register_codec(self):
+        class UppercaseCodec(StdlibJsonCodec):
+            name = 'uppercase'
+
+            def dumps(self, value):
+                return StdlibJsonCodec.dumps(self, value).upper()
+
+        self.assertRaises(ValueError, register_codec, object)
+        register_codec(UppercaseCodec)
+
+        try:
+            self.assertRaises(ValueError, register_codec, UppercaseCodec)
+            self.assertEqual(available_codecs()[-1], 'uppercase')
+
+            rpc = RpcProcessor()
+            rpc.set_codec('uppercase')
+
+            echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                    'string', 'Same value as the first parameter')
+            echo_func.add_param('string', 'message', 'Message to send back')
+            rpc.add_function(echo_func)
+
+            reply = rpc.process_request(b'{"method": "echo", "params": ["Hello"], "id": 1}')
+            self.assertEqual(reply['result'], 'Hello')
+            self.assertTrue(b'"RESULT":"HELLO"' in rpc.codec.dumps(reply))
+        finally:
+            reflectrpc.codec.codec_classes.remove(UppercaseCodec)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,15 +7,27 @@ import json
 import sys
 import unittest
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 sys.path.append('..')
 
 from reflectrpc import RpcProcessor
 from reflectrpc import RpcFunction
 from reflectrpc.server import AbstractJsonRpcServer
+from reflectrpc.server import LineTooLongError
+from reflectrpc.simpleserver import BufferedJsonRpcServer
+from reflectrpc.simpleserver import ConcurrentJsonRpcServer
+from reflectrpc.simpleserver import JsonRpcServer
 
 def echo(msg):
     return msg
 
+async def async_echo(msg):
+    return msg
+
 class DummyServer(AbstractJsonRpcServer):
     def send_data(self, data):
         if not hasattr(self, 'responses'):
@@ -23,6 +35,21 @@ class DummyServer(AbstractJsonRpcServer):
 
         self.responses.append(data)
 
+class PartialSendSocket(object):
+    """
+    Socket that sends at most 7 bytes per call
+    """
+    def __init__(self):
+        self.sent = b''
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        data = b''.join(bytes(b) for b in buffers)[:7]
+        self.sent += data
+
+        return len(data)
+
 class LineServerTests(unittest.TestCase):
     def test_invalid_json(self):
         rpc = RpcProcessor()
@@ -81,5 +108,282 @@ class LineServerTests(unittest.TestCase):
         msg = json.loads(msgstr)
         self.assertEqual({"result": "Hello Echo", "error": None, "id": 3}, msg)
 
+    def test_batch_messages(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+
+        rpc.add_function(echo_func)
+        server = DummyServer(rpc, None)
+
+        server.data_received(b'[{"method": "echo", "params": ["Hello"], "id": 1}, {"method": "echo", "params": ["Server"], "id": 2}]\r\n')
+        self.assertEqual(1, len(server.responses))
+        msg = json.loads(server.responses[0].decode("utf-8"))
+        self.assertEqual([{"result": "Hello", "error": None, "id": 1},
+            {"result": "Server", "error": None, "id": 2}], msg)
+
+    def test_coroutine_messages(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(async_echo, 'async_echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+
+        rpc.add_function(echo_func)
+        server = DummyServer(rpc, None)
+
+        server.data_received(b'{"method": "async_echo", "params": ["Hello"], "id": 1}\r\n')
+        server.data_received(b'{"method": "async_echo", "params": ["Hello"], "id": null}\r\n')
+        self.assertEqual(1, len(server.responses))
+        msg = json.loads(server.responses[0].decode("utf-8"))
+        self.assertEqual({"result": "Hello", "error": None, "id": 1}, msg)
+
+        server.connection_lost()
+
+    def test_failed_deferred_reply(self):
+        try:
+            from twisted.internet import defer
+        except ImportError:
+            self.skipTest('Twisted is not installed')
+
+        rpc = RpcProcessor()
+        server = DummyServer(rpc, None)
+
+        d = defer.Deferred()
+        server.handle_reply(d)
+        d.errback(RuntimeError('Encoding failed'))
+
+        self.assertEqual(json.loads(server.responses[0].decode('utf-8')),
+                {'id': -1, 'result': None, 'error': {'name': 'InternalError', 'message': 'Internal error'}})
+
+    def test_split_utf8_character(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+
+        rpc.add_function(echo_func)
+        server = DummyServer(rpc, None)
+
+        # a multibyte character split across two reads
+        data = '{"method": "echo", "params": ["Gr\u00fc\u00dfe"], "id": 1}\n'.encode('utf-8')
+        split = data.index(b'\xc3') + 1
+        server.data_received(data[:split])
+        server.data_received(data[split:])
+
+        self.assertEqual(1, len(server.responses))
+        msg = json.loads(server.responses[0].decode("utf-8"))
+        self.assertEqual({"result": "Gr\u00fc\u00dfe", "error": None, "id": 1}, msg)
+
+    def test_pipelined_messages(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+
+        rpc.add_function(echo_func)
+        server = DummyServer(rpc, None)
+
+        # LF and CRLF line endings in one read, the last message incomplete
+        data = b''.join(b'{"method": "echo", "params": ["%d"], "id": %d}%s' %
+                (i, i, b'\n' if i % 2 else b'\r\n') for i in range(1000))
+        server.data_received(data + b'{"method": "echo", ')
+
+        # the replies are sent with a single write
+        self.assertEqual(1, len(server.responses))
+        self.assertEqual(1000, server.responses[0].count(b'\r\n'))
+
+        server.data_received(b'"params": ["last"], "id": 1000}\r\n')
+        self.assertEqual(2, len(server.responses))
+
+        replies = b''.join(server.responses).split(b'\r\n')[:-1]
+        ids = [json.loads(r.decode("utf-8"))['id'] for r in replies]
+        self.assertEqual(list(range(1001)), ids)
+
+    def test_flush_threshold(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+
+        rpc.add_function(echo_func)
+
+        data = b''.join(b'{"method": "echo", "params": ["%s"], "id": %d}\n' %
+                (b'x' * 100, i) for i in range(100))
+
+        # replies are sent once there are 1000 bytes of them
+        server = DummyServer(rpc, None, flush_threshold=1000)
+        server.data_received(data)
+
+        self.assertEqual(100, b''.join(server.responses).count(b'\r\n'))
+        self.assertTrue(10 < len(server.responses) < 20)
+        for write in server.responses[:-1]:
+            self.assertTrue(len(write) >= 1000)
+
+        # without a threshold every reply is sent at once
+        server = DummyServer(rpc, None, flush_threshold=None)
+        server.data_received(data)
+
+        self.assertEqual(100, len(server.responses))
+
+    def test_concurrent_server_flush_threshold(self):
+        import selectors
+        import socket
+
+        server = ConcurrentJsonRpcServer(RpcProcessor(), 'localhost', 0)
+        server.set_flush_threshold(None)
+
+        server.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.socket.bind(('localhost', 0))
+        server.socket.listen(1)
+        server.selector = selectors.DefaultSelector()
+
+        client = socket.create_connection(server.socket.getsockname())
+        try:
+            server.accept()
+
+            connections = [key.data for key in server.selector.get_map().values()]
+            self.assertEqual(1, len(connections))
+            self.assertIsNone(connections[0].flush_threshold)
+        finally:
+            client.close()
+            server.shutdown()
+
+    def test_concurrent_server_busy_connection(self):
+        import selectors
+        import socket
+
+        server = ConcurrentJsonRpcServer(RpcProcessor(), 'localhost', 0)
+        server.selector = selectors.DefaultSelector()
+
+        conn, peer = socket.socketpair()
+        try:
+            connection = BufferedJsonRpcServer(server.rpcprocessor, conn)
+            connection.outbuf += b'{"id":1}\r\n'
+            server.update_events(connection)
+            self.assertEqual(selectors.EVENT_READ | selectors.EVENT_WRITE,
+                    connection.events)
+
+            # the output buffer belongs to the worker thread while it runs
+            connection.busy = True
+            server.update_events(connection)
+            self.assertEqual(0, connection.events)
+
+            server.handle_events(connection, selectors.EVENT_WRITE)
+            self.assertEqual(b'{"id":1}\r\n', bytes(connection.outbuf))
+        finally:
+            conn.close()
+            peer.close()
+            server.selector.close()
+
+    def test_large_message(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+
+        rpc.add_function(echo_func)
+        server = DummyServer(rpc, None)
+
+        # a 4 MB message sent in 1 KB chunks
+        value = 'x' * (4 * 1024 * 1024)
+        data = json.dumps({"method": "echo", "params": [value], "id": 1}).encode('utf-8') + b'\r\n'
+        for i in range(0, len(data), 1024):
+            server.data_received(data[i:i + 1024])
+
+        self.assertEqual(1, len(server.responses))
+        msg = json.loads(server.responses[0].decode("utf-8"))
+        self.assertEqual(value, msg['result'])
+        self.assertEqual(0, len(server.buf))
+
+    def test_max_line_length(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+
+        rpc.add_function(echo_func)
+        server = DummyServer(rpc, None, max_line_length=100)
+
+        # a message of exactly the maximum length is accepted
+        request = b'{"method": "echo", "params": ["%s"], "id": 1}' % (b'x' * 57)
+        self.assertEqual(100, len(request))
+        server.data_received(request + b'\r\n')
+        self.assertEqual(1, len(server.responses))
+
+        # an incomplete message that grows too long is rejected early
+        with self.assertRaises(LineTooLongError):
+            server.data_received(b'x' * 101)
+
+        self.assertEqual(2, len(server.responses))
+        msg = json.loads(server.responses[1].decode("utf-8"))
+        self.assertEqual('InvalidRequest', msg['error']['name'])
+        self.assertEqual(0, len(server.buf))
+
+        # so is a complete one
+        with self.assertRaises(LineTooLongError):
+            server.data_received(b'x' * 101 + b'\n')
+
+        self.assertEqual(3, len(server.responses))
+
+    @unittest.skipIf(ijson is None, 'ijson is not installed')
+    def test_incremental_decoding(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+
+        rpc.add_function(echo_func)
+        server = DummyServer(rpc, None, max_line_length=1024 * 1024)
+        server.enable_incremental_decoding(16384)
+
+        # a large message is passed to the parser in chunks while it arrives,
+        # the small one after it is processed as usual
+        value = 'Gr\u00fc\u00dfe ' * 50000
+        data = json.dumps({"method": "echo", "params": [value], "id": 1}).encode('utf-8') + b'\r\n'
+        data += b'{"method": "echo", "params": ["small"], "id": 2}\n'
+
+        for i in range(0, len(data) - 1000, 1000):
+            server.data_received(data[i:i + 1000])
+            self.assertTrue(len(server.buf) <= 16384)
+
+        self.assertFalse(hasattr(server, 'responses'))
+        server.data_received(data[i + 1000:])
+
+        self.assertEqual(2, len(server.responses))
+        msg = json.loads(server.responses[0].decode("utf-8"))
+        self.assertEqual({"result": value, "error": None, "id": 1}, msg)
+        msg = json.loads(server.responses[1].decode("utf-8"))
+        self.assertEqual({"result": "small", "error": None, "id": 2}, msg)
+
+        # invalid JSON is skipped up to the linebreak
+        server.data_received(b'{"method": "echo", "params": ["' + b'x' * 20000 + b'" x}\n')
+        self.assertEqual(3, len(server.responses))
+        msg = json.loads(server.responses[2].decode("utf-8"))
+        self.assertEqual('Received invalid JSON', msg['error']['message'])
+
+        # the maximum line length still applies
+        server.data_received(b'[' + b'1,' * 10000)
+        with self.assertRaises(LineTooLongError):
+            server.data_received(b'1,' * (1024 * 1024))
+
+    def test_send_data_sequence(self):
+        conn = PartialSendSocket()
+        server = JsonRpcServer(RpcProcessor(), conn)
+
+        chunks = [b'{"id":1}', b'\r\n', b'', b'{"id":2}', b'\r\n']
+        server.send_data_sequence(chunks)
+
+        self.assertEqual(b''.join(chunks), conn.sent)
+        self.assertEqual(3, conn.calls)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import sys
+import unittest
+
+sys.path.append('..')
+
+from reflectrpc import RpcProcessor
+from reflectrpc.memory import MemoryTracer
+from reflectrpc.server import AbstractJsonRpcServer
+
+class DummyServer(AbstractJsonRpcServer):
+    def send_data(self, data):
+        pass
+
+class MemoryTracerTests(unittest.TestCase):
+    def tearDown(self):
+        MemoryTracer().stop()
+
+    def test_snapshot_requires_tracing(self):
+        tracer = MemoryTracer()
+
+        with self.assertRaises(ValueError):
+            tracer.take_snapshot('before')
+
+    def test_compare_snapshots(self):
+        tracer = MemoryTracer()
+        tracer.start()
+
+        status = tracer.take_snapshot('before')
+        self.assertTrue(status['tracing'])
+        self.assertEqual(status['snapshots'], ['before'])
+
+        blocks = [bytearray(1000) for i in range(100)]
+
+        tracer.take_snapshot('after')
+
+        sites = tracer.compare_snapshots('before', 'after', 5)
+        self.assertTrue(len(sites) <= 5)
+        self.assertTrue(sites[0]['file'].endswith('memory-tests.py'))
+        self.assertTrue(sites[0]['size_diff'] >= 100000)
+        self.assertTrue(sites[0]['count_diff'] >= 100)
+
+        sites = tracer.compare_snapshots('before', 'after', 5, 'filename')
+        self.assertEqual(sites[0]['line'], 0)
+
+        with self.assertRaises(ValueError):
+            tracer.compare_snapshots('before', 'unknown')
+
+        with self.assertRaises(ValueError):
+            tracer.compare_snapshots('before', 'after', 5, 'traceback')
+
+        tracer.stop()
+        self.assertEqual(tracer.get_status()['snapshots'], [])
+        self.assertFalse(tracer.get_status()['tracing'])
+
+    def test_connection_buffer(self):
+        tracer = MemoryTracer()
+        tracer.start()
+        tracer.take_snapshot('before')
+
+        # a client that never sends a linebreak makes the buffer grow
+        server = DummyServer(RpcProcessor(), None)
+        for i in range(100):
+            server.data_received(b'x' * 1000)
+
+        tracer.take_snapshot('after')
+
+        sites = tracer.compare_snapshots('before', 'after', 3)
+        files = [site['file'] for site in sites]
+        self.assertTrue([f for f in files if f.endswith('server.py')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append('..')
+
+from reflectrpc.metrics import InFlightRequests
+from reflectrpc.metrics import LagMonitor
+from reflectrpc.metrics import LatencyHistogram
+from reflectrpc.metrics import Metrics
+from reflectrpc.metrics import PhaseTimings
+from reflectrpc.metrics import RequestTiming
+from reflectrpc.metrics import SlowRequestLog
+from reflectrpc.metrics import timer
+
+class MetricsTests(unittest.TestCase):
+    def test_histogram(self):
+        histogram = LatencyHistogram((0.1, 1.0))
+
+        histogram.record(0.05)
+        histogram.record(0.1)
+        histogram.record(0.5)
+        histogram.record(2.0)
+
+        # values on a bound are counted in its bucket
+        self.assertEqual(histogram.to_dict(), {'bounds': [0.1, 1.0],
+            'counts': [2, 1, 1], 'count': 4, 'sum': 2.65})
+
+    def test_metrics(self):
+        metrics = Metrics((0.1, 1.0))
+
+        metrics.record('echo', 0.05)
+        metrics.record('echo', 0.5, 'JsonRpcError')
+        metrics.record('add', 2.0, 'InternalError')
+        metrics.record('add', 2.0, 'InternalError')
+
+        self.assertEqual(metrics.to_dict(), {
+            'echo': {'calls': 2, 'errors': {'JsonRpcError': 1},
+                'latency': {'bounds': [0.1, 1.0], 'counts': [1, 1, 0],
+                    'count': 2, 'sum': 0.55}},
+            'add': {'calls': 2, 'errors': {'InternalError': 2},
+                'latency': {'bounds': [0.1, 1.0], 'counts': [0, 0, 2],
+                    'count': 2, 'sum': 4.0}}
+        })
+
+        metrics.reset()
+        self.assertEqual(metrics.to_dict(), {})
+
+    def test_metrics_threads(self):
+        metrics = Metrics()
+
+        def record_calls():
+            for i in range(10000):
+                metrics.record('echo', 0.001)
+
+        threads = [threading.Thread(target=record_calls) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        result = metrics.to_dict()
+        self.assertEqual(result['echo']['calls'], 40000)
+        self.assertEqual(result['echo']['latency']['count'], 40000)
+
+    def test_phase_timings(self):
+        timing = RequestTiming(0.25)
+        timing.mark('decode')
+        timing.mark('execution')
+        timing.mark('execution')
+        self.assertEqual(sorted(timing.phases.keys()), ['decode', 'execution', 'framing'])
+
+        timings = PhaseTimings()
+        timings.record('echo', {'decode': 1.0, 'execution': 2.0})
+        timings.record('echo', {'decode': 3.0})
+
+        result = timings.to_dict()
+        self.assertEqual(result['echo']['count'], 2)
+        self.assertEqual(result['echo']['phases']['decode'],
+                {'total': 4.0, 'mean': 2.0, 'max': 3.0})
+        self.assertEqual(result['echo']['phases']['execution'],
+                {'total': 2.0, 'mean': 1.0, 'max': 2.0})
+
+        timings.reset()
+        self.assertEqual(timings.to_dict(), {})
+
+    def test_slow_request_log(self):
+        log = SlowRequestLog(max_entries=2, threshold=1.0, max_param_length=10)
+        start = timer()
+
+        log.add('a', [1], None, start, 0.1)
+        log.add('b', [2], 'bob', start, 0.3, {'decode': 0.01})
+        self.assertEqual(log.min_seconds, 0.1)
+
+        log.add('c', ['long parameter'], None, start, 0.2)
+        log.add('d', [4], None, start, 0.05)
+        log.add('e', [5], None, start, 1.5, None, True, 'InternalError')
+
+        result = log.to_dict()
+        self.assertEqual([e['method'] for e in result['slowest']], ['e', 'b'])
+        self.assertEqual([e['method'] for e in result['over_threshold']], ['e'])
+
+        entry = result['slowest'][1]
+        self.assertEqual(entry['params'], '[2]')
+        self.assertEqual(entry['username'], 'bob')
+        self.assertEqual(entry['phases'], {'decode': 0.01})
+        self.assertFalse(entry['deferred'])
+        self.assertAlmostEqual(entry['finished'] - entry['started'], 0.3)
+
+        entry = result['slowest'][0]
+        self.assertTrue(entry['deferred'])
+        self.assertEqual(entry['error'], 'InternalError')
+
+        log.add('f', ['long parameter'], None, start, 2.0)
+        self.assertEqual(log.to_dict()['over_threshold'][1]['params'], '["long par...')
+
+        log.clear()
+        self.assertEqual(log.to_dict()['slowest'], [])
+        self.assertEqual(log.min_seconds, 0.0)
+
+    def test_slow_request_log_window(self):
+        log = SlowRequestLog(max_entries=1, threshold=10.0, window=60.0)
+        start = timer()
+
+        log.add('a', [], None, start, 5.0)
+        log.add('b', [], None, start + 30.0, 1.0)
+        self.assertEqual([e['method'] for e in log.to_dict()['slowest']], ['a'])
+        self.assertEqual(log.next_expiry, start + 65.0)
+
+        # the slowest request left the time window
+        log.add('c', [], None, start + 70.0, 1.0)
+        self.assertEqual([e['method'] for e in log.to_dict()['slowest']], ['c'])
+
+    def test_lag_monitor(self):
+        scheduled = []
+
+        class Handle(object):
+            def cancel(self):
+                scheduled.pop()
+
+        def call_later(seconds, func):
+            scheduled.append(func)
+            return Handle()
+
+        monitor = LagMonitor(0.01, 0.02, (0.01, 0.1))
+        monitor.start(call_later)
+
+        # a method blocking the loop makes the next tick late
+        monitor.enter_method('sleep')
+        time.sleep(0.05)
+        monitor.exit_method()
+
+        monitor.enter_method('echo')
+        monitor.exit_method()
+
+        scheduled.pop()()
+
+        # other threads are not attributed
+        def call_method():
+            monitor.enter_method('threaded')
+            time.sleep(0.05)
+            monitor.exit_method()
+
+        t = threading.Thread(target=call_method)
+        t.start()
+        t.join()
+
+        scheduled.pop()()
+
+        result = monitor.to_dict()
+        self.assertEqual(result['lag']['count'], 2)
+        self.assertEqual(result['over_threshold'], 2)
+        self.assertTrue(result['max'] >= 0.04)
+        self.assertEqual(sorted(result['methods'].keys()), ['[unknown]', 'sleep'])
+        self.assertEqual(result['methods']['sleep']['count'], 1)
+
+        monitor.stop()
+        self.assertEqual(scheduled, [])
+
+        monitor.reset()
+        self.assertEqual(monitor.to_dict()['methods'], {})
+
+    def test_in_flight_requests(self):
+        in_flight = InFlightRequests()
+
+        first = in_flight.add('echo', {'username': 'alice', 'peer': '127.0.0.1:4000'})
+        second = in_flight.add('add', {'authenticated': False, 'username': None})
+        in_flight.set_waiting(second)
+
+        requests = in_flight.to_list()
+        self.assertEqual([r['id'] for r in requests], [first, second])
+        self.assertEqual(requests[0]['peer'], '127.0.0.1:4000')
+        self.assertEqual(requests[0]['username'], 'alice')
+        self.assertFalse(requests[0]['waiting'])
+        self.assertTrue(requests[0]['elapsed'] >= requests[1]['elapsed'])
+        self.assertEqual(requests[1]['peer'], None)
+        self.assertTrue(requests[1]['waiting'])
+
+        in_flight.remove(first)
+        self.assertEqual(in_flight.remove_callback('value', second), 'value')
+        self.assertEqual(in_flight.to_list(), [])
+
+if __name__ == '__main__':
+    unittest.main()
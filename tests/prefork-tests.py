@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import os
+import signal
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.append('..')
+
+import reflectrpc.prefork
+from reflectrpc.prefork import create_listening_socket, describe_status
+from reflectrpc.prefork import PreforkMaster
+
+class PreforkTests(unittest.TestCase):
+    def test_listening_socket(self):
+        sock = create_listening_socket('localhost', 0)
+        try:
+            port = sock.getsockname()[1]
+            client = socket.create_connection(('localhost', port))
+            client.close()
+        finally:
+            sock.close()
+
+    def test_reuse_port(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            self.skipTest('SO_REUSEPORT is not supported')
+
+        sock1 = create_listening_socket('localhost', 0, reuse_port=True)
+        port = sock1.getsockname()[1]
+        sock2 = create_listening_socket('localhost', port, reuse_port=True)
+
+        sock1.close()
+        sock2.close()
+
+    def test_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'prefork.sock')
+
+        # a stale socket file is replaced
+        open(path, 'w').close()
+
+        sock = create_listening_socket('unix://' + path, 0,
+                unix_socket_mode=0o600)
+        try:
+            self.assertTrue(stat.S_ISSOCK(os.stat(path).st_mode))
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+        finally:
+            sock.close()
+            os.unlink(path)
+
+        with self.assertRaises(ValueError):
+            create_listening_socket('unix://' + path, 0, reuse_port=True)
+
+    def test_describe_status(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(3)
+
+        self.assertEqual(describe_status(os.waitpid(pid, 0)[1]), 'exit code 3')
+
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(10)
+            os._exit(0)
+
+        os.kill(pid, signal.SIGKILL)
+        self.assertEqual(describe_status(os.waitpid(pid, 0)[1]),
+                'killed by signal 9')
+
+    def test_master(self):
+        # workers report their number and PID through a pipe and crash once
+        read_fd, write_fd = os.pipe()
+        crashed = os.path.join(tempfile.mkdtemp(), 'crashed')
+
+        old_lifetime = reflectrpc.prefork.min_worker_lifetime
+        reflectrpc.prefork.min_worker_lifetime = 0.0
+
+        def run_worker(number):
+            os.write(write_fd, ('%d %d\n' % (number, os.getpid())).encode('ascii'))
+
+            if number == 0 and not os.path.exists(crashed):
+                open(crashed, 'w').close()
+                os._exit(1)
+
+            while True:
+                time.sleep(0.1)
+
+        master = PreforkMaster(2, run_worker, freeze_gc=False, grace_period=5.0)
+        stopper = threading.Timer(1.5, master.handle_signal, (signal.SIGTERM, None))
+        stopper.start()
+
+        try:
+            self.assertEqual(master.run(), 0)
+        finally:
+            stopper.cancel()
+            reflectrpc.prefork.min_worker_lifetime = old_lifetime
+
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            started = [line.split() for line in f.read().splitlines()]
+
+        # worker 0 was restarted after it crashed
+        self.assertEqual(sorted(number for number, pid in started), ['0', '0', '1'])
+        self.assertEqual(master.children, {})
+        self.assertTrue(master.stopping)
+
+if __name__ == '__main__':
+    unittest.main()
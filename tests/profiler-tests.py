@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.append('..')
+
+from reflectrpc.profiler import SamplingProfiler
+
+def busy_loop(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+class SamplingProfilerTests(unittest.TestCase):
+    def test_attribution(self):
+        profiler = SamplingProfiler()
+        stopped = threading.Event()
+
+        def work():
+            profiler.enter_method('busy')
+            busy_loop(0.3)
+            profiler.exit_method()
+
+        profiler.start(0.2, 200, stopped.set)
+        self.assertTrue(profiler.is_running())
+
+        t = threading.Thread(target=work)
+        t.start()
+        t.join()
+
+        self.assertTrue(stopped.wait(5))
+        self.assertFalse(profiler.is_running())
+
+        profile = profiler.get_profile()
+        self.assertFalse(profile['running'])
+        self.assertTrue(profile['samples'] > 0)
+        self.assertEqual(profile['interval'], 0.005)
+
+        lines = profile['data'].split('\n')
+        busy = [l for l in lines if l.startswith('busy;')]
+        self.assertTrue(busy)
+        self.assertTrue('busy_loop (' in busy[0])
+
+        # samples of threads without an RPC method carry the thread name
+        self.assertTrue([l for l in lines if l.startswith('[MainThread];')])
+
+    def test_stop(self):
+        profiler = SamplingProfiler()
+        profiler.start(60, 100)
+        time.sleep(0.05)
+        profiler.stop()
+
+        self.assertFalse(profiler.is_running())
+        self.assertTrue(profiler.get_profile()['duration'] < 60)
+
+    def test_wrap(self):
+        profiler = SamplingProfiler()
+        func = profiler.wrap('echo', lambda value: profiler.methods.copy())
+
+        self.assertEqual(list(func('Hello').values()), ['echo'])
+        self.assertEqual(profiler.methods, {})
+
+    def test_pstats(self):
+        profiler = SamplingProfiler()
+        profiler.interval = 0.01
+        profiler.stacks = {
+                ('echo', (('a.py', 1, 'outer'), ('a.py', 5, 'inner'))): 3,
+                ('echo', (('a.py', 1, 'outer'),)): 1
+        }
+
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(profiler.to_pstats())
+
+            stats = pstats.Stats(path).stats
+        finally:
+            os.remove(path)
+
+        cc, nc, tt, ct, callers = stats[('a.py', 1, 'outer')]
+        self.assertEqual(nc, 4)
+        self.assertAlmostEqual(tt, 0.01)
+        self.assertAlmostEqual(ct, 0.04)
+        self.assertEqual(callers, {('<rpc>', 0, 'echo'): 4})
+
+        cc, nc, tt, ct, callers = stats[('a.py', 5, 'inner')]
+        self.assertAlmostEqual(tt, 0.03)
+        self.assertEqual(callers, {('a.py', 1, 'outer'): 3})
+
+        self.assertEqual(profiler.to_collapsed(),
+                'echo;outer (a.py:1) 1\necho;outer (a.py:1);inner (a.py:5) 3')
+
+if __name__ == '__main__':
+    unittest.main()
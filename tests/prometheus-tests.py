@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import sys
+import unittest
+
+sys.path.append('..')
+
+from reflectrpc import RpcProcessor
+from reflectrpc import RpcFunction
+from reflectrpc.metrics import LagMonitor
+from reflectrpc.prometheus import escape_label_value, generate_metrics
+
+def echo(message):
+    return message
+
+class PrometheusTests(unittest.TestCase):
+    def test_escape_label_value(self):
+        self.assertEqual(escape_label_value('a"b\\c\nd'), 'a\\"b\\\\c\\nd')
+
+    def test_generate_metrics(self):
+        rpc = RpcProcessor()
+        rpc.enable_metrics((0.1, 1.0))
+        rpc.enable_in_flight_tracking()
+
+        func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(func)
+
+        rpc.process_request('{"method": "echo", "params": ["Hello"], "id": 1}')
+        rpc.process_request('{"method": "echo", "params": [1], "id": 2}')
+
+        text = b''.join(generate_metrics(rpc, 3)).decode('utf-8')
+        lines = text.splitlines()
+
+        self.assertTrue('# TYPE reflectrpc_requests_total counter' in lines)
+        self.assertTrue('reflectrpc_requests_total{method="echo"} 2' in lines)
+        self.assertTrue('reflectrpc_errors_total{method="echo",error="TypeError"} 1' in lines)
+        self.assertTrue('reflectrpc_request_duration_seconds_bucket{method="echo",le="0.1"} 2' in lines)
+        self.assertTrue('reflectrpc_request_duration_seconds_bucket{method="echo",le="+Inf"} 2' in lines)
+        self.assertTrue('reflectrpc_request_duration_seconds_count{method="echo"} 2' in lines)
+        self.assertTrue('reflectrpc_connections 3' in lines)
+        self.assertTrue('# TYPE reflectrpc_in_flight_requests gauge' in lines)
+        self.assertFalse('reflectrpc_event_loop_lag_seconds' in text)
+
+        rpc.in_flight.add('echo', {'username': None})
+        text = b''.join(generate_metrics(rpc)).decode('utf-8')
+        self.assertTrue('reflectrpc_in_flight_requests{method="echo"} 1\n' in text)
+        self.assertFalse('reflectrpc_connections' in text)
+
+    def test_event_loop_lag(self):
+        rpc = RpcProcessor()
+        rpc.disable_metrics()
+        rpc.disable_in_flight_tracking()
+
+        monitor = LagMonitor(0.1, 0.05, (0.01, 0.1))
+        ticks = []
+        monitor.start(lambda seconds, func: ticks.append(func))
+        rpc.set_lag_monitor(monitor)
+
+        text = b''.join(generate_metrics(rpc)).decode('utf-8')
+        lines = text.splitlines()
+
+        self.assertEqual(lines[0], '# HELP reflectrpc_event_loop_lag_seconds Delay of the event loop running a periodic timer')
+        self.assertTrue('reflectrpc_event_loop_lag_seconds_count 0' in lines)
+        self.assertTrue('reflectrpc_event_loop_lag_max_seconds 0.0' in lines)
+
+    def test_metrics_resource_failure(self):
+        try:
+            from twisted.internet import task
+            from twisted.python import log
+            from twisted.web.test.requesthelper import DummyRequest
+            import reflectrpc.prometheus
+            import reflectrpc.twistedserver
+        except ImportError:
+            self.skipTest('Twisted is not installed')
+
+        def failing_metrics(rpcprocessor, connection_count=None):
+            yield b'# HELP reflectrpc_requests_total\n'
+            raise RuntimeError('broken metric')
+
+        # run the cooperative writer step by step
+        steps = []
+        class Step(object):
+            def cancel(self):
+                pass
+
+        cooperator = task.Cooperator(scheduler=lambda f: steps.append(f) or Step())
+
+        request = DummyRequest([b'metrics'])
+        lost = []
+        request.loseConnection = lambda: lost.append(True)
+
+        logged = []
+        def observer(event):
+            if event.get('isError'):
+                logged.append(event)
+
+        saved = (task.cooperate, reflectrpc.prometheus.generate_metrics)
+        task.cooperate = cooperator.cooperate
+        reflectrpc.prometheus.generate_metrics = failing_metrics
+        log.addObserver(observer)
+        try:
+            metrics = reflectrpc.twistedserver.MetricsResource(RpcProcessor())
+            metrics.render_GET(request)
+
+            while steps:
+                steps.pop(0)()
+        finally:
+            task.cooperate, reflectrpc.prometheus.generate_metrics = saved
+            log.removeObserver(observer)
+
+        # the connection is dropped instead of hanging
+        self.assertEqual([True], lost)
+        self.assertEqual(0, request.finished)
+        self.assertEqual(1, len(logged))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,7 @@
 from __future__ import unicode_literals
 from builtins import bytes, dict, list, int, float, str
 
+import os
 import sys
 import json
 import unittest
@@ -21,6 +22,15 @@ def test_function():
 def echo(msg):
     return msg
 
+def worker_pid():
+    return os.getpid()
+
+# changed at runtime, workers only see the new value if they are forked
+worker_state = 'imported'
+
+def get_worker_state():
+    return worker_state
+
 def add(a, b):
     return int(a) + int(b)
 
@@ -695,5 +705,1021 @@ class RpcProcessorTests(unittest.TestCase):
         self.assertEqual(reply['error'], None)
         self.assertEqual(reply['result'], {'somestrs': ['str1', 'str2'], 'someints': [1, 2, 3]})
 
+    def test_recursive_named_hash_validation(self):
+        rpc = RpcProcessor()
+
+        node_type = JsonHashType('Node', 'A node in a tree')
+        node_type.add_field('value', 'int', 'Value of the node')
+        node_type.add_field('children', 'array<Node>', 'Child nodes')
+
+        func = RpcFunction(echo_hash, 'echo_hash', 'Expects a tree and returns it',
+                'Node', 'Returns the tree passed by the caller')
+        func.add_param('Node', 'tree', 'A tree of nodes')
+
+        rpc.add_custom_type(node_type)
+        rpc.add_function(func)
+
+        reply = rpc.process_request('{"method": "echo_hash", "params": [{"value": 1, "children": [{"value": 2, "children": []}, {"value": 3, "children": [{"value": "4", "children": []}]}]}], "id": 1}')
+        self.assertEqual(reply['error'], {'name': 'TypeError', 'message': "echo_hash: Expected value of type 'int' for parameter 'tree.children[1].children[0].value' but got value of type 'string'"})
+        self.assertEqual(reply['result'], None)
+
+        reply = rpc.process_request('{"method": "echo_hash", "params": [{"value": 1, "children": [{"value": 2, "children": [], "parent": 1}]}], "id": 2}')
+        self.assertEqual(reply['error'], {'name': 'TypeError', 'message': "echo_hash: Named hash parameter 'tree.children[0]' of type 'Node': Unknown field 'parent'"})
+        self.assertEqual(reply['result'], None)
+
+        reply = rpc.process_request('{"method": "echo_hash", "params": [{"value": 1, "children": [{"value": 2, "children": []}]}], "id": 3}')
+        self.assertEqual(reply['error'], None)
+        self.assertEqual(reply['result'], {'value': 1, 'children': [{'value': 2, 'children': []}]})
+
+    def test_unknown_types_in_add_function(self):
+        rpc = RpcProcessor()
+
+        # unknown element type of a typed array
+        func = RpcFunction(echo_array, 'echo_array', '', 'array', '')
+        func.add_param('array<Foo>', 'foos', '')
+        self.assertRaises(ValueError, rpc.add_function, func)
+        self.assertFalse('echo_array' in rpc.functions_dict)
+
+        # unknown field type of a named hash
+        example_type = JsonHashType('Example', 'A named hash')
+        example_type.add_field('foo', 'Foo', 'Field of an unknown type')
+        rpc.add_custom_type(example_type)
+
+        func = RpcFunction(echo_hash, 'echo_hash', '', 'hash', '')
+        func.add_param('Example', 'example', '')
+        self.assertRaises(ValueError, rpc.add_function, func)
+
+        # works once the type is registered
+        foo_type = JsonHashType('Foo', 'Another named hash')
+        foo_type.add_field('value', 'int', 'Some integer')
+        rpc.add_custom_type(foo_type)
+        rpc.add_function(func)
+
+        reply = rpc.process_request('{"method": "echo_hash", "params": [{"foo": {"value": "1"}}], "id": 1}')
+        self.assertEqual(reply['error'], {'name': 'TypeError', 'message': "echo_hash: Expected value of type 'int' for parameter 'example.foo.value' but got value of type 'string'"})
+
+    def test_fields_added_after_add_function(self):
+        rpc = RpcProcessor()
+
+        example_type = JsonHashType('Example', 'A named hash')
+        example_type.add_field('x', 'int', 'Some integer')
+        rpc.add_custom_type(example_type)
+
+        func = RpcFunction(echo_hash, 'echo_hash', '', 'Example', '')
+        func.add_param('Example', 'example', '')
+        rpc.add_function(func)
+
+        reply = rpc.process_request('{"method": "echo_hash", "params": [{"x": 1}], "id": 1}')
+        self.assertEqual(reply['error'], None)
+
+        example_type.add_field('y', 'int', 'Another integer')
+
+        reply = rpc.process_request('{"method": "echo_hash", "params": [{"x": 1}], "id": 2}')
+        self.assertEqual(reply['error'], {'name': 'TypeError', 'message': "echo_hash: Named hash parameter 'example' of type 'Example': Missing field 'y'"})
+
+        reply = rpc.process_request('{"method": "echo_hash", "params": [{"x": 1, "y": "s"}], "id": 3}')
+        self.assertEqual(reply['error'], {'name': 'TypeError', 'message': "echo_hash: Expected value of type 'int' for parameter 'example.y' but got value of type 'string'"})
+
+        reply = rpc.process_request('{"method": "echo_hash", "params": [{"x": 1, "y": 2}], "id": 4}')
+        self.assertEqual(reply['error'], None)
+
+    def test_typed_arrays_with_enums(self):
+        rpc = RpcProcessor()
+
+        enum = JsonEnumType('PhoneType', 'Type of a phone number')
+        enum.add_value('HOME', 'Home phone')
+        enum.add_value('WORK', 'Work phone')
+
+        func = RpcFunction(echo_array, 'echo_array', 'Expects an array of phone types and returns it',
+                'array<PhoneType>', 'Returns the array passed by the caller')
+        func.add_param('array<PhoneType>', 'types', 'An array of phone types')
+
+        rpc.add_custom_type(enum)
+        rpc.add_function(func)
+
+        reply = rpc.process_request('{"method": "echo_array", "params": [["HOME", 1, "FAX"]], "id": 1}')
+        self.assertEqual(reply['error'], {'name': 'TypeError', 'message': "echo_array: 'FAX' is not a valid value for parameter 'types[2]' of enum type 'PhoneType'"})
+
+        reply = rpc.process_request('{"method": "echo_array", "params": [["HOME", true]], "id": 2}')
+        self.assertEqual(reply['error'], {'name': 'TypeError', 'message': "echo_array: Enum parameter 'types[1]' requires a value of type 'int' or 'string' but type was 'bool'"})
+
+        reply = rpc.process_request('{"method": "echo_array", "params": [["HOME", 1]], "id": 3}')
+        self.assertEqual(reply['error'], None)
+        self.assertEqual(reply['result'], ['HOME', 1])
+
+    def test_type_checks_for_null_values(self):
+        rpc = RpcProcessor()
+
+        func = RpcFunction(echo_array, 'echo_array', 'Expects an array of ints and returns it',
+                'array<int>', 'Returns the array passed by the caller')
+        func.add_param('array<int>', 'numbers', 'An array of integer values')
+
+        rpc.add_function(func)
+
+        reply = rpc.process_request('{"method": "echo_array", "params": [null], "id": 1}')
+        self.assertEqual(reply['error'], {'name': 'TypeError', 'message': "echo_array: Expected value of type 'array<int>' for parameter 'numbers' but got value of type 'null'"})
+
+        reply = rpc.process_request('{"method": "echo_array", "params": [[1, true, null]], "id": 2}')
+        self.assertEqual(reply['error'], {'name': 'TypeError', 'message': "echo_array: Expected value of type 'int' for parameter 'numbers[1]' but got value of type 'bool'"})
+
+    def test_batch_request(self):
+        global notify_was_called
+        notify_was_called = False
+
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(echo_func)
+
+        notify_func = RpcFunction(notify, 'notify', 'Notification function',
+                'bool', 'Does not return because it is a notification')
+        rpc.add_function(notify_func)
+
+        reply = rpc.process_request('[{"method": "echo", "params": ["Hello"], "id": 1}, {"method": "notify", "params": [], "id": null}, {"method": "echo", "params": [42], "id": 2}, 5]')
+        self.assertTrue(notify_was_called)
+        self.assertEqual(reply, [
+            {'id': 1, 'result': 'Hello', 'error': None},
+            {'id': 2, 'result': None, 'error': {'name': 'TypeError', 'message': "echo: Expected value of type 'string' for parameter 'message' but got value of type 'int'"}},
+            {'id': -1, 'result': None, 'error': {'name': 'InvalidRequest', 'message': 'Request must be a JSON object'}}
+        ])
+
+        # a batch of notifications gets no reply
+        notify_was_called = False
+        reply = rpc.process_request('[{"method": "notify", "params": [], "id": null}]')
+        self.assertEqual(reply, None)
+        self.assertTrue(notify_was_called)
+        notify_was_called = False
+
+        reply = rpc.process_request('[]')
+        self.assertEqual(reply, {'id': -1, 'result': None, 'error': {'name': 'InvalidRequest', 'message': 'Received empty batch'}})
+
+    def test_process_message(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(echo_func)
+
+        notify_func = RpcFunction(notify, 'notify', 'Notification function',
+                'bool', 'Does not return because it is a notification')
+        rpc.add_function(notify_func)
+
+        reply = rpc.process_message(b'{"method": "echo", "params": ["H\xc3\xa4llo"], "id": 1}')
+        self.assertTrue(isinstance(reply, bytes))
+        self.assertEqual(json.loads(reply.decode('utf-8')), {'id': 1, 'result': 'H\xe4llo', 'error': None})
+
+        reply = rpc.process_message(b'{"method": "echo", "params": [5], "id": 2}')
+        self.assertEqual(json.loads(reply.decode('utf-8'))['error']['name'], 'TypeError')
+
+        reply = rpc.process_message(b'{"method": "echo"')
+        self.assertEqual(json.loads(reply.decode('utf-8')), {'id': -1, 'result': None, 'error': {'name': 'InvalidRequest', 'message': 'Received invalid JSON'}})
+
+        reply = rpc.process_message(b'{"method": "notify", "params": [], "id": null}')
+        self.assertEqual(reply, None)
+
+        reply = rpc.process_message(b'[{"method": "echo", "params": ["a"], "id": 1}, {"method": "echo", "params": ["b"], "id": 2}]')
+        self.assertEqual(json.loads(reply.decode('utf-8')), [{'id': 1, 'result': 'a', 'error': None}, {'id': 2, 'result': 'b', 'error': None}])
+
+    def test_process_decoded_message(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(echo_func)
+
+        reply = rpc.process_decoded_message({'method': 'echo', 'params': ['Hello'], 'id': 1})
+        self.assertEqual(json.loads(reply.decode('utf-8')), {'id': 1, 'result': 'Hello', 'error': None})
+
+        reply = rpc.process_decoded_message([{'method': 'echo', 'params': ['a'], 'id': 1}])
+        self.assertEqual(json.loads(reply.decode('utf-8')), [{'id': 1, 'result': 'a', 'error': None}])
+
+        # the time the server spent decoding is recorded as decode phase
+        hook_calls = []
+        rpc.enable_phase_timing(lambda method, phases: hook_calls.append((method, phases)))
+        rpc.process_decoded_message({'method': 'echo', 'params': ['Hello'], 'id': 2},
+                None, 0.5, 0.25)
+
+        self.assertEqual(hook_calls[0][0], 'echo')
+        self.assertEqual(hook_calls[0][1]['framing'], 0.5)
+        self.assertEqual(hook_calls[0][1]['decode'], 0.25)
+
+    def test_process_message_unserializable_result(self):
+        rpc = RpcProcessor()
+
+        func = RpcFunction(lambda: object(), 'get_object', 'Returns something that is not JSON',
+                'hash', 'Some object')
+        rpc.add_function(func)
+
+        reply = rpc.process_message(b'{"method": "get_object", "params": [], "id": 1}')
+        self.assertEqual(json.loads(reply.decode('utf-8')), {'id': 1, 'result': None, 'error': {'name': 'InternalError', 'message': 'Internal error'}})
+
+    def test_process_message_deferred(self):
+        from twisted.internet import defer
+
+        pending = []
+
+        def deferred_echo(msg):
+            d = defer.Deferred()
+            pending.append((d, msg))
+            return d
+
+        rpc = RpcProcessor()
+
+        func = RpcFunction(deferred_echo, 'deferred_echo', 'Returns what it was given later',
+                'string', 'Same value as the first parameter')
+        func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(func)
+
+        replies = []
+        d = rpc.process_message(b'[{"method": "deferred_echo", "params": ["a"], "id": 1}, {"method": "deferred_echo", "params": ["b"], "id": 2}]')
+        d.addCallback(replies.append)
+
+        # both functions run concurrently and the reply is sent after the last one
+        self.assertEqual(len(pending), 2)
+        pending[1][0].callback(pending[1][1])
+        self.assertEqual(replies, [])
+        pending[0][0].errback(JsonRpcError("Failed"))
+
+        self.assertEqual(json.loads(replies[0].decode('utf-8')), [
+            {'id': 1, 'result': None, 'error': {'name': 'JsonRpcError', 'message': 'Failed'}},
+            {'id': 2, 'result': 'b', 'error': None}])
+
+    def test_coroutines(self):
+        import asyncio
+
+        notified = []
+
+        async def async_echo(msg):
+            await asyncio.sleep(0)
+            return msg
+
+        async def async_error():
+            await asyncio.sleep(0)
+            raise JsonRpcError("Failed")
+
+        async def async_notify(msg):
+            await asyncio.sleep(0)
+            notified.append(msg)
+
+        rpc = RpcProcessor()
+
+        func = RpcFunction(async_echo, 'async_echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(func)
+
+        func = RpcFunction(async_error, 'async_error', 'Raises an error',
+                'string', 'Nothing')
+        rpc.add_function(func)
+
+        func = RpcFunction(async_notify, 'async_notify', 'Remembers a value',
+                'bool', 'Nothing')
+        func.add_param('string', 'message', 'Message to remember')
+        rpc.add_function(func)
+
+        reply = asyncio.run(rpc.process_request_async('{"method": "async_echo", "params": ["Hello"], "id": 1}'))
+        self.assertEqual(reply, {'id': 1, 'result': 'Hello', 'error': None})
+
+        reply = asyncio.run(rpc.process_request_async('{"method": "async_error", "params": [], "id": 2}'))
+        self.assertEqual(reply, {'id': 2, 'result': None, 'error': {'name': 'JsonRpcError', 'message': 'Failed'}})
+
+        # plain functions work with the async API as well
+        reply = asyncio.run(rpc.process_request_async('{"method": "__describe_service", "params": [], "id": 3}'))
+        self.assertEqual(reply['id'], 3)
+        self.assertEqual(type(reply['result']), dict)
+
+        reply = asyncio.run(rpc.process_request_async('{"method": "async_notify", "params": ["a"], "id": null}'))
+        self.assertEqual(reply, None)
+        self.assertEqual(notified, ['a'])
+
+        # process_message returns an awaitable that has to be run
+        reply = rpc.process_message(b'[{"method": "async_echo", "params": ["b"], "id": 4}, {"method": "async_notify", "params": ["c"], "id": null}, {"method": "async_echo", "params": [5], "id": 5}]')
+        self.assertEqual(json.loads(asyncio.run(reply).decode('utf-8')), [
+            {'id': 4, 'result': 'b', 'error': None},
+            {'id': 5, 'result': None, 'error': {'name': 'TypeError', 'message': 'async_echo: Expected value of type \'string\' for parameter \'message\' but got value of type \'int\''}}])
+        self.assertEqual(notified, ['a', 'c'])
+
+        reply = asyncio.run(rpc.process_message_async(b'{"method": "async_notify", "params": ["d"], "id": null}'))
+        self.assertEqual(reply, None)
+        self.assertEqual(notified, ['a', 'c', 'd'])
+
+    def test_mixed_batch(self):
+        import asyncio
+
+        notified = []
+
+        async def async_notify(msg):
+            await asyncio.sleep(0)
+            notified.append(msg)
+
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(echo_func)
+
+        func = RpcFunction(async_notify, 'async_notify', 'Remembers a value',
+                'bool', 'Nothing')
+        func.add_param('string', 'message', 'Message to remember')
+        rpc.add_function(func)
+
+        # the notification is kept apart from the replies
+        reply = rpc.process_request('[{"method": "async_notify", "params": ["a"], "id": null}, {"method": "echo", "params": ["Hello"], "id": 1}]')
+        self.assertEqual(reply, [{'id': 1, 'result': 'Hello', 'error': None}])
+        self.assertEqual(len(reply.notifications), 1)
+        self.assertEqual(notified, [])
+
+        for notification in reply.notifications:
+            asyncio.run(notification)
+        self.assertEqual(notified, ['a'])
+
+        # without replies a single awaitable runs all notifications
+        reply = rpc.process_request('[{"method": "async_notify", "params": ["b"], "id": null}, {"method": "async_notify", "params": ["c"], "id": null}, {"method": "echo", "params": ["Hello"], "id": null}]')
+        self.assertEqual(asyncio.run(reply), None)
+        self.assertEqual(notified, ['a', 'b', 'c'])
+
+        reply = rpc.process_request('[{"method": "echo", "params": ["Hello"], "id": 2}]')
+        self.assertEqual(reply, [{'id': 2, 'result': 'Hello', 'error': None}])
+        self.assertEqual(reply.notifications, [])
+
+    def test_executor(self):
+        calls = []
+
+        class DummyExecutor(object):
+            def execute(self, pool_name, func, params):
+                calls.append(pool_name)
+                return func(*params)
+
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+        echo_func.run_in_thread_pool('io')
+        rpc.add_function(echo_func)
+
+        auth_func = RpcFunction(authcheck, 'authcheck', 'Returns the rpcinfo',
+                'string', 'Authentication information')
+        auth_func.require_rpcinfo()
+        auth_func.run_in_thread_pool()
+        rpc.add_function(auth_func)
+
+        # without an executor functions are executed inline
+        reply = rpc.process_request('{"method": "echo", "params": ["Hello"], "id": 1}')
+        self.assertEqual(reply, {'id': 1, 'result': 'Hello', 'error': None})
+        self.assertEqual(calls, [])
+
+        rpc.set_executor(DummyExecutor())
+
+        reply = rpc.process_request('{"method": "echo", "params": ["Hello"], "id": 2}')
+        self.assertEqual(reply, {'id': 2, 'result': 'Hello', 'error': None})
+
+        rpcinfo = {'authenticated': True, 'username': 'bob'}
+        reply = rpc.process_request('{"method": "authcheck", "params": [], "id": 3}', rpcinfo)
+        self.assertEqual(reply['result'], 'Authenticated: True; Username: bob')
+        self.assertEqual(calls, ['io', 'default'])
+
+        echo_func.run_inline()
+        reply = rpc.process_request('{"method": "echo", "params": ["Hello"], "id": 4}')
+        self.assertEqual(reply, {'id': 4, 'result': 'Hello', 'error': None})
+        self.assertEqual(calls, ['io', 'default'])
+
+    def test_process_pool(self):
+        import asyncio
+        from reflectrpc.processpool import ProcessPool
+
+        rpc = RpcProcessor()
+        rpc.add_process_pool(ProcessPool(processes=1), 'workers')
+
+        func = RpcFunction(worker_pid, 'worker_pid', 'Returns the PID of the worker',
+                'int', 'PID')
+        func.run_in_process_pool('workers')
+        rpc.add_function(func)
+
+        func = RpcFunction(echo, 'unknown_pool', 'Uses a pool that does not exist',
+                'string', 'Nothing')
+        func.run_in_process_pool('unknown')
+        rpc.add_function(func)
+
+        try:
+            # without a running event loop the call blocks
+            reply = rpc.process_request('{"method": "worker_pid", "params": [], "id": 1}')
+            self.assertNotEqual(reply['result'], os.getpid())
+            pid = reply['result']
+
+            # with asyncio the result is awaited
+            reply = asyncio.run(rpc.process_request_async('{"method": "worker_pid", "params": [], "id": 2}'))
+            self.assertEqual(reply, {'id': 2, 'result': pid, 'error': None})
+
+            reply = rpc.process_request('{"method": "unknown_pool", "params": [], "id": 3}')
+            self.assertEqual(reply['error']['name'], 'InternalError')
+        finally:
+            rpc.stop_process_pools()
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'fork is not supported')
+    def test_process_pool_fork(self):
+        import multiprocessing
+        from reflectrpc.processpool import ProcessPool
+
+        global worker_state
+        worker_state = 'changed'
+
+        # fork is used even if the default start method is a different one
+        default_method = multiprocessing.get_start_method(allow_none=True)
+        multiprocessing.set_start_method('spawn', force=True)
+        pool = ProcessPool(processes=1)
+
+        try:
+            pool.start()
+            self.assertEqual('fork', pool.context.get_start_method())
+            self.assertEqual('changed', pool.apply(get_worker_state, ()))
+        finally:
+            pool.stop()
+            multiprocessing.set_start_method(default_method, force=True)
+            worker_state = 'imported'
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'fork is not supported')
+    def test_process_pool_no_fork(self):
+        import threading
+        from reflectrpc.processpool import get_worker_context
+
+        self.assertEqual('fork', get_worker_context(None).get_start_method())
+
+        # replaced workers would be forked from a server that runs threads
+        self.assertNotEqual('fork', get_worker_context(10).get_start_method())
+
+        stop = threading.Event()
+        t = threading.Thread(target = stop.wait, args = ())
+        t.start()
+
+        try:
+            self.assertNotEqual('fork', get_worker_context(None).get_start_method())
+        finally:
+            stop.set()
+            t.join()
+
+    def test_result_cache(self):
+        calls = []
+
+        def lookup(key):
+            calls.append(key)
+            return {'key': key}
+
+        def whoami(rpcinfo):
+            calls.append(rpcinfo['username'])
+            return rpcinfo['username']
+
+        rpc = RpcProcessor()
+
+        func = RpcFunction(lookup, 'lookup', 'Looks up a key', 'hash', 'Value')
+        func.add_param('string', 'key', 'Key to look up')
+        func.enable_result_cache(max_entries=2)
+        rpc.add_function(func)
+
+        func = RpcFunction(whoami, 'whoami', 'Returns the username', 'string',
+                'Username')
+        func.require_rpcinfo()
+        func.enable_result_cache(per_user=True)
+        rpc.add_function(func)
+
+        for i in range(2):
+            reply = rpc.process_message(b'{"method": "lookup", "params": ["a"], "id": 1}')
+            self.assertEqual(json.loads(reply.decode('utf-8')), {'id': 1, 'result': {'key': 'a'}, 'error': None})
+
+            reply = rpc.process_request('{"method": "lookup", "params": ["a"], "id": 2}')
+            self.assertEqual(reply, {'id': 2, 'result': {'key': 'a'}, 'error': None})
+
+        self.assertEqual(calls, ['a'])
+
+        # 'a' is evicted as least recently used entry
+        rpc.process_request('{"method": "lookup", "params": ["b"], "id": 3}')
+        rpc.process_request('{"method": "lookup", "params": ["c"], "id": 4}')
+        rpc.process_request('{"method": "lookup", "params": ["a"], "id": 5}')
+        self.assertEqual(calls, ['a', 'b', 'c', 'a'])
+
+        # failed type checks don't reach the cache
+        reply = rpc.process_request('{"method": "lookup", "params": [1], "id": 6}')
+        self.assertEqual(reply['error']['name'], 'TypeError')
+
+        for username in ['alice', 'bob', 'alice']:
+            rpcinfo = {'authenticated': True, 'username': username}
+            reply = rpc.process_request('{"method": "whoami", "params": [], "id": 7}', rpcinfo)
+            self.assertEqual(reply['result'], username)
+
+        self.assertEqual(calls, ['a', 'b', 'c', 'a', 'alice', 'bob'])
+
+        reply = rpc.process_request('{"method": "__describe_result_caches", "params": [], "id": 8}')
+        self.assertEqual(reply['result'], {
+            'lookup': {'entries': 2, 'max_entries': 2, 'ttl': None, 'hits': 3,
+                'misses': 4, 'evictions': 2, 'expirations': 0},
+            'whoami': {'entries': 2, 'max_entries': 1024, 'ttl': None,
+                'hits': 1, 'misses': 2, 'evictions': 0, 'expirations': 0}
+        })
+
+        rpc.clear_result_caches()
+        rpc.process_request('{"method": "lookup", "params": ["a"], "id": 9}')
+        self.assertEqual(calls, ['a', 'b', 'c', 'a', 'alice', 'bob', 'a'])
+
+        # callers can't change the cached result
+        reply = rpc.process_request('{"method": "lookup", "params": ["a"], "id": 10}')
+        reply['result']['key'] = 'changed'
+        reply = rpc.process_request('{"method": "lookup", "params": ["a"], "id": 11}')
+        self.assertEqual(reply['result'], {'key': 'a'})
+
+    def test_result_cache_deferred(self):
+        from twisted.internet import defer
+
+        calls = []
+
+        def deferred_lookup(key):
+            calls.append(key)
+            return defer.succeed(key)
+
+        rpc = RpcProcessor()
+
+        func = RpcFunction(deferred_lookup, 'deferred_lookup', 'Looks up a key',
+                'string', 'Value')
+        func.add_param('string', 'key', 'Key to look up')
+        func.enable_result_cache()
+        rpc.add_function(func)
+
+        replies = []
+        d = rpc.process_message(b'{"method": "deferred_lookup", "params": ["a"], "id": 1}')
+        d.addCallback(replies.append)
+
+        reply = rpc.process_message(b'{"method": "deferred_lookup", "params": ["a"], "id": 2}')
+        replies.append(reply)
+
+        self.assertEqual([json.loads(r.decode('utf-8')) for r in replies], [
+            {'id': 1, 'result': 'a', 'error': None},
+            {'id': 2, 'result': 'a', 'error': None}])
+        self.assertEqual(calls, ['a'])
+
+        # process_request passes plain values on
+        results = []
+        reply = rpc.process_request('{"method": "deferred_lookup", "params": ["b"], "id": 3}')
+        reply['result'].addCallback(results.append)
+        self.assertEqual(results, ['b'])
+
+    def test_result_cache_coroutine(self):
+        import asyncio
+
+        calls = []
+
+        async def async_lookup(key):
+            calls.append(key)
+            return {'key': key}
+
+        rpc = RpcProcessor()
+
+        func = RpcFunction(async_lookup, 'async_lookup', 'Looks up a key',
+                'hash', 'Value')
+        func.add_param('string', 'key', 'Key to look up')
+        func.enable_result_cache()
+        rpc.add_function(func)
+
+        reply = rpc.process_request('{"method": "async_lookup", "params": ["a"], "id": 1}')
+        self.assertEqual(asyncio.run(reply['result']), {'key': 'a'})
+
+        reply = rpc.process_request('{"method": "async_lookup", "params": ["a"], "id": 2}')
+        self.assertEqual(reply['result'], {'key': 'a'})
+        self.assertEqual(calls, ['a'])
+
+    def test_metrics(self):
+        import asyncio
+        import time
+        from twisted.internet import defer
+
+        pending = []
+
+        def deferred_echo(msg):
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+
+        async def async_error():
+            await asyncio.sleep(0.01)
+            raise JsonRpcError("Failed")
+
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(echo_func)
+
+        func = RpcFunction(deferred_echo, 'deferred_echo', 'Returns what it was given later',
+                'string', 'Same value as the first parameter')
+        func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(func)
+
+        func = RpcFunction(async_error, 'async_error', 'Raises an error',
+                'string', 'Nothing')
+        rpc.add_function(func)
+
+        # nothing is recorded by default
+        rpc.process_request('{"method": "echo", "params": ["Hello"], "id": 1}')
+        self.assertEqual(rpc.describe_metrics(), {})
+
+        rpc.enable_metrics()
+
+        rpc.process_request('{"method": "echo", "params": ["Hello"], "id": 1}')
+        rpc.process_request('{"method": "echo", "params": [1], "id": 2}')
+        rpc.process_request('{"method": "echo", "params": ["Hello"], "id": null}')
+
+        # unknown methods are not recorded
+        rpc.process_request('{"method": "unknown", "params": [], "id": 3}')
+
+        # Deferreds are measured when they fire
+        rpc.process_message(b'{"method": "deferred_echo", "params": ["Hello"], "id": 4}')
+        time.sleep(0.01)
+        pending[0].callback('Hello')
+
+        asyncio.run(rpc.process_request_async('{"method": "async_error", "params": [], "id": 5}'))
+
+        metrics = rpc.process_request('{"method": "__describe_metrics", "params": [], "id": 6}')['result']
+
+        self.assertEqual(sorted(metrics.keys()), ['async_error', 'deferred_echo', 'echo'])
+        self.assertEqual(metrics['echo']['calls'], 3)
+        self.assertEqual(metrics['echo']['errors'], {'TypeError': 1})
+        self.assertEqual(metrics['echo']['latency']['count'], 3)
+        self.assertEqual(metrics['deferred_echo']['calls'], 1)
+        self.assertTrue(metrics['deferred_echo']['latency']['sum'] >= 0.01)
+        self.assertEqual(metrics['async_error']['errors'], {'JsonRpcError': 1})
+        self.assertTrue(metrics['async_error']['latency']['sum'] >= 0.01)
+
+        rpc.disable_metrics()
+        rpc.process_request('{"method": "echo", "params": ["Hello"], "id": 7}')
+        self.assertEqual(rpc.describe_metrics()['echo']['calls'], 3)
+
+    def test_phase_timing(self):
+        import asyncio
+
+        async def async_echo(msg):
+            await asyncio.sleep(0.01)
+            return msg
+
+        hook_calls = []
+
+        rpc = RpcProcessor()
+        rpc.enable_phase_timing(lambda method, phases: hook_calls.append((method, phases)))
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(echo_func)
+
+        func = RpcFunction(async_echo, 'async_echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(func)
+
+        rpc.process_message(b'{"method": "echo", "params": ["Hello"], "id": 1}', None, 0.5)
+        rpc.process_message(b'{"method": "echo", "params": [1], "id": 2}')
+        rpc.process_message(b'{"method": "echo", "params": ["Hello"], "id": 3')
+        rpc.process_message(b'[{"method": "echo", "params": ["Hello"], "id": 4}]')
+        asyncio.run(rpc.process_message_async(b'{"method": "async_echo", "params": ["Hello"], "id": 5}'))
+
+        self.assertEqual([c[0] for c in hook_calls],
+                ['echo', 'echo', '[invalid]', '[batch]', 'async_echo'])
+        self.assertEqual(sorted(hook_calls[0][1].keys()),
+                ['decode', 'encode', 'envelope', 'execution', 'framing', 'type_check'])
+        self.assertEqual(hook_calls[0][1]['framing'], 0.5)
+        self.assertEqual(sorted(hook_calls[1][1].keys()),
+                ['decode', 'encode', 'envelope', 'error_handling', 'type_check'])
+        self.assertEqual(sorted(hook_calls[2][1].keys()), ['decode', 'encode'])
+        self.assertTrue(hook_calls[4][1]['execution'] >= 0.01)
+
+        timings = rpc.process_request('{"method": "__describe_phase_timings", "params": [], "id": 6}')['result']
+        self.assertEqual(timings['echo']['count'], 2)
+        self.assertEqual(timings['echo']['phases']['framing']['total'], 0.5)
+        self.assertEqual(timings['echo']['phases']['framing']['mean'], 0.25)
+        self.assertEqual(timings['echo']['phases']['framing']['max'], 0.5)
+        self.assertEqual(timings['async_echo']['count'], 1)
+
+        rpc.disable_phase_timing()
+        rpc.process_message(b'{"method": "echo", "params": ["Hello"], "id": 7}')
+        self.assertEqual(len(hook_calls), 5)
+        self.assertEqual(rpc.describe_phase_timings()['echo']['count'], 2)
+
+    def test_profiler(self):
+        import time
+
+        def busy(seconds):
+            end = time.time() + seconds
+            while time.time() < end:
+                pass
+
+            return True
+
+        rpc = RpcProcessor()
+
+        func = RpcFunction(busy, 'busy', 'Keeps the CPU busy',
+                'bool', 'Always true')
+        func.add_param('float', 'seconds', 'Seconds to be busy')
+        rpc.add_function(func)
+
+        admin = {'authenticated': True, 'username': 'admin'}
+
+        reply = rpc.process_request('{"method": "__start_profiler", "params": [1], "id": 1}', admin)
+        self.assertEqual(reply['error'], {'name': 'PermissionDenied',
+            'message': "Only privileged users can call '__start_profiler'"})
+
+        rpc.set_privileged_users(['admin'])
+
+        reply = rpc.process_request('{"method": "__start_profiler", "params": [1], "id": 2}')
+        self.assertEqual(reply['error']['name'], 'PermissionDenied')
+
+        reply = rpc.process_request('{"method": "__start_profiler", "params": [0], "id": 3}', admin)
+        self.assertEqual(reply['error']['name'], 'InvalidRequest')
+
+        reply = rpc.process_request('{"method": "__start_profiler", "params": [60, 500], "id": 4}', admin)
+        self.assertEqual(reply['result'], True)
+        self.assertTrue(rpc.profiler is not None)
+
+        reply = rpc.process_request('{"method": "__start_profiler", "params": [60], "id": 5}', admin)
+        self.assertEqual(reply['error'], {'name': 'InvalidRequest',
+            'message': 'Profiler is already running'})
+
+        rpc.process_request('{"method": "busy", "params": [0.2], "id": 6}')
+
+        reply = rpc.process_request('{"method": "__stop_profiler", "params": [], "id": 7}', admin)
+        self.assertEqual(reply['result'], True)
+        self.assertTrue(rpc.profiler is None)
+
+        reply = rpc.process_request('{"method": "__get_profile", "params": [], "id": 8}', admin)
+        profile = reply['result']
+        self.assertFalse(profile['running'])
+        self.assertEqual(profile['format'], 'collapsed')
+        self.assertTrue([l for l in profile['data'].split('\n') if l.startswith('busy;')])
+
+        reply = rpc.process_request('{"method": "__get_profile", "params": ["pstats"], "id": 9}', admin)
+        self.assertEqual(reply['result']['format'], 'pstats')
+
+        reply = rpc.process_request('{"method": "__get_profile", "params": ["xml"], "id": 10}', admin)
+        self.assertEqual(reply['error']['name'], 'InvalidRequest')
+
+    def test_slow_requests(self):
+        import time
+        from twisted.internet import defer
+
+        pending = []
+
+        def slow_echo(msg):
+            time.sleep(0.02)
+            return msg
+
+        def deferred_echo(msg):
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+
+        rpc = RpcProcessor()
+        rpc.set_privileged_users(['admin'])
+        rpc.enable_slow_request_log(max_entries=2, threshold=0.01)
+        rpc.enable_phase_timing()
+
+        func = RpcFunction(slow_echo, 'slow_echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(func)
+
+        func = RpcFunction(deferred_echo, 'deferred_echo', 'Returns what it was given later',
+                'string', 'Same value as the first parameter')
+        func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(func)
+
+        admin = {'authenticated': True, 'username': 'admin'}
+
+        rpc.process_message(b'{"method": "slow_echo", "params": ["Hello"], "id": 1}', admin)
+        rpc.process_message(b'{"method": "deferred_echo", "params": ["World"], "id": 2}')
+        time.sleep(0.02)
+        pending[0].callback('World')
+
+        reply = rpc.process_request('{"method": "__describe_slow_requests", "params": [], "id": 3}')
+        self.assertEqual(reply['error']['name'], 'PermissionDenied')
+
+        reply = rpc.process_request('{"method": "__describe_slow_requests", "params": [], "id": 4}', admin)
+        log = reply['result']
+        self.assertEqual(log['threshold'], 0.01)
+        self.assertEqual([e['method'] for e in log['over_threshold']],
+                ['slow_echo', 'deferred_echo'])
+
+        entry = log['over_threshold'][0]
+        self.assertEqual(entry['params'], '["Hello"]')
+        self.assertEqual(entry['username'], 'admin')
+        self.assertFalse(entry['deferred'])
+        self.assertTrue(entry['phases']['execution'] >= 0.02)
+        self.assertTrue('encode' in entry['phases'])
+
+        entry = log['over_threshold'][1]
+        self.assertEqual(entry['username'], None)
+        self.assertTrue(entry['deferred'])
+
+        reply = rpc.process_request('{"method": "__clear_slow_requests", "params": [], "id": 5}', admin)
+        self.assertEqual(reply['result'], True)
+
+        # the call of the builtin itself is logged after the log was cleared
+        log = rpc.describe_slow_requests()
+        self.assertEqual(log['over_threshold'], [])
+        self.assertEqual([e['method'] for e in log['slowest']], ['__clear_slow_requests'])
+
+        rpc.disable_slow_request_log()
+        reply = rpc.process_request('{"method": "__describe_slow_requests", "params": [], "id": 6}', admin)
+        self.assertEqual(reply['error']['message'], 'Slow request log is disabled')
+
+    def test_event_loop_lag(self):
+        from reflectrpc.metrics import LagMonitor
+
+        rpc = RpcProcessor()
+
+        reply = rpc.process_request('{"method": "__describe_event_loop_lag", "params": [], "id": 1}')
+        self.assertEqual(reply['error']['message'], 'Event loop lag monitor is disabled')
+
+        monitor = LagMonitor()
+        rpc.set_lag_monitor(monitor)
+
+        ticks = []
+        monitor.start(lambda seconds, func: ticks.append(func))
+
+        rpc.process_request('{"method": "__describe_metrics", "params": [], "id": 2}')
+        self.assertEqual(monitor.longest_method, '__describe_metrics')
+
+        reply = rpc.process_request('{"method": "__describe_event_loop_lag", "params": [], "id": 3}')
+        self.assertEqual(reply['result']['interval'], 0.1)
+        self.assertEqual(reply['result']['lag']['count'], 0)
+
+    def test_in_flight_requests(self):
+        import asyncio
+
+        rpc = RpcProcessor()
+        rpc.set_privileged_users(['admin'])
+        admin = {'authenticated': True, 'username': 'admin', 'peer': '127.0.0.1:4000'}
+
+        reply = rpc.process_request('{"method": "__describe_in_flight_requests", "params": [], "id": 0}', admin)
+        self.assertEqual(reply['error']['message'], 'In-flight tracking is disabled')
+
+        rpc.enable_in_flight_tracking()
+
+        async def wait_for(event):
+            await event.wait()
+            return 'done'
+
+        async def run():
+            event = asyncio.Event()
+
+            func = RpcFunction(lambda: wait_for(event), 'wait', 'Waits for an event',
+                    'string', 'Always done')
+            rpc.add_function(func)
+
+            reply = rpc.process_request('{"method": "wait", "params": [], "id": 1}')
+            task = asyncio.ensure_future(reply['result'])
+            await asyncio.sleep(0)
+
+            reply = rpc.process_request('{"method": "__describe_in_flight_requests", "params": [], "id": 2}')
+            self.assertEqual(reply['error']['name'], 'PermissionDenied')
+
+            reply = rpc.process_request('{"method": "__describe_in_flight_requests", "params": [], "id": 3}', admin)
+            requests = reply['result']
+            self.assertEqual([r['method'] for r in requests], ['wait', '__describe_in_flight_requests'])
+            self.assertTrue(requests[0]['waiting'])
+            self.assertEqual(requests[0]['username'], None)
+            self.assertFalse(requests[1]['waiting'])
+            self.assertEqual(requests[1]['username'], 'admin')
+            self.assertEqual(requests[1]['peer'], '127.0.0.1:4000')
+
+            event.set()
+            self.assertEqual(await task, 'done')
+
+        asyncio.run(run())
+        self.assertEqual(rpc.in_flight.to_list(), [])
+
+        rpc.process_request('{"method": "echo", "params": [], "id": 4}')
+        self.assertEqual(rpc.in_flight.to_list(), [])
+
+        rpc.disable_in_flight_tracking()
+        reply = rpc.process_request('{"method": "__describe_in_flight_requests", "params": [], "id": 5}', admin)
+        self.assertEqual(reply['error']['message'], 'In-flight tracking is disabled')
+
+    def test_memory_tracing(self):
+        rpc = RpcProcessor()
+        rpc.set_privileged_users(['admin'])
+        admin = {'authenticated': True, 'username': 'admin'}
+
+        reply = rpc.process_request('{"method": "__start_memory_tracing", "params": [], "id": 1}')
+        self.assertEqual(reply['error']['name'], 'PermissionDenied')
+
+        reply = rpc.process_request('{"method": "__take_memory_snapshot", "params": ["before"], "id": 2}', admin)
+        self.assertEqual(reply['error']['name'], 'InvalidRequest')
+
+        try:
+            reply = rpc.process_request('{"method": "__start_memory_tracing", "params": [], "id": 3}', admin)
+            self.assertTrue(reply['result']['tracing'])
+
+            rpc.process_request('{"method": "__take_memory_snapshot", "params": ["before"], "id": 4}', admin)
+            blocks = [bytearray(1000) for i in range(100)]
+            reply = rpc.process_request('{"method": "__take_memory_snapshot", "params": ["after"], "id": 5}', admin)
+            self.assertEqual(reply['result']['snapshots'], ['before', 'after'])
+
+            reply = rpc.process_request('{"method": "__compare_memory_snapshots", "params": ["before", "after", 3], "id": 6}', admin)
+            self.assertTrue(len(reply['result']) <= 3)
+            self.assertTrue(reply['result'][0]['size_diff'] >= 100000)
+
+            reply = rpc.process_request('{"method": "__compare_memory_snapshots", "params": ["before", "unknown"], "id": 7}', admin)
+            self.assertEqual(reply['error']['message'], 'No such snapshot: unknown')
+        finally:
+            reply = rpc.process_request('{"method": "__stop_memory_tracing", "params": [], "id": 8}', admin)
+            self.assertEqual(reply['result'], True)
+
+        reply = rpc.process_request('{"method": "__describe_memory_tracing", "params": [], "id": 9}', admin)
+        self.assertFalse(reply['result']['tracing'])
+        self.assertEqual(reply['result']['snapshots'], [])
+
+    def test_builtin_params(self):
+        rpc = RpcProcessor()
+
+        reply = rpc.process_request('{"method": "__describe_service", "params": [1], "id": 1}')
+        self.assertEqual(reply['error'], {'name': 'ParamError',
+            'message': "Expected 0 parameters for '__describe_service' but got 1"})
+        self.assertEqual(reply['result'], None)
+
+        reply = rpc.process_request('{"method": "__describe_if_changed", "params": [], "id": 2}')
+        self.assertEqual(reply['error'], {'name': 'ParamError',
+            'message': "Expected 1 parameters for '__describe_if_changed' but got 0"})
+
+        # optional parameters may be left out
+        rpc.set_privileged_users(['admin'])
+        admin = {'authenticated': True, 'username': 'admin'}
+
+        reply = rpc.process_request('{"method": "__start_memory_tracing", "params": [], "id": 3}', admin)
+        self.assertEqual(reply['error'], None)
+        rpc.process_request('{"method": "__stop_memory_tracing", "params": [], "id": 4}', admin)
+
+        reply = rpc.process_request('{"method": "__get_profile", "params": ["collapsed", 1], "id": 5}', admin)
+        self.assertEqual(reply['error'], {'name': 'ParamError',
+            'message': "Expected 1 parameters for '__get_profile' but got 2"})
+
+    def test_description_cache(self):
+        rpc = RpcProcessor()
+        rpc.set_description("Example RPC Service",
+                "This is an example service for ReflectRPC", "1.0")
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(echo_func)
+
+        hash1 = rpc.description_hash()
+        self.assertEqual(hash1, rpc.description_hash())
+        self.assertTrue(rpc.describe_functions() is rpc.describe_functions())
+
+        reply = rpc.process_message(b'{"method": "__describe_functions", "params": [], "id": 1}')
+        self.assertEqual(json.loads(reply.decode('utf-8'))['result'], rpc.describe_functions())
+
+        reply = rpc.process_request('{"method": "__describe_if_changed", "params": [null], "id": 2}')
+        self.assertEqual(reply['error'], None)
+        self.assertEqual(reply['result'], {'hash': hash1, 'changed': True,
+            'service': rpc.describe_service(), 'functions': rpc.describe_functions(),
+            'custom_types': []})
+
+        reply = rpc.process_message(('{"method": "__describe_if_changed", "params": ["%s"], "id": 3}' % (hash1)).encode('utf-8'))
+        self.assertEqual(json.loads(reply.decode('utf-8'))['result'], {'hash': hash1, 'changed': False})
+
+        # adding a custom type changes the description
+        enum = JsonEnumType('PhoneType', 'Type of a phone number')
+        enum.add_value('HOME', 'Home phone')
+        rpc.add_custom_type(enum)
+
+        hash2 = rpc.description_hash()
+        self.assertNotEqual(hash1, hash2)
+        self.assertEqual(rpc.describe_custom_types(), [enum.to_dict()])
+
+        reply = rpc.process_message(('{"method": "__describe_if_changed", "params": ["%s"], "id": 4}' % (hash1)).encode('utf-8'))
+        result = json.loads(reply.decode('utf-8'))['result']
+        self.assertEqual(result['hash'], hash2)
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['custom_types'], [enum.to_dict()])
+
+        # so does adding a function or changing the service description
+        add_func = RpcFunction(add, 'add', 'Returns the sum of the two parameters',
+                'int', 'Sum of a and b')
+        rpc.add_function(add_func)
+        hash3 = rpc.description_hash()
+        self.assertNotEqual(hash2, hash3)
+        self.assertEqual(len(rpc.describe_functions()), 2)
+
+        rpc.set_description("Example RPC Service", "Changed", "1.1")
+        self.assertNotEqual(hash3, rpc.description_hash())
+
+        # changes to registered types need an explicit invalidation
+        enum.add_value('WORK', 'Work phone')
+        rpc.invalidate_description_cache()
+        self.assertEqual(len(rpc.describe_custom_types()[0]['values']), 2)
+
 if __name__ == '__main__':
     unittest.main()